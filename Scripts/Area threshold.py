@@ -1,3 +1,5 @@
+import os
+import sys
 import processing
 from qgis.PyQt.QtCore import (QCoreApplication,QVariant)
 from qgis.analysis import QgsZonalStatistics
@@ -20,6 +22,9 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterVectorDestination)
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import artifacts
+
 
 class AreaThreshold(QgsProcessingAlgorithm):
 
@@ -52,6 +57,8 @@ class AreaThreshold(QgsProcessingAlgorithm):
     
     The 'Max. memory usage (MB)' parameter the amount of physical memory that can be used by this process.
     
+    The flow accumulation raster is passed to r.stream.extract, so it is not calculated again here. It can come from the tiled mode of the terrain processing tool for DEMs larger than the memory limit.
+    
     A line vector with an empty 'StreamType' field is generated from this tool, which has to be filled based on the strahler order category (field 'Strahler'). 
     
     Other outputs include a flow direction and a strahler order rasters.
@@ -91,7 +98,8 @@ class AreaThreshold(QgsProcessingAlgorithm):
         #Dividing threshold in square meters by pixel size
         number_cells = int(thresh_meters / flowacc.rasterUnitsPerPixelX())
         
-        result = processing.run("grass7:r.stream.extract", {
+        # Derived rasters are reused from an earlier run with the same inputs and threshold
+        result = artifacts.run(processing.run, "grass7:r.stream.extract", {
         'elevation': dem,
         'threshold': number_cells,
         'memory': memory,
@@ -100,11 +108,11 @@ class AreaThreshold(QgsProcessingAlgorithm):
         'GRASS_REGION_CELLSIZE_PARAMETER' : 0,
         'GRASS_VECTOR_EXPORT_NOCAT' : False,
         'stream_length': 10,
-        'accumulation' : None, 'd8cut' : None, 'depression' : None,
+        'accumulation' : flowacc, 'd8cut' : None, 'depression' : None,
         'stream_vector':'TEMPORARY_OUTPUT',
         'stream_raster': streams_raster,
         'direction': flowdir,
-        }, context=context, feedback=feedback)
+        }, destinations=('stream_vector', 'stream_raster', 'direction'), ignore=('memory',), context=context, feedback=feedback)
         
         temp_stream_vector = result['stream_vector']
         
@@ -120,18 +128,18 @@ class AreaThreshold(QgsProcessingAlgorithm):
         temp_output = QgsProcessingUtils.generateTempFilename('strahler.tif')
         
         # Run r.stream.order algorithm
-        output_strahler = processing.run("grass7:r.stream.order", {
+        output_strahler = artifacts.run(processing.run, "grass7:r.stream.order", {
             'stream_ras': streams_raster,
             'direction': flowdir,
             'memory': memory,
             'GRASS_REGION_CELLSIZE_PARAMETER': 0,
             'GRASS_REGION_PARAMETER': None,
             'strahler': temp_output
-        }, context=context, feedback=feedback)["strahler"]
+        }, destinations=('strahler',), ignore=('memory',), context=context, feedback=feedback)["strahler"]
 
         
         # Convert raster to vector
-        output_strahler_v = processing.run("grass7:r.to.vect", {
+        output_strahler_v = artifacts.run(processing.run, "grass7:r.to.vect", {
             'input': output_strahler,
             'type': 0,
             'column': 'Strahler',
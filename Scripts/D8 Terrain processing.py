@@ -1,6 +1,7 @@
 
 import tempfile
 import os
+import sys
 import processing
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.analysis import QgsZonalStatistics
@@ -20,6 +21,9 @@ from qgis.core import (QgsProcessing,
 
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import artifacts, blocks, fill, flow, tiled
+
 
 
 
@@ -48,6 +52,10 @@ class D8TerrainProcessingAlgorithm(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr('''This algorithm fills a DEM and generates a hillshade raster
     
+    Flow direction and accumulation are D8 steepest descent on the filled DEM, with flat areas drained towards their nearest outlet. They replace r.watershed (-s -a) but are not identical to it: r.watershed routes with its own A* search, so cells on flats and on ties between neighbours can drain differently.
+    
+    Flow direction and accumulation are calculated in tiles when they do not fit in the 'Max. memory usage (MB)' parameter, with the same result as in one piece: the cells of flats, which drain across tile edges, are routed together once all tiles are read. Sink filling is not tiled: the whole DEM is filled at once (about 24 bytes per cell), and the tool stops with a message when that does not fit in the memory limit, so DEMs larger than RAM still have to be split into catchments.
+    
     --- Developed and adapted on July 2024 by Fernando Avendaño Veas (Massey University) using ArcPy scripts from the ACPF project (USDA) ---    
     ''')
 
@@ -57,16 +65,30 @@ class D8TerrainProcessingAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterRasterDestination('OutputFillDEM', 'Output Fill DEM'))
         self.addParameter(QgsProcessingParameterRasterDestination('OutputHshd', 'Output Hillshade'))
         self.addParameter(QgsProcessingParameterNumber('ZFactor', 'Z Factor', type=QgsProcessingParameterNumber.Double, minValue=0.0, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('MinSlope', 'Minimum slope of filled areas (degrees)', type=QgsProcessingParameterNumber.Double, minValue=0.0, defaultValue=0.0))
+        self.addParameter(QgsProcessingParameterNumber('Memory', 'Max. memory usage (MB)', type=QgsProcessingParameterNumber.Double, defaultValue=2000))
         self.addParameter(QgsProcessingParameterRasterDestination('OutputFlowAcc', 'Output Flow Accumulation'))
+        self.addParameter(QgsProcessingParameterRasterDestination('OutputFlowDir', 'Output Flow Direction', optional=True, createByDefault=False))
 
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         # Get parameter values
         dem = self.parameterAsRasterLayer(parameters, 'DEM', context)
         output_fill_dem = self.parameterAsOutputLayer(parameters, 'OutputFillDEM', context)
         output_flow_acc = self.parameterAsOutputLayer(parameters, 'OutputFlowAcc', context)       
+        output_flow_dir = self.parameterAsOutputLayer(parameters, 'OutputFlowDir', context)
         output_hillshade = self.parameterAsOutputLayer(parameters, 'OutputHshd', context)
         z_factor = self.parameterAsDouble(parameters, 'ZFactor', context)
+        min_slope = self.parameterAsDouble(parameters, 'MinSlope', context)
+        memory = self.parameterAsDouble(parameters, 'Memory', context)
         
         
         
@@ -74,37 +96,52 @@ class D8TerrainProcessingAlgorithm(QgsProcessingAlgorithm):
 
         if not dem.isValid():
             print('Invalid layers. Check file paths.')
+        elif not tiled.fits_in_memory(dem.source(), memory, tiled.FILL_BYTES_PER_CELL):
+            # Only flow routing is tiled: the sinks are filled on the whole DEM at once
+            raise QgsProcessingException(f'Filling the sinks of this DEM needs about {tiled.fill_memory_mb(dem.source()):.0f} MB, '
+                                         f'more than the {memory:.0f} MB allowed. Sink filling is not tiled; raise the memory '
+                                         'limit or split the DEM into catchments.')
         else:
-            output_fill_dem = processing.run("saga:fillsinksxxlwangliu", { 
+            # Every derived raster is reused from an earlier run with the same DEM and parameters
+            output_fill_dem = artifacts.call(fill.run_fill_sinks, {
             'ELEV': dem,
-            'MINSLOPE':0.0,
+            'MINSLOPE': min_slope,
             'FILLED': output_fill_dem,
-            }, context=context, feedback=feedback)["FILLED"]
-
-            # Calculate Flow Accumulation
-            output_flow_acc = processing.run("grass7:r.watershed", {
-                'elevation': output_fill_dem,
-                'threshold': 500000,
-                'memory': 3000,
-                '-s': True,
-                '-a': True,
-                'accumulation': output_flow_acc
-            }, context=context, feedback=feedback)["accumulation"]
+            }, feedback=feedback, destinations=('FILLED',))["FILLED"]
+
+            # Calculate Flow Direction and Accumulation (single flow direction, absolute values)
+            # DEMs that do not fit in the memory limit are processed in tiles
+            if tiled.fits_in_memory(output_fill_dem, memory):
+                flow_outputs = artifacts.call(flow.run_flow_accumulation, {
+                    'elevation': output_fill_dem,
+                    'accumulation': output_flow_acc,
+                    'drainage': output_flow_dir
+                }, feedback=feedback, destinations=('accumulation', 'drainage'))
+            else:
+                flow_outputs = artifacts.call(tiled.run_tiled_accumulation, {
+                    'elevation': output_fill_dem,
+                    'accumulation': output_flow_acc,
+                    'drainage': output_flow_dir,
+                    'memory': memory
+                }, feedback=feedback, destinations=('accumulation', 'drainage'), ignore=('memory',))
+            output_flow_acc = flow_outputs["accumulation"]
+            output_flow_dir = flow_outputs.get("drainage")
         
             # Calculate Hillshade
-            output_hillshade = processing.run("native:hillshade", {
+            output_hillshade = artifacts.run(processing.run, "native:hillshade", {
             'INPUT': output_fill_dem,
             'AZIMUTH': 315,
             'V_ANGLE': 45,
             'Z_FACTOR': z_factor,
             'OUTPUT': output_hillshade
-            }, context=context, feedback=feedback)["OUTPUT"]
+            }, destinations=('OUTPUT',), context=context, feedback=feedback)["OUTPUT"]
             
         # Return results
         return {
             'OutputFillDEM': output_fill_dem,
             'OutputHshd': output_hillshade,
-            'OutputFlowAcc': output_flow_acc
+            'OutputFlowAcc': output_flow_acc,
+            'OutputFlowDir': output_flow_dir
         }
     
     
@@ -0,0 +1,226 @@
+import os
+import sys
+import processing
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingException,
+                       QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingUtils,
+                       QgsVectorLayer,
+                       QgsFeature,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterVectorDestination)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import selection, tiles
+from dbsim.outputs import Outputs
+
+
+class DBs_tiled(QgsProcessingAlgorithm):
+
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def name(self):
+        return 'DBs tiled'
+
+    def displayName(self):
+        return '7c) Detainment bunds simulation tool (tiled)'
+
+    def group(self):
+        return 'DB simulator'
+
+    def groupId(self):
+        return 'dbsimulator'
+
+    def createInstance(self):
+        return DBs_tiled()
+
+    def shortHelpString(self):
+        return self.tr('''This algorithm runs the detainment bunds simulation tool (single scenario) over large catchments, cutting them into overlapping tiles.
+
+        Every tile is run on its own with the inputs clipped to the tile and a halo around it (the bund length plus "Halo"), so the memory used depends on the tile size and not on the catchment. The bunds of all tiles are merged, keeping each bund only in the tile that holds its centre, and overlapping bunds on tile borders are resolved as in a single run. The results are close to but not the same as a single run: the stations are laid out along the flow lines clipped to each halo, so they can shift by up to one spacing, and the elevation drop filter only sees the upstream points inside the halo.
+
+        With more than one tile in parallel the tiles are run as separate qgis_process commands, which needs the DB simulator scripts in the default QGIS profile.
+
+    --- Developed and adapted on July 2024 by Fernando Avendaño Veas (Massey University) using ArcPy scripts from the ACPF project (USDA) ---
+    ''')
+
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(QgsProcessingParameterVectorLayer('FB', 'Fields boundaries'))
+        self.addParameter(QgsProcessingParameterRasterLayer('UnfilledDEM', 'Unfilled DEM'))
+        self.addParameter(QgsProcessingParameterRasterLayer('FlowAcc', 'Flow accumulation raster'))
+        self.addParameter(QgsProcessingParameterVectorLayer('Flowpaths', 'Flow pathways from "Visualize flow pathways step"', types=[QgsProcessing.TypeVectorLine]))
+
+        self.addParameter(QgsProcessingParameterBoolean('Checkbox','''
+    Do flow lines come from previous step 'identifying flow pathways (detailed)'?
+        ''', defaultValue=True))
+
+        self.addParameter(QgsProcessingParameterVectorLayer('StreamReach', 'Stream reach or vector with perennial streams', types=[QgsProcessing.TypeVectorLine]))
+        self.addParameter(QgsProcessingParameterVectorLayer('CatchmentBoundary', 'Catchment boundary'))
+        self.addParameter(QgsProcessingParameterNumber('Spacing', 'Point spacing (m) to simulate detainment bunds', QgsProcessingParameterNumber.Integer, defaultValue=60))
+        self.addParameter(QgsProcessingParameterNumber('Height', 'Detainment bund height (m)', QgsProcessingParameterNumber.Integer, defaultValue=3))
+        self.addParameter(QgsProcessingParameterNumber('Length', 'Detainment bund length (m)', QgsProcessingParameterNumber.Integer, defaultValue=20))
+
+        self.addParameter(QgsProcessingParameterBoolean('Checkbox2','''
+    Eliminate DBs that are too incised (> twice the height of DB)?
+        ''', defaultValue=False))
+
+        self.addParameter(QgsProcessingParameterNumber('Z', 'Z factor', QgsProcessingParameterNumber.Double, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('TileSize', 'Tile size (m)', QgsProcessingParameterNumber.Double, defaultValue=5000, minValue=100))
+        self.addParameter(QgsProcessingParameterNumber('Halo', 'Halo around the tiles beyond the bund length (m)', QgsProcessingParameterNumber.Double, defaultValue=100, minValue=0))
+        self.addParameter(QgsProcessingParameterNumber('Tiles', 'Tiles run in parallel', QgsProcessingParameterNumber.Integer, defaultValue=1, minValue=1))
+        self.addParameter(QgsProcessingParameterNumber('Workers', 'Parallel processes evaluating the reaches of each tile (0 or 1 runs in the tile process)', QgsProcessingParameterNumber.Integer, defaultValue=0, minValue=0))
+        self.addParameter(QgsProcessingParameterVectorDestination('PotentialDB', 'Potential DB'))
+
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+
+        fb=self.parameterAsVectorLayer(parameters, 'FB', context)
+        dem = self.parameterAsRasterLayer(parameters, 'UnfilledDEM', context)
+        flowacc = self.parameterAsRasterLayer(parameters, 'FlowAcc', context)
+        flow_network = self.parameterAsVectorLayer(parameters, 'Flowpaths', context)
+        stream_reach = self.parameterAsVectorLayer(parameters, 'StreamReach', context)
+        catchment = self.parameterAsVectorLayer(parameters, 'CatchmentBoundary', context)
+        length=self.parameterAsDouble(parameters,'Length', context)
+        tile_size = self.parameterAsDouble(parameters, 'TileSize', context)
+        halo = self.parameterAsDouble(parameters, 'Halo', context)
+        parallel = self.parameterAsInt(parameters, 'Tiles', context)
+        out_db = self.parameterAsOutputLayer(parameters, 'PotentialDB', context)
+
+        outputs = Outputs(feedback)
+
+
+        # Overlap suppression in the single scenario tool only removes crossing bunds, so the halo only
+        # has to hold the bund length plus the extra distance asked
+        bbox = catchment.extent()
+        extent = (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum())
+        grid = tiles.tile_grid(extent, tile_size, length + halo)
+
+        feedback.pushInfo(f'''
+
+        ---------Cutting the catchment into {len(grid)} tiles of {tile_size} m with a {length + halo} m halo -------------------
+
+        ''')
+
+        crs = catchment.crs().authid()
+        runs = []
+        for tile in grid:
+            if feedback.isCanceled():
+                break
+            xmin, ymin, xmax, ymax = tile.halo
+            box = f'{xmin},{xmax},{ymin},{ymax} [{crs}]'
+
+            tile_catchment = processing.run("native:extractbyextent", {
+                'INPUT': catchment,
+                'EXTENT': box,
+                'CLIP': True,
+                'OUTPUT': QgsProcessingUtils.generateTempFilename(f'{tile.name}_catchment.gpkg')
+            }, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
+
+            if QgsVectorLayer(tile_catchment, tile.name, 'ogr').featureCount() == 0:
+                continue
+
+            # Inputs clipped to the halo of the tile
+            tile_parameters = {'CatchmentBoundary': tile_catchment}
+            for key, layer in (('FB', fb), ('Flowpaths', flow_network), ('StreamReach', stream_reach)):
+                tile_parameters[key] = processing.run("native:extractbyextent", {
+                    'INPUT': layer,
+                    'EXTENT': box,
+                    'CLIP': True,
+                    'OUTPUT': QgsProcessingUtils.generateTempFilename(f'{tile.name}_{key}.gpkg')
+                }, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
+
+            for key, layer in (('UnfilledDEM', dem), ('FlowAcc', flowacc)):
+                tile_parameters[key] = processing.run("gdal:cliprasterbyextent", {
+                    'INPUT': layer,
+                    'PROJWIN': box,
+                    'OUTPUT': QgsProcessingUtils.generateTempFilename(f'{tile.name}_{key}.tif')
+                }, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
+
+            for key in ('Checkbox', 'Spacing', 'Height', 'Length', 'Checkbox2', 'Z', 'Workers'):
+                tile_parameters[key] = parameters[key]
+            tile_parameters['PotentialDB'] = QgsProcessingUtils.generateTempFilename(f'{tile.name}_bunds.gpkg')
+            runs.append((tile, tile_parameters))
+
+
+        feedback.pushInfo(f'''
+
+        ---------Simulating detainment bunds in {len(runs)} tiles, {parallel} at a time -------------------
+
+        ''')
+
+        if parallel > 1 and len(runs) > 1:
+            executable = tiles.find_qgis_process()
+            if executable is None:
+                raise QgsProcessingException('qgis_process was not found; run the tiles one at a time')
+            commands = [tiles.qgis_process_command(executable, 'script:DBs', {key: str(value).lower() if isinstance(value, bool) else value
+                                                                             for key, value in tile_parameters.items()})
+                        for _, tile_parameters in runs]
+            try:
+                tiles.run_commands(commands, parallel, feedback)
+            except RuntimeError as e:
+                raise QgsProcessingException(str(e))
+        else:
+            for i, (tile, tile_parameters) in enumerate(runs):
+                if feedback.isCanceled():
+                    break
+                feedback.pushInfo(f'Tile {i + 1} of {len(runs)} ({tile.name})')
+                processing.run('script:DBs', tile_parameters, context=context, feedback=feedback, is_child_algorithm=True)
+
+
+        feedback.pushInfo('''
+
+        ---------Merging the tiles: keeping each DB in the tile holding its centre and resolving overlaps on the borders -------------------
+
+        ''')
+
+        merged = None
+        bunds = []
+        for tile, tile_parameters in runs:
+            result = QgsVectorLayer(tile_parameters['PotentialDB'], tile.name, 'ogr')
+            if not result.isValid():
+                continue
+            if merged is None:
+                merged = QgsVectorLayer('LineString?crs={}'.format(result.crs().authid()), 'merged', 'memory')
+                merged.dataProvider().addAttributes([field for field in result.fields() if field.name() != 'fid'])
+                merged.updateFields()
+            features = list(result.getFeatures())
+            centres = [feature.geometry().vertexAt(1) for feature in features]
+            inside = tiles.owned([p.x() for p in centres], [p.y() for p in centres], tile, extent)
+            for feature, kept in zip(features, inside):
+                if not kept:
+                    continue
+                out_feature = QgsFeature(merged.fields())
+                out_feature.setGeometry(feature.geometry())
+                for field in merged.fields():
+                    out_feature[field.name()] = feature[field.name()]
+                out_feature['DB_ID'] = len(bunds) + 1
+                bunds.append(out_feature)
+
+        if merged is None:
+            raise QgsProcessingException('No tile produced detainment bunds')
+        merged.dataProvider().addFeatures(bunds)
+        merged.updateExtents()
+
+        #Among overlapping DBs of neighbouring tiles, keeping the ones with the largest contributing area
+
+        features = list(merged.getFeatures())
+        ends = [list(feature.geometry().vertices()) for feature in features]
+        keep = selection.suppress_overlaps([v[0].x() for v in ends], [v[0].y() for v in ends],
+                                           [v[-1].x() for v in ends], [v[-1].y() for v in ends],
+                                           [feature['Contr_area'] for feature in features])
+        merged.dataProvider().deleteFeatures([feature.id() for feature, kept in zip(features, keep) if not kept])
+
+        outputs.stage(out_db, merged, 'merged')
+        outputs.write()
+
+        return {'PotentialDB': out_db}
@@ -1,3 +1,5 @@
+import os
+import sys
 import processing
 from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsProcessing,
@@ -13,7 +15,6 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterField,
                        QgsProcessingParameterNumber,
                        QgsProcessingContext,
-                       QgsProcessingUtils,
                        QgsVectorLayer,
                        QgsField,
                        QgsFields,
@@ -30,8 +31,12 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterBoolean,
                        QgsProcessingParameterVectorDestination)
 from datetime import datetime
-from qgis.utils import iface
 import math
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import algebra, artifacts, blocks, candidates, profiling, sample, selection, stations, transects
+from dbsim.outputs import Outputs
 
 
 class DBs(QgsProcessingAlgorithm):
@@ -60,6 +65,8 @@ class DBs(QgsProcessingAlgorithm):
         return self.tr('''This algorithm identifies potential places for detainment bunds (also known as WASCOBs).
         
         Outputs include a line vector where potential detainment bunds could be built and a points vector where DBs were initially assessed to be placed.
+
+        The time, memory and features of every step are shown in the log and saved next to the bunds output (name ending in _profile.json).
     
     
     Please be patient, since this proces might take some time and computer resources.
@@ -92,9 +99,19 @@ class DBs(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber('Z', 'Z factor', QgsProcessingParameterNumber.Double, defaultValue=1))
         self.addParameter(QgsProcessingParameterVectorDestination('PotentialDB', 'Potential DB'))
         self.addParameter(QgsProcessingParameterVectorDestination('OutPoints','All DB simulated points', optional=True, createByDefault=False))
+        self.addParameter(QgsProcessingParameterNumber('Workers', 'Parallel processes evaluating the reaches (0 or 1 runs in the QGIS process)', QgsProcessingParameterNumber.Integer, defaultValue=0, minValue=0))
+        self.addParameter(QgsProcessingParameterBoolean('Debug', 'Write intermediate layers to the temporary folder (debug)', defaultValue=False))
 
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         
         
         fb=self.parameterAsVectorLayer(parameters, 'FB', context)
@@ -111,6 +128,13 @@ class DBs(QgsProcessingAlgorithm):
         points = self.parameterAsOutputLayer(parameters, 'OutPoints', context)
         visualize_preprocess = self.parameterAsBool(parameters,'Checkbox', context)
         tooincised=self.parameterAsBool(parameters,'Checkbox2', context)
+        workers = self.parameterAsInt(parameters, 'Workers', context)
+        debug = self.parameterAsBool(parameters, 'Debug', context)
+        
+        outputs = Outputs(feedback, debug)
+
+        #Wall and CPU time, memory, features and bytes written of every stage, pushed below and saved next to the output
+        profiler = profiling.Profiler(feedback, self.name())
 
         
         ###CREATING STREAMS >=2 HA AND <=50 HA
@@ -119,50 +143,27 @@ class DBs(QgsProcessingAlgorithm):
         ---------Extracting streams >=2 ha and <= 50 ha, formatting and clipping -------------------
         
         ''')
-        #Conversion from squared metres to hectares
+        #Conversion from squared metres to hectares, selecting stream >= 2 hectares and <= 50 hectares
+        #and converting to 'CELL' format (integer, 0 as null) to be handled by GRASS, in one pass
         
         pixels=flowacc.rasterUnitsPerPixelX()
-        expression = f'(({flowacc.name()}@1*{pixels})/10000)'
+        flowacc_ha = algebra.Raster(flowacc) * pixels / 10000
+        drainage_network = (flowacc_ha >= 2) & (flowacc_ha <= 50)
 
-        flowacc_ha= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': flowacc,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-        
-        
-        
-        #Selecting stream >= 2 hectares and <= 50 hectares, vectorising and clipping to wsh boundary
-        
-        expression = f'((({flowacc_ha}@1>=2)AND({flowacc_ha}@1<=50))*1)'
-        
-        drainage_network= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': flowacc_ha,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-        
-        
-        #Converting to 'CELL' format to be handled by GRASS
-        
-        expression = f'(if(A>0, 1, null()))'
-        
-        to_cell = processing.run(
-            "grass7:r.mapcalc.simple",{
-            'a': drainage_network,
-            'expression': expression,
-            'output': 'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['output']
+        #Derived rasters and vectors are reused from an earlier run with the same inputs
+        to_cell = profiler.run('streams 2-50 ha', artifacts.call, algebra.run_calculate, {'EXPRESSION': algebra.where(drainage_network, 1, 0), 'OUTPUT': 'TEMPORARY_OUTPUT',
+                                  'DTYPE': 'int32', 'NODATA': 0}, feedback=feedback)['OUTPUT']
 
         #Filtering out zeros
         
-        thinned = processing.run(
+        thinned = profiler.run('r.thin', artifacts.run, processing.run,
             "grass7:r.thin",{
             'input': to_cell,
             'output': 'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['output']
         
         #Converting to vector
         
-        vector = processing.run(
+        vector = profiler.run('r.to.vect', artifacts.run, processing.run,
             "grass7:r.to.vect",{
             'input': thinned,
             'type': 0,
@@ -171,7 +172,7 @@ class DBs(QgsProcessingAlgorithm):
         
         #Clip network by catchment boundary 
         
-        clipped= processing.run(
+        clipped= profiler.run('clip to catchment', processing.run,
             "native:clip",{
             'INPUT': vector,
             'OVERLAY': catchment,
@@ -180,7 +181,7 @@ class DBs(QgsProcessingAlgorithm):
         
         #Create shp with only isAG>=1
         
-        isAG1= processing.run(
+        isAG1= profiler.run('agricultural fields', processing.run,
             "native:extractbyattribute",{
             'INPUT': fb,
             'FIELD': "isAG",
@@ -190,7 +191,7 @@ class DBs(QgsProcessingAlgorithm):
         
         #Clip network by isAG
         
-        clipped2= processing.run(
+        clipped2= profiler.run('clip to fields', processing.run,
             "native:clip",{
             'INPUT': clipped,
             'OVERLAY': isAG1,
@@ -204,24 +205,24 @@ class DBs(QgsProcessingAlgorithm):
         if visualize_preprocess is True: 
         
                     
-            difference= processing.run(
+            difference= profiler.run('difference with flow pathways', processing.run,
                 "native:difference",{
                 'INPUT': clipped2,
                 'OVERLAY': flow_network,
                 'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
             
-            intersection= processing.run(
+            intersection= profiler.run('intersection with flow pathways', processing.run,
                 "native:multiintersection",{
                 'INPUT': flow_network,
                 'OVERLAYS': clipped2,
                 'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
             
-            merged = processing.run("native:mergevectorlayers", {
+            merged = profiler.run('merge', processing.run, "native:mergevectorlayers", {
                 'LAYERS': [difference, intersection], 
                 'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
             
             
-            dissolved2= processing.run(
+            dissolved2= profiler.run('dissolve flow lines', processing.run,
                 "native:dissolve",{
                 'INPUT': merged,
                 'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
@@ -230,14 +231,14 @@ class DBs(QgsProcessingAlgorithm):
           ###Work here: will do a conditional if flow lines came from a different tool than this set, or the same
             
         else: 
-            extracted=processing.run(       ###WE USE THIS FOR WHEN THE FLOW LINES ARE DIFFERENT
+            extracted=profiler.run('extract flow pathways', processing.run,        ###WE USE THIS FOR WHEN THE FLOW LINES ARE DIFFERENT
                 "native:extractwithindistance",{
                 'INPUT': flow_network,
                 'REFERENCE': clipped2,
                 'DISTANCE':2,
                 'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
                  
-            dissolved2= processing.run(
+            dissolved2= profiler.run('dissolve flow lines', processing.run,
                 "native:dissolve",{
                 'INPUT': extracted,
                 'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']       
@@ -247,7 +248,7 @@ class DBs(QgsProcessingAlgorithm):
         
 
             
-        split2= processing.run(
+        split2= profiler.run('split at junctions', processing.run,
             "native:splitwithlines",{
             'INPUT': dissolved2,
             'LINES': dissolved2,
@@ -257,33 +258,17 @@ class DBs(QgsProcessingAlgorithm):
         '''Now we calculate the direction of each line'''
 
   
-        ID_field=processing.run("native:fieldcalculator", {
+        ID_field=profiler.run('reach IDs', processing.run, "native:fieldcalculator", {
             'INPUT':split2, 
             'FIELD_NAME': "LINKNO",
             'FIELD_TYPE': 1, 
             'FORMULA':"@id",
             'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
         
-        temp_out_path = QgsProcessingUtils.generateTempFilename("temp_out.shp")       
-        
-        dir = QgsProcessingUtils.generateTempFilename('dir.shp')
-        
-        Direction_CompassA=processing.run("native:fieldcalculator", {
-            'INPUT':ID_field, 
-            'FIELD_NAME': "Azimuth",
-            'FORMULA':"azimuth(start_point($geometry), end_point($geometry)) * (180/pi())", #* (180/pi()) is to convert from radians to degrees
-            'OUTPUT': dir}, context=context, feedback=feedback)['OUTPUT']
-
-
-        diss = QgsProcessingUtils.generateTempFilename('diss.shp')
-        
-        dissolved4_path= processing.run(
+        dissolved4 = profiler.run('dissolve reaches', processing.run,
             "native:dissolve",{
-            'INPUT': Direction_CompassA,
-            'OUTPUT':diss},context=context,feedback=feedback)['OUTPUT']
-
-
-        dissolved4 = QgsVectorLayer(dissolved4_path, "Dissolved Layer", "ogr")
+            'INPUT': ID_field,
+            'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
 
 
         feedback.pushInfo(f'--------- Creating points every {spacing} m apart in ephemeral/intermittent streams -----------------------------')
@@ -291,63 +276,43 @@ class DBs(QgsProcessingAlgorithm):
         ###THIS FUCTION CALCULATES DISTANCE BETWEEN TWO LINE FEATURE'S VERTEX AND CREATES POINTS SPACED AT PREDEFINED DISTANCE
 
 
-        # Create a memory layer for output points
-        out_layer = QgsVectorLayer('Point?crs={}'.format(flow_network.crs().authid()), 'output_points', 'memory')
-        pr = out_layer.dataProvider()
-
-        statn_pts_spacing = spacing
+        profiler.start('stations', dissolved4)
 
+        # Stations of all flow lines at once, keeping chainage, part, the smoothed local tangent (azimuth) and the
+        # bearings of both halves of the transect as attributes
+        parts = []
         for feature in dissolved4.getFeatures():
             geom = feature.geometry()
             if geom.isMultipart():
-                parts = geom.asMultiPolyline()
+                polylines = geom.asMultiPolyline()
             else:
-                parts = [geom.asPolyline()]
-
-            for part in parts:
-                if len(part) == 0:
-                    continue
-
-                # Add a point at the start of the feature
-                prev_point = part[0]
-                out_feature = QgsFeature()
-                out_feature.setGeometry(QgsGeometry.fromPointXY(prev_point))
-                pr.addFeatures([out_feature])
-                
-                distance_accumulated = 0.0
-
-                for i in range(1, len(part)):
-                    current_point = part[i]
-                    segment_length = current_point.distance(prev_point)
-                    distance_accumulated += segment_length
-
-                    while distance_accumulated >= statn_pts_spacing:
-                        ratio = (statn_pts_spacing - (distance_accumulated - segment_length)) / segment_length
-                        new_x = prev_point.x() + ratio * (current_point.x() - prev_point.x())
-                        new_y = prev_point.y() + ratio * (current_point.y() - prev_point.y())
-                        new_point = QgsPointXY(new_x, new_y)
-                        
-                        out_feature = QgsFeature()
-                        out_feature.setGeometry(QgsGeometry.fromPointXY(new_point))
-                        pr.addFeatures([out_feature])
-
-                        distance_accumulated -= statn_pts_spacing
-                        prev_point = QgsPoint(new_x, new_y)
-
-                    prev_point = current_point
-
-        # Update fields in the out_layer
+                polylines = [geom.asPolyline()]
+            parts.extend([(point.x(), point.y()) for point in part] for part in polylines)
+
+        statn_pts = stations.stations(parts, spacing)
+
+        # Create a memory layer for output points
+        out_layer = QgsVectorLayer('Point?crs={}'.format(flow_network.crs().authid()), 'output_points', 'memory')
+        pr = out_layer.dataProvider()
+        pr.addAttributes([QgsField('Chainage', QVariant.Double),
+                          QgsField('Part', QVariant.Int),
+                          QgsField('Tangent', QVariant.Double),
+                          QgsField('L_perp', QVariant.Double),
+                          QgsField('R_perp', QVariant.Double)])
         out_layer.updateFields()
 
-        # Save the memory layer to the specified output
-        temp_path = points + "_temp.shp"
-        transform_context = QgsProject.instance().transformContext()
-        save_options = QgsVectorFileWriter.SaveVectorOptions()
-        save_options.driverName = "ESRI Shapefile"
-        save_options.fileEncoding = "UTF-8"
+        out_features = []
+        for x, y, chainage, part, tangent, l_perp, r_perp in zip(*statn_pts, statn_pts.l_perp, statn_pts.r_perp):
+            out_feature = QgsFeature(out_layer.fields())
+            out_feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+            out_feature.setAttributes([float(chainage), int(part), float(tangent), float(l_perp), float(r_perp)])
+            out_features.append(out_feature)
+        pr.addFeatures(out_features)
+        out_layer.updateExtents()
 
-        # If exporting only points, replace the temp shp for "points"
-        QgsVectorFileWriter.writeAsVectorFormatV3(out_layer, temp_path, transform_context, save_options)
+        # Intermediate layers are kept in memory; outputs are written once at the end of the run
+        outputs.stage(points, out_layer, 'stations')
+        profiler.finish(out_layer)
         
             
             
@@ -358,8 +323,8 @@ class DBs(QgsProcessingAlgorithm):
         DB_height= height/z_factor
         
         
-        ID = processing.run("native:fieldcalculator", { 
-            'INPUT': temp_path,
+        ID = profiler.run('point IDs', processing.run, "native:fieldcalculator", { 
+            'INPUT': out_layer,
             'FIELD_NAME': "DB_ID",
             'FIELD_TYPE': 1, 
             'FORMULA': "@id",
@@ -369,8 +334,8 @@ class DBs(QgsProcessingAlgorithm):
         
         #Streams to raster
         
-        rasterised_streams=processing.run('gdal:rasterize',{
-            'INPUT': Direction_CompassA,
+        rasterised_streams=profiler.run('rasterize reaches', artifacts.run, processing.run, 'gdal:rasterize',{
+            'INPUT': ID_field,
             'FIELD': 'LINKNO',
             'UNITS': 1,
             'WIDTH': 1.0,
@@ -379,416 +344,112 @@ class DBs(QgsProcessingAlgorithm):
             'EXTENT': flow_network,
             'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
             
-            #QGIS cannot do zonal statistics with point or line features, so we have to convert to polygon using buffer
+        #Sampling contributing area (ha), elevation and reach ID at every point, and evaluating the points reach by reach
+        #(drop filter and transects), in several processes when "Workers" is above 1
         
-        buffered_points = processing.run("native:buffer", {
-            'INPUT': ID,
-            'DISTANCE': 0.5,
-            'SEGMENTS': 1,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback) ['OUTPUT']
-                
-        mean_CA = processing.run("native:zonalstatisticsfb", {
-            'INPUT': buffered_points,
-            'INPUT_RASTER': flowacc_ha,
-            'RASTER_BAND': 1,
-            'COLUMN_PREFIX': "_",
-            'STATISTICS': 2,
-            'OUTPUT': 'TEMPORARY_OUTPUT'  
-            }, context=context, feedback=feedback)['OUTPUT']
+        profiler.start('sample reaches', ID, rasterised_streams)
+        features = list(ID.getFeatures())
+        x = [feature.geometry().asPoint().x() for feature in features]
+        y = [feature.geometry().asPoint().y() for feature in features]
+        angle = [feature['L_perp'] for feature in features]
+        reach = sample.sample_raster(rasterised_streams, x, y)
         
-        mean_elev = processing.run("native:zonalstatisticsfb", {
-            'INPUT': mean_CA,
-            'INPUT_RASTER': dem,
-            'RASTER_BAND': 1,
-            'COLUMN_PREFIX': "_1",
-            'STATISTICS': 2,
-            'OUTPUT': 'TEMPORARY_OUTPUT' 
-            }, context=context, feedback=feedback)['OUTPUT']
-            
-        mean_reach = processing.run("native:zonalstatisticsfb", {
-            'INPUT': mean_elev,
-            'INPUT_RASTER': rasterised_streams,
-            'RASTER_BAND': 1,
-            'COLUMN_PREFIX': "_2",
-            'STATISTICS': 2,
-            'OUTPUT': 'TEMPORARY_OUTPUT' 
-            }, context=context, feedback=feedback)['OUTPUT']        
-        
-
-
-        joined=processing.run("native:joinattributestable", { 
-            'INPUT': ID,
-            'FIELD': 'DB_ID',
-            'INPUT_2': mean_reach,
-            'FIELD_2': 'DB_ID',
-            'FIELDS_TO_COPY': ['_mean', '_1mean','_2mean'],
-            'METHOD': 1,
-            'DISCARD_NONMATCHING': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-        
-        
-        expression = f'( ("_2mean" IS NOT NULL) AND  ("_mean" >2) AND ("_mean" <50) AND ("_mean" IS NOT NULL))'
-        
-        selected=processing.run("native:extractbyexpression", {
-            'INPUT': joined,
-            'EXPRESSION': expression,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-        
-        reach_added = processing.run("native:fieldcalculator", {
-            'INPUT': selected,
-            'FIELD_NAME': "Reach",
-            'FIELD_TYPE': 1, 
-            'FORMULA': "_2mean",
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']        
-        
-
-        
-
-        ###RENAME
-      
-        # Open editing session
-        reach_added.startEditing()
-
-        # Rename field
-        idx = reach_added.fields().indexFromName('_mean')
-        if idx != -1:
-            reach_added.renameAttribute(idx, 'Contr_area')
-        
-        # Rename field
-        idx = reach_added.fields().indexFromName('_1mean')
-        if idx != -1:
-            reach_added.renameAttribute(idx, 'Elevation')
-
-        #Delete _2mean field
-        idx = reach_added.fields().indexFromName('_2mean')
-        if idx != -1:
-            reach_added.deleteAttribute(idx)
-            
-            
-        # Close editing session and save changes
-        reach_added.commitChanges()
-
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(reach_added, points, 'utf-8', selected.crs(), 'ESRI Shapefile')
-        
-        
-        
-        
-        #Sort by catchment area
-        
-        sorted=processing.run("native:orderbyexpression", {   ###Leave this as temporary output, points export anyways if return:sorted
-            'INPUT': reach_added,
-            'EXPRESSION': "Contr_area",
-            'ASCENDING' : True,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']        
-        
-        
-        
-        #Creating reach ID field and append each unique "LINKNO" to ReachList as a string
-        
-        ReachList = []
-        for feature in sorted.getFeatures():
-            reach_id = feature['Reach']
-            if reach_id not in ReachList:
-                ReachList.append(reach_id)
-                
-        
-        # # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(sorted, points, 'utf-8', selected.crs(), 'ESRI Shapefile')        
-        
-        
-        # Delete points where elevation drop is insufficient
         feedback.pushInfo('''
         
         ----------- Deleting points with an elevation drop between itself and the next upstream point less than the DB impoundment height -------------------
         
         ''')
-
-        for Reach in ReachList:
-            UpElev = float('inf')
-            
-            sorted.startEditing()
-            for feature in sorted.getFeatures():
-                if feature['Reach'] != Reach:
-                    continue
-                CurrentElev = feature['Elevation'] + height
-                if CurrentElev < UpElev:
-                    UpElev = feature['Elevation']
-                else:
-                    sorted.deleteFeature(feature.id())
-            sorted.commitChanges()
-
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(sorted, points, 'utf-8', selected.crs(), 'ESRI Shapefile')
         
+        profiler.start('evaluate candidates', flowacc, dem)
+        evaluated = candidates.evaluate(flowacc, dem, x, y, angle, reach, [height], [length / 2], pixels / 10000,
+                                        workers=workers, feedback=feedback)
         
-        #Add and populate "Height" field
-        
-        
-        height_field = processing.run("native:fieldcalculator", {
-            'INPUT': sorted,
-            'FIELD_NAME': "Height (m)",
-            'FIELD_TYPE': 1, 
-            'FORMULA': f'{height}',
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']        
-        
-        
-        Compass_A_points=processing.run("native:joinattributestable", {
-            'INPUT': height_field,
-            'FIELD': 'Reach',
-            'INPUT_2': Direction_CompassA,
-            'FIELD_2': 'LINKNO',
-            'FIELDS_TO_COPY': ['Azimuth'],
-            'METHOD': 0,
-            'DISCARD_NONMATCHING': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']        
-        
-        
-        L_perp = processing.run("native:fieldcalculator", {
-            'INPUT': Compass_A_points,
-            'FIELD_NAME': "L_perp",
-            'FIELD_TYPE': 0, 
-            'FORMULA': "((360-Azimuth))",
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-        
-        R_perp = processing.run("native:fieldcalculator", {
-            'INPUT': L_perp,
-            'FIELD_NAME': "R_perp",
-            'FIELD_TYPE': 0, 
-            'FORMULA': "(360-Azimuth)+180",
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-        
-        
-      # Create output layers for left and right lines
-        loffset_layer = QgsVectorLayer('LineString?crs=', 'loffset', 'memory')
-        roffset_layer = QgsVectorLayer('LineString?crs=', 'roffset', 'memory')
-        loffset_provider = loffset_layer.dataProvider()
-        roffset_provider = roffset_layer.dataProvider()
-        
-        loffset_provider.addAttributes([QgsField("DB_ID", QVariant.Int)])
-        roffset_provider.addAttributes([QgsField("DB_ID", QVariant.Int)])
-        loffset_layer.updateFields()
-        roffset_layer.updateFields()
+        profiler.start('sorted points', ID)
 
-        # Create lines based on the angles
-        def create_perpendicular_line(point, distance, angle):
-            angle_rad = math.radians(angle)
-            dx = distance * math.cos(angle_rad)
-            dy = distance * math.sin(angle_rad)
-            end_point = QgsPointXY(point.x() + dx, point.y() + dy)
-            return QgsGeometry.fromPolylineXY([point, end_point])
-
-
-        for feature in R_perp.getFeatures():
-            geom = feature.geometry()
-            point = geom.asPoint()
-            l_angle = feature['L_perp']
-            r_angle = feature['R_perp']
-            
-            # Left line
-            l_line = create_perpendicular_line(point, (length / 2), l_angle)
-            l_feature = QgsFeature()
-            l_feature.setGeometry(l_line)
-            l_feature.setAttributes([feature['DB_ID']])
-            loffset_provider.addFeature(l_feature)
-
-            # Right line
-            r_line = create_perpendicular_line(point, (length / 2), r_angle)
-            r_feature = QgsFeature()
-            r_feature.setGeometry(r_line)
-            r_feature.setAttributes([feature['DB_ID']])
-            roffset_provider.addFeature(r_feature)
-
-        loffset_layer.updateExtents()
-        roffset_layer.updateExtents()
-
-
-        buffered_left = processing.run("native:buffer", {
-            'INPUT': loffset_layer,
-            'DISTANCE': 0.7,
-            'SEGMENTS': 1,
-            'END_CAP_STYLE': 2,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback) ['OUTPUT']
-
-        buffered_right = processing.run("native:buffer", {
-            'INPUT': roffset_layer,
-            'DISTANCE': 0.7,
-            'SEGMENTS': 1,
-            'END_CAP_STYLE': 2,            
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback) ['OUTPUT']
-
-
-        range_left = processing.run("native:zonalstatisticsfb", {
-            'INPUT': buffered_left,
-            'INPUT_RASTER': dem,
-            'BAND': 1,
-            'COLUMN_PREFIX': "left_",
-            'STATISTICS': 7,
-            'OUTPUT': 'TEMPORARY_OUTPUT'  
-            }, context=context, feedback=feedback)['OUTPUT']
+        # Points sorted by catchment area
+        sorted = QgsVectorLayer('Point?crs={}'.format(ID.crs().authid()), 'sampled_points', 'memory')
+        pr = sorted.dataProvider()
+        pr.addAttributes(ID.fields().toList() + [QgsField('Contr_area', QVariant.Double),
+                                                 QgsField('Elevation', QVariant.Double),
+                                                 QgsField('Reach', QVariant.Int)])
+        sorted.updateFields()
         
-        range_right = processing.run("native:zonalstatisticsfb", {
-            'INPUT': buffered_right,
-            'INPUT_RASTER': dem,
-            'BAND': 1,
-            'COLUMN_PREFIX': "right_",
-            'STATISTICS': 7,
-            'OUTPUT': 'TEMPORARY_OUTPUT'  
-            }, context=context, feedback=feedback)['OUTPUT']
-            
-        # Merge the left and right lines
-        merged = processing.run("native:mergevectorlayers", {
-            'LAYERS': [loffset_layer, roffset_layer], 
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-        
-        dissolved= processing.run(
-            "native:dissolve",{
-            'INPUT': merged,
-            'FIELD': 'DB_ID',
-            'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
-            
-            
-        joined=processing.run("native:joinattributestable", {
-            'INPUT': dissolved,
-            'FIELD': 'DB_ID',
-            'INPUT_2': Compass_A_points,
-            'FIELD_2': 'DB_ID',
-            'FIELDS_TO_COPY': ['Contr_area', 'Elevation','Height (m)'],
-            'METHOD': 1,
-            'DISCARD_NONMATCHING': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']        
-        
-        
-        joined_range_l=processing.run("native:joinattributestable", {
-            'INPUT': joined,
-            'FIELD': 'DB_ID',
-            'INPUT_2': range_left,
-            'FIELD_2': 'DB_ID',
-            'FIELDS_TO_COPY': ['left_range'],
-            'METHOD': 1,
-            'DISCARD_NONMATCHING': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']                
-        
-        
-        joined2=processing.run("native:joinattributestable", {
-            'INPUT': joined_range_l,
-            'FIELD': 'DB_ID',
-            'INPUT_2': range_right,
-            'FIELD_2': 'DB_ID',
-            'FIELDS_TO_COPY': ['right_range'],
-            'METHOD': 1,
-            'DISCARD_NONMATCHING': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']                
-        
-        expression = f'"left_range" > "Height (m)" AND "right_range" > "Height (m)"'
-
-
-
-            ###Change done here compared to the original script in Scripts
-
+        sampled = []
+        for i in np.argsort(evaluated.contr_area, kind='stable'):
+            if not (evaluated.candidate[i] and evaluated.keep[0, i]):
+                continue
+            z = evaluated.elevation[i]
+            out_feature = QgsFeature(sorted.fields())
+            out_feature.setGeometry(features[i].geometry())
+            out_feature.setAttributes(features[i].attributes() + [float(evaluated.contr_area[i]), None if math.isnan(z) else float(z), int(reach[i])])
+            sampled.append(out_feature)
+        pr.addFeatures(sampled)
+        sorted.updateExtents()
 
-        # Select features that match the expression
-        selected0 = processing.run("native:extractbyexpression", {
-            'INPUT': joined2,
-            'EXPRESSION': expression,
-            'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
+        # Current state of the output, written once at the end
+        outputs.stage(points, sorted, 'sorted')
+        profiler.finish(sorted)
         
-        selected1= processing.run(
-            "native:fixgeometries",{
-            'INPUT': selected0,
-            'OUTPUT':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['OUTPUT']
         
+        #Building the DB lines whose banks are higher than the DB (and, if asked, lower than twice its height)
+        
+        profiler.start('transects')
         if tooincised is True:
             
             feedback.pushInfo('''
             ----------- Deleting DBs with banks more than double the height of the DB embankment --------
             ''')
-            expression = f'"left_range" < ("Height (m)"*2) AND "right_range" < ("Height (m)"*2)'
-
-            # Select features that match the expression
-            selected2 = processing.run("native:extractbyexpression", {
-                'INPUT': selected1,
-                'EXPRESSION': expression,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-        else:
-            selected2 = selected1
-
-        # Save the final layer
-        QgsVectorFileWriter.writeAsVectorFormat(selected2, out_db, 'utf-8', selected2.crs(), 'ESRI Shapefile')
-        
-        #Ensure selected2 is a QgsVectorLayer
-        if not isinstance(selected2, QgsVectorLayer):
-            raise Exception("The output of extractbyexpression is not a QgsVectorLayer.")
-
-        # Create a spatial index for the selected layer
-        index = QgsSpatialIndex(selected2.getFeatures())
-
-        # To track processed features
-        processed_features = set()
-
-        # Start an edit session
-        selected2.startEditing()
-
-        # Loop through each feature in the layer
-        for feature in selected2.getFeatures():
-            DB_ID = feature['DB_ID']
-
-            # If the feature has been processed, skip it
-            if DB_ID in processed_features:
-                continue
-
-            # Find intersecting features using the spatial index
-            intersecting_ids = index.intersects(feature.geometry().boundingBox())
-            intersecting_features = [f for f in selected2.getFeatures(QgsFeatureRequest().setFilterFids(intersecting_ids)) if f.geometry().intersects(feature.geometry())]
-
-            # If more than one intersecting feature, process them
-            while len(intersecting_features) > 1:
-                # Find the feature with the smallest contributing area
-                smallest_feature = min(intersecting_features, key=lambda f: f['Contr_area'])
-                
-                # Delete the feature with the smallest contributing area
-                selected2.deleteFeature(smallest_feature.id())
-                
-                # Update the processed feature list
-                processed_features.add(smallest_feature['DB_ID'])
-
-                # Rebuild the list of intersecting features
-                intersecting_ids = index.intersects(feature.geometry().boundingBox())
-                intersecting_features = [f for f in selected2.getFeatures(QgsFeatureRequest().setFilterFids(intersecting_ids)) if f.geometry().intersects(feature.geometry())]
-
-        # Commit changes
-        selected2.commitChanges()
-
-        
-        temp = QgsProcessingUtils.generateTempFilename('temp.shp')
-        
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(selected2, out_db, 'utf-8', flow_network.crs(), 'ESRI Shapefile')
-
-        
-        FB_lines=processing.run("native:polygonstolines", {
+        _, _, p_index = selection.scenario_matrix(evaluated.keep, evaluated.left_range, evaluated.right_range, [height], tooincised)
+        xl, yl, xr, yr = transects.line_ends(x, y, angle, length / 2)
+
+        selected2 = QgsVectorLayer('LineString?crs={}'.format(ID.crs().authid()), 'transects', 'memory')
+        pr = selected2.dataProvider()
+        pr.addAttributes([QgsField('DB_ID', QVariant.Int),
+                          QgsField('Contr_area', QVariant.Double),
+                          QgsField('Elevation', QVariant.Double),
+                          QgsField('Height (m)', QVariant.Int),
+                          QgsField('left_range', QVariant.Double),
+                          QgsField('right_range', QVariant.Double)])
+        selected2.updateFields()
+
+        lines = []
+        for i in p_index:
+            feature = features[i]
+            line = QgsFeature(selected2.fields())
+            line.setGeometry(QgsGeometry.fromPolylineXY([QgsPointXY(xl[i], yl[i]), feature.geometry().asPoint(), QgsPointXY(xr[i], yr[i])]))
+            line.setAttributes([feature['DB_ID'], float(evaluated.contr_area[i]), float(evaluated.elevation[i]), height,
+                                float(evaluated.left_range[0, i]), float(evaluated.right_range[0, i])])
+            lines.append(line)
+        pr.addFeatures(lines)
+        selected2.updateExtents()
+
+        # Current state of the output, written once at the end
+        outputs.stage(out_db, selected2, 'selected2')
+        profiler.finish(selected2)
+        
+        #Among overlapping DBs, keeping the ones with the largest contributing area (greedy non-maximum suppression)
+
+        profiler.start('overlap suppression', selected2)
+        features = list(selected2.getFeatures())
+        ends = [list(feature.geometry().vertices()) for feature in features]
+        keep = selection.suppress_overlaps([v[0].x() for v in ends], [v[0].y() for v in ends],
+                                           [v[-1].x() for v in ends], [v[-1].y() for v in ends],
+                                           [feature['Contr_area'] for feature in features])
+        selected2.dataProvider().deleteFeatures([feature.id() for feature, kept in zip(features, keep) if not kept])
+        profiler.finish(selected2)
+
+        
+        # Current state of the output, written once at the end
+        outputs.stage(out_db, selected2, 'selected2')
+
+        
+        FB_lines=profiler.run('field boundaries', processing.run, "native:polygonstolines", {
             'INPUT': isAG1,
             'OUTPUT': 'TEMPORARY_OUTPUT'
         }, context=context, feedback=feedback)['OUTPUT']
 
 
-        select_within_distance=processing.run("native:selectwithindistance", {
+        select_within_distance=profiler.run('bunds near streams', processing.run, "native:selectwithindistance", {
             'INPUT': selected2,
             'REFERENCE': stream_reach,
             'DISTANCE': 25,
@@ -798,15 +459,17 @@ class DBs(QgsProcessingAlgorithm):
 
         
         # Remove selected features from line_layer_1
+        profiler.start('remove bunds near streams', select_within_distance)
         select_within_distance.startEditing()
         for feature in select_within_distance.getSelectedFeatures():
             select_within_distance.deleteFeature(feature.id())
         select_within_distance.commitChanges()
         
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(select_within_distance, out_db, 'utf-8', flow_network.crs(), 'ESRI Shapefile')
+        # Current state of the output, written once at the end
+        outputs.stage(out_db, select_within_distance, 'select_within_distance')
+        profiler.finish(select_within_distance)
         
-        select_intersect=processing.run("native:selectbylocation", {
+        select_intersect=profiler.run('bunds crossing fields', processing.run, "native:selectbylocation", {
             'INPUT': select_within_distance,
             'PREDICATE': [0],
             'INTERSECT': FB_lines,
@@ -814,25 +477,32 @@ class DBs(QgsProcessingAlgorithm):
             'OUTPUT':out_db
         }, context=context, feedback=feedback)['OUTPUT']        
 
+        profiler.start('remove bunds crossing fields', select_intersect)
         select_intersect.startEditing()
         for feature in select_intersect.getSelectedFeatures():
             select_intersect.deleteFeature(feature.id())
         select_intersect.commitChanges()
         
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(select_intersect, out_db, 'utf-8', flow_network.crs(), 'ESRI Shapefile')
+        # Current state of the output, written once at the end
+        outputs.stage(out_db, select_intersect, 'select_intersect')
+        profiler.finish(select_intersect)
         
         
         #Calculation of length
-        LengthDB=processing.run("native:fieldcalculator", {
+        LengthDB=profiler.run('bund length', processing.run, "native:fieldcalculator", {
             'INPUT':select_intersect, 
             'FIELD_NAME': "Length (m)",
             'FIELD_TYPE': 1, 
             'FORMULA':"length(@geometry)",
             'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
         
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(LengthDB, out_db, 'utf-8', flow_network.crs(), 'ESRI Shapefile')        
+        # Current state of the output, written once at the end
+        outputs.stage(out_db, LengthDB, 'LengthDB')
         
+        profiler.start('write outputs', LengthDB)
+        written = outputs.write()
+        profiler.finish(list(written))
+
+        profiler.write(profiling.report_path(out_db))
 
         return {'PotentialDB': LengthDB,'OutPoints': sorted}
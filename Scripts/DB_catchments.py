@@ -1,3 +1,5 @@
+import os
+import sys
 import processing
 from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsProcessing,
@@ -16,6 +18,7 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingContext,
                        QgsProcessingUtils,
                        QgsVectorLayer,
+                       QgsRasterLayer,
                        QgsField,
                        QgsFields,
                        QgsFeature,
@@ -28,11 +31,14 @@ from qgis.core import (QgsProcessing,
                        QgsVectorFileWriter,
                        QgsFeatureRequest,
                        QgsSpatialIndex,
+                       QgsProcessingParameterBoolean,
                        QgsProcessingParameterVectorDestination)
 from datetime import datetime
-from qgis.utils import iface
 import math
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import algebra, basins, blocks, fill, raster_io, storage
+
 
 class DBs(QgsProcessingAlgorithm):
 
@@ -72,8 +78,17 @@ class DBs(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber('Z', 'Z factor', QgsProcessingParameterNumber.Double, defaultValue=1))
         self.addParameter(QgsProcessingParameterVectorDestination('Catchments', 'Potential DB catchments'))
         self.addParameter(QgsProcessingParameterRasterDestination('Depth', 'Catchment depth raster', optional=True))
+        self.addParameter(QgsProcessingParameterBoolean('Polygonize', 'Polygonize the ponds (impounded footprint) for display', defaultValue=True))
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         
         
         locations=self.parameterAsVectorLayer(parameters, 'DB_locations', context)
@@ -83,6 +98,7 @@ class DBs(QgsProcessingAlgorithm):
         memory = self.parameterAsDouble(parameters, 'Memory', context)
         catchments = self.parameterAsOutputLayer(parameters, 'Catchments', context)
         depth = self.parameterAsOutputLayer(parameters, 'Depth', context)
+        polygonize = self.parameterAsBool(parameters, 'Polygonize', context)
         
 
         
@@ -94,10 +110,18 @@ class DBs(QgsProcessingAlgorithm):
         ''')
 
 
-        #Getting pour point coordinates of DBs
+        #Getting pour point cells of DBs, labelled by ID
 
-        buffer= processing.run("native:buffer", {
+        ID_field = processing.run("native:fieldcalculator", {
             'INPUT': locations,
+            'FIELD_NAME': "ID",
+            'FIELD_TYPE': 0, 
+            'FORMULA': f'@id+1', #was id+1
+            'OUTPUT': 'TEMPORARY_OUTPUT'
+            }, context=context, feedback=feedback)['OUTPUT']
+
+        buffer= processing.run("native:buffer", {
+            'INPUT': ID_field,
             'DISTANCE':1,
             'SEGMENTS': 1,
             'END_CAP_STYLE': 2,
@@ -105,38 +129,36 @@ class DBs(QgsProcessingAlgorithm):
             }, context=context, feedback=feedback)["OUTPUT"]
 
 
-        points= processing.run("qgis:generatepointspixelcentroidsinsidepolygons", {
-            'INPUT_RASTER': flowdir,
-            'INPUT_VECTOR':buffer,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
+        #Outlet cells on the flow direction grid
 
-
-        dissolve= processing.run("native:dissolve", {
-            'INPUT': points,
-            'FIELD':'poly_id',
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-
-
-        dissolved_sorted=processing.run("native:orderbyexpression", {   
-            'INPUT': dissolve,
-            'EXPRESSION': 'poly_id',
-            'ASCENDING': True,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-
-
-        temp_raster = QgsProcessingUtils.generateTempFilename('temp_raster.tif')
+        outlets=processing.run('gdal:rasterize',{
+            'INPUT': buffer,
+            'FIELD': 'ID',
+            'UNITS': 1,
+            'WIDTH': flowdir.rasterUnitsPerPixelX(),
+            'HEIGHT': flowdir.rasterUnitsPerPixelY(),
+            'NODATA': 0,
+            'DATA_TYPE': 4,
+            'EXTENT': flowdir.extent(),
+            'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
 
         #Finding watersheds of all detainment bund places
         
-        watersheds= processing.run(
-            "grass7:r.stream.basins",{
+        stream_basins= basins.run_stream_basins({
             'direction': flowdir,
-            'points': dissolved_sorted,
-            'memory': memory,
-            'basins':temp_raster},context=context,feedback=feedback)['basins']
+            'outlets': outlets,
+            'basins':'TEMPORARY_OUTPUT'},feedback=feedback)
+        watersheds = stream_basins['basins']
+
+        #Every raster step below only runs on the window holding the DB basins, on the grid of the DEM
+
+        full_dem = dem
+        window = stream_basins['window']
+        if window is not None:
+            feedback.pushInfo(f'Cropping the rasters to the {window[2]} x {window[3]} cells upstream of the DBs')
+            dem = QgsRasterLayer(raster_io.crop_raster(dem, window), dem.name())
+            flowdir = QgsRasterLayer(raster_io.crop_raster(flowdir, window), flowdir.name())
+            watersheds = raster_io.crop_raster(watersheds, window)
 
         
         feedback.pushInfo('''
@@ -165,16 +187,16 @@ class DBs(QgsProcessingAlgorithm):
             'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
 
 
-        #Rasterizing DBs based on height parameter
+        #Rasterizing DBs based on height parameter, on the DEM grid to be combined with it cell by cell
 
         rasterised_db_height=processing.run('gdal:rasterize',{
             'INPUT': buffer, #was locations
             'FIELD': 'Height (m)',
             'UNITS': 1,
-            'WIDTH': 1.0,
-            'HEIGHT': 1.0,
+            'WIDTH': dem.rasterUnitsPerPixelX(),
+            'HEIGHT': dem.rasterUnitsPerPixelY(),
             'NODATA': 0,
-            'EXTENT': buffer.extent(), #was dem
+            'EXTENT': dem.extent(),
             'EXTRA': f'-a_srs "{epsg_code}"',
             'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
         
@@ -195,154 +217,85 @@ class DBs(QgsProcessingAlgorithm):
             'output': 'TEMPORARY_OUTPUT' 
             }, context=context, feedback=feedback)['output']
             
-        min_DB_with_crs = processing.run('gdal:assignprojection', {
-            'INPUT': min_DB,
-            'CRS': dem.crs().toWkt(),
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-            
-        expression =f'\"{min_DB_with_crs}@1\" + \"{rasterised_db_height}@1\"'
-        
-        db_hgt= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': [rasterised_db_height, min_DB_with_crs],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
+        #Crest of the DBs (minimum elevation under the DB + height, no data cells read as zeros), burned
+        #into the DEM in one pass to create the New DEM, and filling DEM
+        db_hgt = algebra.Raster(min_DB).filled(0) + algebra.Raster(rasterised_db_height).filled(0)
         
-        #Filling db_hgt no data cells with zeros for processing, then creating New DEM with DBs burned, and filling DEM
-        fill_nodata= processing.run("native:fillnodata", {
-            'INPUT': db_hgt,
-            'BAND':1,
-            'FILL_VALUE': 0,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
+        NewDEM = algebra.calculate(algebra.where(algebra.Raster(rasterised_db_height).filled(0) > 0, db_hgt, algebra.Raster(dem)),
+                                   'TEMPORARY_OUTPUT', feedback=feedback)
 
-        expression = f'(({fill_nodata}@1>0)*{fill_nodata}@1+({fill_nodata}@1=0)*{dem.name()}@1)'
-        
-
-
-        NewDEM= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': [dem, fill_nodata],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-
-        FilledNewDEM = processing.run("saga:fillsinksxxlwangliu", { ##WILL HAVE TO USE WANGLIU ONLY. EXTRA VALUES ARE GENERATED WHEN MIXING XXL AND NOT XXL
+        #Only the basins behind the burned DBs are filled again, starting from the filled DEM
+        FilledNewDEM = fill.run_refill_local({
             'ELEV': NewDEM,
+            'FILLED_DEM': dem,
+            'DIRECTION': flowdir,
             'MINSLOPE':0.0,
             'FILLED': 'TEMPORARY_OUTPUT',
-            }, context=context, feedback=feedback)["FILLED"]
+            }, feedback=feedback)["FILLED"]
 
-        expression =f'\"{FilledNewDEM}@1\" - \"{dem.name()}@1\"'
+        #Depth of the ponds, with the negative values as zero, in one pass over the filled and original DEMs
+        FillReg = algebra.Raster(FilledNewDEM) - algebra.Raster(dem)
         
-        FillReg= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': [FilledNewDEM, dem],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]        
+        pond_depth = algebra.calculate(algebra.where(FillReg > 0, FillReg, 0), 'TEMPORARY_OUTPUT', nodata=0, feedback=feedback)
 
 
 
-        # Convert FillReg (which represents the volume of storage at every sink cell in the DEM) to volume in cubic metres        
-        expression = f'({FillReg}@1 * {z_factor})'
-        
-        FillRegMet = processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': [FillReg],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-        
-        pixels=dem.rasterUnitsPerPixelX()
-        
-        expression = f'({FillRegMet}@1 * {pixels} * {pixels})'
-        
-        FillRegCM = processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': [FillRegMet],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-
-        # Convert values of all sink cells to the WASCOBID of the watershed that it falls in
+        # Volume (m3), wet area and maximum depth of the pond of every DB, reduced per basin label straight from the
+        # depth raster (FillReg x z factor x cell area), without polygonizing the ponds. The DB cells themselves are
+        # embankment, not water, and are left out as in the stage-storage curves of catchment_exp2
+        pond_stats = storage.run_pond_statistics({
+            'DEPTH': pond_depth,
+            'BASINS': watersheds,
+            'BUNDS': rasterised_db_height,
+            'Z': z_factor,
+            'PONDS': 'TEMPORARY_OUTPUT' if polygonize else None
+            }, feedback=feedback)
+        statistics = pond_stats['STATISTICS']
 
-
-        expression = f'((A > 0) * B)' ##EXPRESSIONS IN GDAL NEEDS SPACES!
-        
-        Sinks_ID = processing.run("gdal:rastercalculator", {
-            'INPUT_A': FillRegCM,
-            'BAND_A': 1,
-            'INPUT_B':watersheds,
-            'BAND_B': 1,
-            'FORMULA': expression,
-            'NO_DATA': 0,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-
-        polygonised = processing.run('grass7:r.to.vect', {
-            'input': Sinks_ID,
-            'type': 2,
-            'column': 'value',
-            '-s': True,
-            'output': 'TEMPORARY_OUTPUT' 
-            }, context=context, feedback=feedback)['output']
-        
-        ID_field = processing.run("native:fieldcalculator", {
-            'INPUT': locations,
-            'FIELD_NAME': "ID",
-            'FIELD_TYPE': 0, 
-            'FORMULA': f'@id+1', #was id+1
-            'OUTPUT': 'TEMPORARY_OUTPUT'
+        if polygonize:
+            
+            # Only the impounded footprint is polygonized, for display
+            polygonised = processing.run("gdal:polygonize", {
+                'INPUT': pond_stats['PONDS'],
+                'BAND': 1,
+                'FIELD': 'value',
+                'EIGHT_CONNECTEDNESS': False,
+                'OUTPUT': 'TEMPORARY_OUTPUT'
             }, context=context, feedback=feedback)['OUTPUT']
-        
-        joined=processing.run("native:joinattributestable", {
-            'INPUT': polygonised,
-            'FIELD': 'value',
-            'INPUT_2': ID_field,
-            'FIELD_2': 'ID',
-            'FIELDS_TO_COPY': ['DB_ID', 'Contr_area', 'Height (m)'],
-            'METHOD': 1,
-            'DISCARD_NONMATCHING': False,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-
-        
-        fixed=processing.run("native:fixgeometries", {
-            'INPUT': joined,
-            'METHOD': 1,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-        
-        
-        dissolve=processing.run("native:dissolve", {
-            'INPUT': fixed,
-            'FIELD': 'DB_ID',
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-
-        
-        volume = processing.run("native:zonalstatisticsfb", {
-            'INPUT': dissolve,
-            'INPUT_RASTER': FillRegCM, ##FillRegCM
-            'RASTER_BAND': 1,
-            'STATISTICS': 1,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)['OUTPUT']
-        
-        
-        volume2=processing.run("native:fieldcalculator", {
-            'INPUT':volume, 
-            'FIELD_NAME': "Volume(m3)",
-            'FIELD_TYPE': 0,
-            'FORMULA':"_sum",
-            'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
-        
-
-        
-        area=processing.run("native:fieldcalculator", {
-            'INPUT':volume2, 
-            'FIELD_NAME': "Area (m2)",
-            'FIELD_TYPE': 0,
-            'FORMULA':"area(@geometry)",
-            'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
+            
+            footprint = processing.run("native:dissolve", {
+                'INPUT': polygonised,
+                'FIELD': 'value',
+                'OUTPUT': 'TEMPORARY_OUTPUT'
+            }, context=context, feedback=feedback)['OUTPUT']
+            
+            geometries = {int(feature['value']): feature.geometry() for feature in footprint.getFeatures() if feature['value']}
+            area = QgsVectorLayer('MultiPolygon?crs={}'.format(dem.crs().authid()), 'ponds', 'memory')
+        else:
+            geometries = None
+            area = QgsVectorLayer('LineString?crs={}'.format(ID_field.crs().authid()), 'ponds', 'memory')
+
+        pr = area.dataProvider()
+        pr.addAttributes([QgsField('DB_ID', QVariant.Int),
+                          QgsField('Contr_area', QVariant.Double),
+                          QgsField('Height (m)', QVariant.Int),
+                          QgsField('Volume(m3)', QVariant.Double),
+                          QgsField('Area (m2)', QVariant.Double),
+                          QgsField('Max depth', QVariant.Double)])
+        area.updateFields()
+
+        ponds = []
+        for feature in ID_field.getFeatures():
+            label = int(feature['ID'])
+            if geometries is not None and label not in geometries:
+                continue
+            pond = QgsFeature(area.fields())
+            pond.setGeometry(geometries[label] if geometries is not None else feature.geometry())
+            volume, wet_area, max_depth = statistics.row(label)
+            pond.setAttributes([feature['DB_ID'], feature['Contr_area'], feature['Height (m)'], volume, wet_area, max_depth])
+            ponds.append(pond)
+        pr.addFeatures(ponds)
+        area.updateExtents()
 
         smoothed=processing.run("native:smoothgeometry", { 
             'INPUT': area,
@@ -377,9 +330,6 @@ class DBs(QgsProcessingAlgorithm):
         # Close editing session and save changes
         smoothed.commitChanges() 
 
-        # Save the renamed layer to the final output
-        QgsVectorFileWriter.writeAsVectorFormat(smoothed, catchments, 'utf-8', smoothed.crs(), 'ESRI Shapefile')
-
         
         ratio=processing.run("native:fieldcalculator", {
             'INPUT':smoothed, 
@@ -397,15 +347,7 @@ class DBs(QgsProcessingAlgorithm):
         }, context=context, feedback=feedback)['OUTPUT']      
         
         
-        expression = f'((A > 0) * A)'
-            
-        nodata = processing.run("gdal:rastercalculator", {
-            'INPUT_A': FillReg,
-            'BAND_A': 1,
-            'FORMULA': expression,
-            'NO_DATA': 0,
-            'OUTPUT': depth
-        }, context=context, feedback=feedback)['OUTPUT']
+        #Depth written back on the whole DEM grid
+        nodata = raster_io.expand_raster(pond_depth, full_dem, depth, 0)
         
-
         return {'Catchments':sorted, 'Depth': nodata}
@@ -1,5 +1,6 @@
 import processing
 import os
+import sys
 import tempfile
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.analysis import QgsZonalStatistics
@@ -19,6 +20,9 @@ from qgis.core import (QgsProcessing,
                        QgsProject)
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import algebra, blocks
+
 
 
 
@@ -61,6 +65,14 @@ class ImpededFlow(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterRasterDestination('DepthGrid', 'Impeded flow'))
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         # Get parameter values
         dem = self.parameterAsRasterLayer(parameters, 'DEM', context)
         filled=self.parameterAsRasterLayer(parameters, 'FilledDEM', context)
@@ -86,27 +98,12 @@ class ImpededFlow(QgsProcessingAlgorithm):
             # }, context=context, feedback=feedback)["C"]
             
             
-            expression =f'\"{filled.name()}@1\" - \"{dem.name()}@1\"'
-            
-            
-            raster_difference = processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': [filled, dem],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-            
-            
-            #Declaring the expression to use in the raster calculator
-            expression = f'((\"{raster_difference}@1\" > 0) * \"{raster_difference}@1\")'
-            
+            raster_difference = algebra.Raster(filled) - algebra.Raster(dem)
             
             
-            #We use raster calculator for making all negative values as zero
-            output_noneg = processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': raster_difference,
-            'OUTPUT': output_depthgrid
-            }, context=context, feedback=feedback)["OUTPUT"]
+            #Making all negative values as zero, written in the same pass as the difference
+            output_noneg = algebra.calculate(algebra.where(raster_difference > 0, raster_difference, 0),
+                                             output_depthgrid, feedback=feedback)
             
             
             # #We use GDAL translate tool to eliminate all zero values and obtain only positive numbers
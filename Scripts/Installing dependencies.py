@@ -40,7 +40,7 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         return InstallDepProcessingAlgorithm()
     
     def shortHelpString(self):
-        return self.tr('''This algorithm installs addons "r.stream.order" and "r..stream.basins" from GRASS GIS.
+        return self.tr('''This algorithm installs the addon "r.stream.order" from GRASS GIS (basins are labelled by the DB simulator itself).
     
     --- Developed and adapted on July 2024 by Fernando Avendaño Veas (Massey University) using ArcPy scripts from the ACPF project (USDA) ---
     ''')
@@ -85,17 +85,6 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         
             feedback.pushInfo("Extension 'r.stream.order' has been installed.")
         
-        if 'r.stream.basins' in extensions_content:
-            feedback.pushInfo("Extension 'r.stream.basins' is installed.")
-        else:
-            feedback.pushInfo("Extension 'r.stream.basins' is NOT installed.")
-            
-            install.stream.basins = processing.run(
-            "grass7:g.extension.manage",{
-            'extension': 'r.stream.basins',
-            'operation':0},context=context,feedback=feedback)
-        
-            feedback.pushInfo("Extension 'r.stream.basins' has been installed.")        
         
 
 
@@ -132,10 +121,8 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         
         #fuzzy='r.fuzzy.system.exe'
         r_order_name = 'r.stream.order.exe'
-        r_basins_name = 'r.stream.basins.exe'
 
         r_order_file_path = os.path.join(grass_lib_path, r_order_name)
-        r_basins_file_path = os.path.join(grass_lib_path, r_basins_name)
         #path=os.path.join(grass_lib_path, fuzzy)
         
         
@@ -143,7 +130,6 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         destination_dir = os.path.join(gisbase, 'bin')
 
         destination_r_order_path = os.path.join(destination_dir, r_order_name)
-        destination_r_basins_path = os.path.join(destination_dir, r_basins_name)
         #destination_file_path = os.path.join(destination_dir, fuzzy)        
 
         # Copy the file if the source exists
@@ -151,8 +137,6 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
             try:
                 shutil.copy2(r_order_file_path, destination_r_order_path)
                 print(f"File {r_order_name} copied successfully to {destination_r_order_path}")
-                shutil.copy2(r_basins_file_path, destination_r_basins_path)
-                print(f"File {r_basins_name} copied successfully to {destination_r_basins_path}")                
                 # shutil.copy2(path, destination_file_path)
                 # print(f"File {fuzzy} copied successfully to {destination_file_path}")                
                 
@@ -179,12 +163,10 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         #Description names
         #fuzzy_txt='r.fuzzy.system.txt'
         r_order_txt = 'r.stream.order.txt'
-        r_basins_txt = 'r.stream.basins.txt'        
         
         #Files dirs
         #fuzzy_path=os.path.join(description_dir,fuzzy_txt)
         r_order_file_path = os.path.join(description_dir,r_order_txt)
-        r_basins_file_path = os.path.join(description_dir,r_basins_txt)
         
         
         
@@ -194,7 +176,6 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         destination_dir2 = os.path.join(prefix_path, 'python', 'plugins', 'grassprovider', 'description')
         #destination_descr_path = os.path.join(destination_dir2, fuzzy_txt)
         destination_r_order_desc = os.path.join(destination_dir2, r_order_txt)
-        destination_r_basins_desc = os.path.join(destination_dir2, r_basins_txt)
         
         if os.path.exists(destination_dir2):
             
@@ -204,12 +185,9 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
                 # print(f"File {fuzzy_txt} copied successfully to {destination_descr_path}")
                 shutil.copy2(r_order_file_path,destination_r_order_desc)
                 print(f"File {r_order_txt} copied successfully to {destination_r_order_desc}")                
-                shutil.copy2(r_basins_file_path,destination_r_basins_desc)
-                print(f"File {r_basins_txt} copied successfully to {destination_r_basins_desc}")
                 
             except FileNotFoundError:
                 print(f"File {r_order_txt} not found in {r_order_file_path}")
-                print(f"File {r_basins_txt} not found in {r_basins_file_path}")                
                 #print(f"File {fuzzy_txt} not found in {fuzzy_path}")                
                 
             except Exception as e:
@@ -34,7 +34,7 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
         return InstallDepProcessingAlgorithm()
     
     def shortHelpString(self):
-        return self.tr('''This algorithm installs addons "r.stream.order" and "r.stream.basins" from GRASS GIS.
+        return self.tr('''This algorithm installs the addon "r.stream.order" from GRASS GIS (basins are labelled by the DB simulator itself).
     
     --- Developed and adapted on July 2024 by Fernando Avendaño Veas (Massey University) using ArcPy scripts from the ACPF project (USDA) ---
     ''')
@@ -77,26 +77,13 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
                     }, context=context, feedback=feedback)
                 feedback.pushInfo("Extension 'r.stream.order' has been installed.")
 
-            if 'r.stream.basins' in extensions_content:
-                feedback.pushInfo("Extension 'r.stream.basins' is installed.")
-            else:
-                feedback.pushInfo("Installing 'r.stream.basins'...")
-                processing.run(
-                    "grass7:g.extension.manage", {
-                        'extension': 'r.stream.basins',
-                        'operation': 0
-                    }, context=context, feedback=feedback)
-                feedback.pushInfo("Extension 'r.stream.basins' has been installed.")
-
             scripts_path = ProcessingConfig.getSetting('SCRIPTS_FOLDERS')
             parent_dir = os.path.dirname(scripts_path)
             description_dir = os.path.join(parent_dir, 'GRASS descriptions')
 
             r_order_txt = 'r.stream.order.txt'
-            r_basins_txt = 'r.stream.basins.txt'
 
             r_order_file_path = os.path.join(description_dir, r_order_txt)
-            r_basins_file_path = os.path.join(description_dir, r_basins_txt)
 
             grass_provider = QgsApplication.processingRegistry().providerById('grass7')
 
@@ -113,18 +100,14 @@ class InstallDepProcessingAlgorithm(QgsProcessingAlgorithm):
 
                             prefix_path = folder
                             destination_r_order_desc = os.path.join(prefix_path, r_order_txt)
-                            destination_r_basins_desc = os.path.join(prefix_path, r_basins_txt)
 
                             if os.path.exists(prefix_path):
                                 try:
                                     shutil.copy2(r_order_file_path, destination_r_order_desc)
                                     feedback.pushInfo(f"File {r_order_txt} copied successfully to {destination_r_order_desc}")
-                                    shutil.copy2(r_basins_file_path, destination_r_basins_desc)
-                                    feedback.pushInfo(f"File {r_basins_txt} copied successfully to {destination_r_basins_desc}")
 
                                 except FileNotFoundError:
                                     feedback.pushInfo(f"File {r_order_txt} not found in {r_order_file_path}")
-                                    feedback.pushInfo(f"File {r_basins_txt} not found in {r_basins_file_path}")
 
                                 except Exception as e:
                                     feedback.pushInfo(f"Error copying file: {e}")
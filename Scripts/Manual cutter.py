@@ -1,3 +1,5 @@
+import os
+import sys
 import processing
 
 from qgis.PyQt.QtCore import QCoreApplication
@@ -17,6 +19,9 @@ from qgis.core import (QgsProcessing,
 
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import blocks, fill, flow
+
 
 class ManualCutterAlgorithm(QgsProcessingAlgorithm):
 
@@ -46,6 +51,8 @@ class ManualCutterAlgorithm(QgsProcessingAlgorithm):
         return self.tr('''This tool takes an input line vector and burns it into an input DEM raster. 
     
     
+    The flow accumulation of the new DEM is D8 steepest descent on the filled surface, with flat areas drained towards their nearest outlet; it replaces r.watershed (-s -a) but can differ from it on flats and on ties between neighbours.
+    
     Please be patient, since this proces might take some time and computer resources.
     
     --- Developed and adapted on July 2024 by Fernando Avendaño Veas (Massey University) using ArcPy scripts from the ACPF project (USDA) ---    
@@ -59,10 +66,20 @@ class ManualCutterAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterRasterDestination('OutputNewDEM', 'Output New DEM'))
         self.addParameter(QgsProcessingParameterRasterDestination('OutputFillDEM', 'Output New Filled DEM'))
         self.addParameter(QgsProcessingParameterRasterDestination('OutputFlowAcc', 'Output Flow Accumulation'))
+        self.addParameter(QgsProcessingParameterRasterDestination('OutputFlowDir', 'Output Flow Direction', optional=True, createByDefault=False))
         self.addParameter(QgsProcessingParameterRasterDestination('OutputHshd', 'Output Hillshade'))
         self.addParameter(QgsProcessingParameterNumber('ZFactor', 'Z Factor', type=QgsProcessingParameterNumber.Double, minValue=0.0, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('MinSlope', 'Minimum slope of filled areas (degrees)', type=QgsProcessingParameterNumber.Double, minValue=0.0, defaultValue=0.0))
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         # Get parameter values
         cut_lines = self.parameterAsVectorLayer(parameters, 'CutLines', context)
         #dam_lines = self.parameterAsVectorLayer(parameters, 'DamLines', context)
@@ -71,8 +88,10 @@ class ManualCutterAlgorithm(QgsProcessingAlgorithm):
         output_new_dem = self.parameterAsOutputLayer(parameters, 'OutputNewDEM', context)
         output_fill_dem = self.parameterAsOutputLayer(parameters, 'OutputFillDEM', context)
         output_flow_acc = self.parameterAsOutputLayer(parameters, 'OutputFlowAcc', context)
+        output_flow_dir = self.parameterAsOutputLayer(parameters, 'OutputFlowDir', context)
         output_hillshade = self.parameterAsOutputLayer(parameters, 'OutputHshd', context)
         z_factor = self.parameterAsDouble(parameters, 'ZFactor', context)
+        min_slope = self.parameterAsDouble(parameters, 'MinSlope', context)
         
         cut_zmin = None  # Initialize cut_zmin to None
         dam_zmax = None # Initialize dam_zmax to None
@@ -143,11 +162,11 @@ class ManualCutterAlgorithm(QgsProcessingAlgorithm):
             output_new_dem = dem
 
         # Fill the NewDEM
-        output_filldem = processing.run("saga:fillsinksxxlwangliu", {
+        output_filldem = fill.run_fill_sinks({
             'ELEV': output_new_dem,
-            'MINSLOPE':0.0,
+            'MINSLOPE': min_slope,
             'FILLED': 'TEMPORARY_OUTPUT',
-        }, context=context, feedback=feedback)["FILLED"]
+        }, feedback=feedback)["FILLED"]
 
         ##reprojection
         
@@ -163,15 +182,14 @@ class ManualCutterAlgorithm(QgsProcessingAlgorithm):
             context=context, feedback=feedback)["OUTPUT"]
 
 
-        # Calculate Flow Accumulation
-        output_flow_acc = processing.run("grass7:r.watershed", {
-            'elevation': output_fill_dem,
-            'threshold': 500000,
-            'memory': 3000,
-            '-s': True,
-            '-a': True,
-            'accumulation': output_flow_acc
-        }, context=context, feedback=feedback)["accumulation"]
+        # Calculate Flow Direction and Accumulation (single flow direction, absolute values)
+        flow_outputs = flow.run_flow_accumulation({
+            'elevation': filled_dem,
+            'accumulation': output_flow_acc,
+            'drainage': output_flow_dir
+        }, feedback=feedback)
+        output_flow_acc = flow_outputs["accumulation"]
+        output_flow_dir = flow_outputs.get("drainage")
 
         # Calculate Hillshade
         output_hillshade = processing.run("native:hillshade", {
@@ -188,5 +206,6 @@ class ManualCutterAlgorithm(QgsProcessingAlgorithm):
             'OutputNewDEM': output_new_dem,
             'OutputFillDEM': filled_dem,
             'OutputFlowAcc': output_flow_acc,
+            'OutputFlowDir': output_flow_dir,
             'OutputHshd': output_hillshade
         }
@@ -1,6 +1,7 @@
 import processing
 import subprocess
 import os
+import sys
 import multiprocessing
 import tempfile
 import shutil
@@ -32,6 +33,9 @@ from subprocess import run
 from datetime import datetime
 import getpass
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import algebra, blocks
+
 
 
 class StreamReachAlgorithm(QgsProcessingAlgorithm):
@@ -78,6 +82,14 @@ class StreamReachAlgorithm(QgsProcessingAlgorithm):
 
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         
 
         
@@ -147,14 +159,7 @@ class StreamReachAlgorithm(QgsProcessingAlgorithm):
         
         '''HERE WE OBTAIN THE ABSOLUTE VALUES OF FLOWDIR OF GRASS GIS, SINCE IT HAS NEGATIVE VALUES'''
         
-        expression = f'(({d8_flow_dir.name()}@1 < 0) * -1*{d8_flow_dir.name()}@1 + ({d8_flow_dir.name()}@1 >= 0) *{d8_flow_dir.name()}@1)' 
-
-        
-        flowdir_abs = processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': d8_flow_dir,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
+        flowdir_abs = algebra.calculate(abs(algebra.Raster(d8_flow_dir)), 'TEMPORARY_OUTPUT', feedback=feedback)
         
         
         
@@ -180,7 +185,7 @@ class StreamReachAlgorithm(QgsProcessingAlgorithm):
                 ###script to get script's directory and create a temporary folder'
         
 
-        dir = QgsProject.instance().readPath("./") + '/'
+        dir = QgsProcessingUtils.tempFolder()
         
         temp_dir = tempfile.mkdtemp(dir=dir)
 
@@ -261,14 +266,11 @@ class StreamReachAlgorithm(QgsProcessingAlgorithm):
         temp_data.addAttributes(attr)
         temp.updateFields()
         temp_data.addFeatures(feats)
-        QgsProject.instance().addMapLayer(temp)
         
-        # Adds memory layer with all copied attributes to ToC
         temp.selectAll()
         duplicate=processing.run("native:saveselectedfeatures", {'INPUT': temp, 'OUTPUT': out_stream_reach}, context=context, feedback=feedback)['OUTPUT']
         temp.removeSelection()
 
-        QgsProject.instance().removeMapLayer(temp.id())
         del reach_layer
         
         
@@ -289,8 +291,6 @@ class StreamReachAlgorithm(QgsProcessingAlgorithm):
         rlayer = QgsRasterLayer(temp_raster, "CatchmentsRaster")
         if not rlayer.isValid():
             print("Raster Layer failed to load!")
-            
-        QgsProject.instance().addMapLayer(rlayer)
 
         vector_catchments=processing.run("gdal:polygonize", {
         'INPUT':rlayer, 
@@ -312,9 +312,6 @@ class StreamReachAlgorithm(QgsProcessingAlgorithm):
 
         #deleting files
         
-        # QgsProject.instance().removeMapLayer(new_layer.id())
-        
-        QgsProject.instance().removeMapLayer(rlayer.id())
         del rlayer
 
         shutil.rmtree(temp_dir)
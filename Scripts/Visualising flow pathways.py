@@ -1,3 +1,5 @@
+import os
+import sys
 import processing
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.analysis import QgsZonalStatistics
@@ -17,6 +19,9 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterVectorDestination)
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import algebra, artifacts, blocks
+
 
 class FlowPaths(QgsProcessingAlgorithm):
 
@@ -58,6 +63,14 @@ class FlowPaths(QgsProcessingAlgorithm):
 
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
 
         flowacc = self.parameterAsRasterLayer(parameters, 'FlowAcc', context)
         areathr=self.parameterAsDouble(parameters,'AreaThr', context)
@@ -69,54 +82,31 @@ class FlowPaths(QgsProcessingAlgorithm):
         --------- Extracting streams -------------------
         
         ''')
-        #Conversion from squared metres to hectares
+        #Conversion from squared metres to hectares, selecting streams more than the limit specified
+        #and converting to 'CELL' format (integer, 0 as null) to be handled by GRASS, in one pass
         
         pixels=flowacc.rasterUnitsPerPixelX()
-        expression = f'(({flowacc.name()}@1*{pixels})/10000)'
+        flowacc_ha = algebra.Raster(flowacc) * pixels / 10000
+        drainage_network = flowacc_ha >= areathr
 
-        flowacc_ha= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': flowacc,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-        
-        
-        
-        #Selecting streams more than the limit specified and vectorising 
-        
-        expression = f'(({flowacc_ha}@1>={areathr})*1)'
-        
-        drainage_network= processing.run("qgis:rastercalculator", {
-            'EXPRESSION': expression,
-            'LAYERS': flowacc_ha,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)["OUTPUT"]
-        
-        
-        #Converting to 'CELL' format to be handled by GRASS
-        
-        expression = f'(if(A>0, 1, null()))'
-        
-        to_cell = processing.run(
-            "grass7:r.mapcalc.simple",{
-            'a': drainage_network,
-            'expression': expression,
-            'output': 'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['output']
+        #Derived rasters and vectors are reused from an earlier run with the same inputs
+        to_cell = artifacts.call(algebra.run_calculate, {'EXPRESSION': algebra.where(drainage_network, 1, 0), 'OUTPUT': 'TEMPORARY_OUTPUT',
+                                  'DTYPE': 'int32', 'NODATA': 0}, feedback=feedback)['OUTPUT']
 
         #Filtering out zeros
         
-        thinned = processing.run(
+        thinned = artifacts.run(processing.run,
             "grass7:r.thin",{
             'input': to_cell,
             'output': 'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['output']
         
         #Converting to vector
         
-        vector = processing.run(
+        vector = artifacts.run(processing.run,
             "grass7:r.to.vect",{
             'input': thinned,
             'type': 0,
-            'output':output_flowpaths},context=context,feedback=feedback)['output']
+            'output':output_flowpaths}, destinations=('output',), context=context,feedback=feedback)['output']
         
 
         # Return results
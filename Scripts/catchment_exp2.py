@@ -1,3 +1,5 @@
+import os
+import sys
 import processing
 from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsProcessing,
@@ -30,12 +32,16 @@ from qgis.core import (QgsProcessing,
                        QgsFeatureRequest,
                        QgsSpatialIndex,
                        QgsRasterBandStats,
-                       QgsProcessingParameterVectorDestination)
+                       QgsProcessingParameterVectorDestination,
+                       QgsProcessingParameterFileDestination)
 from datetime import datetime
-from qgis.utils import iface
 from qgis.analysis import QgsRasterCalculatorEntry
 import math
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dbsim import blocks, results, storage
+from dbsim.outputs import write_layer
+
 
 class DBs_2(QgsProcessingAlgorithm):
 
@@ -60,6 +66,7 @@ class DBs_2(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr('''This algorithm estimates the storage pond, contributing area and storage:catchment ratio for potential detainment bunds previously simulated (DB simulation tool).
             Please be patient, since this proces may take some time and computer resources.
+            The DEM is not filled again for every height: the volume and area of all heights are read from a stage-storage curve of each bund place, which can be saved as a table (DB_ID, stage, elevation, area and volume every "Curve step" metres).
     
     --- Developed and adapted on July 2024 by Fernando Avendaño Veas (Massey University) using ArcPy scripts from the ACPF project (USDA) ---    
 
@@ -75,8 +82,18 @@ class DBs_2(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber('Z', 'Z factor', QgsProcessingParameterNumber.Double, defaultValue=1))
         self.addParameter(QgsProcessingParameterVectorDestination('Catchments', 'Potential DB catchments'))
         self.addParameter(QgsProcessingParameterRasterDestination('Depth', 'Catchment depth raster', optional=True))
+        self.addParameter(QgsProcessingParameterFileDestination('Curves', 'Stage-storage curves', 'CSV files (*.csv)', optional=True, createByDefault=False))
+        self.addParameter(QgsProcessingParameterNumber('Step', 'Curve step (m)', QgsProcessingParameterNumber.Double, defaultValue=0.1, minValue=0.01))
 
     def processAlgorithm(self, parameters, context, feedback):
+        # The shared raster block cache of dbsim keeps the rasters it read open until it is released,
+        # also when the run fails
+        try:
+            return self.runAlgorithm(parameters, context, feedback)
+        finally:
+            blocks.release(feedback)
+
+    def runAlgorithm(self, parameters, context, feedback):
         
         
         locations=self.parameterAsVectorLayer(parameters, 'DB_locations', context)
@@ -86,34 +103,47 @@ class DBs_2(QgsProcessingAlgorithm):
         memory = self.parameterAsDouble(parameters, 'Memory', context)
         catchments = self.parameterAsOutputLayer(parameters, 'Catchments', context)
         depth = self.parameterAsOutputLayer(parameters, 'Depth', context)
+        curves_path = self.parameterAsFileOutput(parameters, 'Curves', context)
+        step = self.parameterAsDouble(parameters, 'Step', context)
 
 
 
 
         
 
-        # Step 1: Get unique combinations of 'Height (m)' and 'Length (m)' fields
-        unique_combinations = set()
+        # Step 1: Get unique values of 'Length (m)'. Bunds of every height on the same place share
+        # their basin, so the storage of all heights is read from one stage-storage curve per place
+        lengths = set()
         for feature in locations.getFeatures():
-            height = feature['Height (m)']
-            length = feature['Length (m)']
-            unique_combinations.add((height, length))
+            lengths.add(feature['Length (m)'])
 
-        feedback.pushInfo(f'Processing {len(unique_combinations)} unique Height-Length combinations.')
+        feedback.pushInfo(f'Processing {len(lengths)} unique Length values.')
 
-        # Step 2: Process each combination separately
+        # Step 2: Process each length separately
         combined_catchments = []  # List to store the catchments for each combination
+        curves = {}  # Stage-storage curve of every DB_ID
         
         
-        for height, length in unique_combinations:
-            feedback.pushInfo(f'Processing Height: {height}, Length: {length}')
+        for length in lengths:
+            feedback.pushInfo(f'Processing Length: {length}')
 
-            # Filter locations for the current height and length
-            request = QgsFeatureRequest().setFilterExpression(f'"Height (m)" = {height} AND "Length (m)" = {length}')
+            # Filter locations for the current length
+            request = QgsFeatureRequest().setFilterExpression(results.scenario_filter(length=length))
             selected_locations = locations.materialize(QgsFeatureRequest(request))
 
 
-            # Repeat your existing logic but replace `locations` with `selected_locations`
+            # Labelling the places of the DBs, shared by the DBs of different heights
+            sites = {}
+            selected_locations.startEditing()
+            selected_locations.addAttribute(QgsField('Site', QVariant.Int))
+            selected_locations.updateFields()
+            idx = selected_locations.fields().indexFromName('Site')
+            for feature in selected_locations.getFeatures():
+                site = sites.setdefault(feature.geometry().asWkt(), len(sites) + 1)
+                selected_locations.changeAttributeValue(feature.id(), idx, site)
+            selected_locations.commitChanges()
+
+
             buffer = processing.run("native:buffer", {
             'INPUT': selected_locations,
             'DISTANCE': 1,
@@ -123,39 +153,18 @@ class DBs_2(QgsProcessingAlgorithm):
             }, context=context, feedback=feedback)["OUTPUT"]
 
 
-            temp_depth_file = QgsProcessingUtils.generateTempFilename(f"depth_{height}_{length}.tif")
-
+            #Outlet cells of the DBs on the flow direction grid, labelled by site
 
-            rasterised_db_id=processing.run('grass7:v.to.rast',{
-                'input': buffer, #was locations
-                'attribute_column': 'DB_ID',
-                'GRASS_REGION_PARAMETER': dem.extent(),
-                'GRASS_REGION_CELLSIZE_PARAMETER': 1,
-                'output': temp_depth_file}, context=context, feedback=feedback)['output']
-
-
-            points= processing.run("qgis:generatepointspixelcentroidsinsidepolygons", {
-                'INPUT_RASTER': flowdir,
-                'INPUT_VECTOR':buffer,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
-
-
-            dissolve= processing.run("native:dissolve", {
-                'INPUT': points,
-                'FIELD':'poly_id',
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
-
-
-            #Finding watersheds of all detainment bund places
-            
-            watersheds= processing.run(
-                "grass7:r.stream.basins",{
-                'direction': flowdir,
-                'points': dissolve,
-                'memory': memory,
-                'basins':'TEMPORARY_OUTPUT'},context=context,feedback=feedback)['basins']
+            outlets=processing.run('gdal:rasterize',{
+                'INPUT': buffer,
+                'FIELD': 'Site',
+                'UNITS': 1,
+                'WIDTH': flowdir.rasterUnitsPerPixelX(),
+                'HEIGHT': flowdir.rasterUnitsPerPixelY(),
+                'NODATA': 0,
+                'DATA_TYPE': 4,
+                'EXTENT': flowdir.extent(),
+                'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
 
             
             feedback.pushInfo('''
@@ -165,270 +174,132 @@ class DBs_2(QgsProcessingAlgorithm):
             ''')
 
 
-            #dem_crs = dem.crs().toWkt()
-            #feedback.pushInfo(f'DEM CRS: {dem_crs}')
-            #feedback.pushInfo(f'Extent: {dem.extent().toString()}')
-            epsg_code = dem.crs().authid() 
-
-            
-            # #Rasterizing DBs based on height parameter
-
-            rasterised_db_height=processing.run('gdal:rasterize',{
-                'INPUT': buffer, #was locations
-                'FIELD': 'Height (m)',
-                'UNITS': 1,
-                'WIDTH': 1.0,
-                'HEIGHT': 1.0,
-                'NODATA': 0,
-                'EXTENT': buffer,
-                'EXTRA': f'-a_srs "{epsg_code}"',
-                'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
-            
-            # #Converting format, needed for GRASS zonal stats processing
-            
-            # id_translated=processing.run('gdal:translate',{
-            #     'INPUT': rasterised_db_id,
-            #     'DATA_TYPE': 5,
-            #     'EXTRA': f'-a_srs "{epsg_code}"',
-            #     'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
-
-
-            min_DB = processing.run('grass7:r.stats.zonal', {
-                'base': rasterised_db_id,
-                'cover': dem,
-                'method': 2,
-                'GRASS_REGION_PARAMETER': dem,
-                'output': 'TEMPORARY_OUTPUT' 
-                }, context=context, feedback=feedback)['output']
-                
-            min_DB_with_crs = processing.run('gdal:assignprojection', {
-                'INPUT': min_DB,
-                'CRS': dem.crs().toWkt(),
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)['OUTPUT']
-                
-            expression =f'\"{min_DB_with_crs}@1\" + \"{rasterised_db_height}@1\"'
-            
-            db_hgt= processing.run("qgis:rastercalculator", {
-                'EXPRESSION': expression,
-                'LAYERS': [rasterised_db_height, min_DB_with_crs],
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
-            
-            #Filling db_hgt no data cells with zeros for processing, then creating New DEM with DBs burned, and filling DEM
-            fill_nodata= processing.run("native:fillnodata", {
-                'INPUT': db_hgt,
-                'BAND':1,
-                'FILL_VALUE': 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
-
-            expression = f'(({fill_nodata}@1>0)*{fill_nodata}@1+({fill_nodata}@1=0)*{dem.name()}@1)'
-            
-
-
-            NewDEM= processing.run("qgis:rastercalculator", {
-                'EXPRESSION': expression,
-                'LAYERS': [dem, fill_nodata],
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
-
-            FilledNewDEM = processing.run("saga:fillsinksxxlwangliu", { ##WILL HAVE TO USE WANGLIU ONLY. EXTRA VALUES ARE GENERATED WHEN MIXING XXL AND NOT XXL
-                'ELEV': NewDEM,
-                'MINSLOPE':0.0,
-                'FILLED': 'TEMPORARY_OUTPUT',
-                }, context=context, feedback=feedback)["FILLED"]
-
-            expression =f'\"{FilledNewDEM}@1\" - \"{dem.name()}@1\"'
-            
-            FillReg= processing.run("qgis:rastercalculator", {
-                'EXPRESSION': expression,
-                'LAYERS': [FilledNewDEM, dem],
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]        
+            #Stage-storage curve of every site; the crest of each DB is its height above the lowest cell under it
 
+            bunds = [(feature['Site'], feature['DB_ID'], feature['Height (m)']) for feature in selected_locations.getFeatures()]
 
+            stage_storage = storage.run_stage_storage({
+                'DEM': dem,
+                'DIRECTION': flowdir,
+                'OUTLETS': outlets,
+                'BUNDS': bunds,
+                'Z': z_factor,
+                }, feedback=feedback)
 
-            # Convert FillReg (which represents the volume of storage at every sink cell in the DEM) to volume in cubic metres        
-            expression = f'({FillReg}@1 * {z_factor})'
+            curves.update(stage_storage['CURVES'])
             
-            FillRegMet = processing.run("qgis:rastercalculator", {
-                'EXPRESSION': expression,
-                'LAYERS': [FillReg],
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
-            
-            pixels=dem.rasterUnitsPerPixelX()
             
-            expression = f'({FillRegMet}@1 * {pixels} * {pixels})'
+            #Writing volume and area of every DB from the curves
             
-            FillRegCM = processing.run("qgis:rastercalculator", {
-                'EXPRESSION': expression,
-                'LAYERS': [FillRegMet],
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-                }, context=context, feedback=feedback)["OUTPUT"]
+            selected_locations.startEditing()
+            selected_locations.addAttribute(QgsField('Volume(m3)', QVariant.Double))
+            selected_locations.addAttribute(QgsField('Area (m2)', QVariant.Double))
+            selected_locations.updateFields()
+            idx_volume = selected_locations.fields().indexFromName('Volume(m3)')
+            idx_area = selected_locations.fields().indexFromName('Area (m2)')
+            for feature in selected_locations.getFeatures():
+                area, volume = stage_storage['STORAGE'].get(feature['DB_ID'], (0.0, 0.0))
+                selected_locations.changeAttributeValue(feature.id(), idx_volume, volume)
+                selected_locations.changeAttributeValue(feature.id(), idx_area, area)
+            selected_locations.commitChanges()
 
-            # Convert values of all sink cells to the WASCOBID of the watershed that it falls in
 
+            for height, ponds in stage_storage['PONDS'].items():
+                feedback.pushInfo(f'Processing Height: {height}, Length: {length}')
 
-            expression = f'((A > 0) * B)' ##EXPRESSIONS IN GDAL NEEDS SPACES!
-            
-            Sinks_ID = processing.run("gdal:rastercalculator", {
-                'INPUT_A': FillRegCM,
-                'BAND_A': 1,
-                'INPUT_B':watersheds,
-                'BAND_B': 1,
-                'FORMULA': expression,
-                'NO_DATA': 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-
-            polygonised = processing.run('grass7:r.to.vect', {
-                'input': Sinks_ID,
-                'type': 2,
-                'column': 'value',
-                '-s': True,
-                'output': 'TEMPORARY_OUTPUT' 
-                }, context=context, feedback=feedback)['output']
-            
-            ID_field = processing.run("native:fieldcalculator", {
-                'INPUT': buffer,
-                'FIELD_NAME': "ID",
-                'FIELD_TYPE': 0, 
-                'FORMULA': f'@id', ##was+1
-                'OUTPUT': 'TEMPORARY_OUTPUT'
+                polygonised = processing.run('grass7:r.to.vect', {
+                    'input': ponds,
+                    'type': 2,
+                    'column': 'value',
+                    '-s': True,
+                    'output': 'TEMPORARY_OUTPUT' 
+                    }, context=context, feedback=feedback)['output']
+                
+                joined=processing.run("native:joinattributestable", {
+                    'INPUT': polygonised,
+                    'FIELD': 'value',
+                    'INPUT_2': selected_locations,
+                    'FIELD_2': 'DB_ID',
+                    'FIELDS_TO_COPY': ['DB_ID', 'Contr_area', 'Height (m)', 'Length (m)', 'Volume(m3)', 'Area (m2)'],
+                    'METHOD': 1,
+                    'DISCARD_NONMATCHING': False,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
                 }, context=context, feedback=feedback)['OUTPUT']
-            
-            joined=processing.run("native:joinattributestable", {
-                'INPUT': polygonised,
-                'FIELD': 'value',
-                'INPUT_2': ID_field,
-                'FIELD_2': 'ID',
-                'FIELDS_TO_COPY': ['DB_ID', 'Contr_area', 'Height (m)', 'Length (m)'],
-                'METHOD': 1,
-                'DISCARD_NONMATCHING': False,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-            
-                        
-            fixed=processing.run("native:fixgeometries", {
-                'INPUT': joined,
-                'METHOD': 1,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-            
-            
-            dissolve=processing.run("native:dissolve", {
-                'INPUT': fixed,
-                'FIELD': 'DB_ID',
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-
-            
-            volume = processing.run("native:zonalstatisticsfb", {
-                'INPUT': dissolve,
-                'INPUT_RASTER': FillRegCM, ##FillRegCM
-                'RASTER_BAND': 1,
-                'STATISTICS': 1,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-            
-            
-            volume2=processing.run("native:fieldcalculator", {
-                'INPUT':volume, 
-                'FIELD_NAME': "Volume(m3)",
-                'FIELD_TYPE': 0,
-                'FORMULA':"_sum",
-                'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
-            
-
-            
-            area=processing.run("native:fieldcalculator", {
-                'INPUT':volume2, 
-                'FIELD_NAME': "Area (m2)",
-                'FIELD_TYPE': 0,
-                'FORMULA':"area(@geometry)",
-                'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
-
-            smoothed=processing.run("native:smoothgeometry", { 
-                'INPUT': area,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
-
-            # Open editing session
-            smoothed.startEditing()
-            
-            
-            #Delete _sum field
-            idx = smoothed.fields().indexFromName('_sum')
-            if idx != -1:
-                smoothed.deleteAttribute(idx)
-            
-            #Delete value  field
-            idx = smoothed.fields().indexFromName('value')
-            if idx != -1:
-                smoothed.deleteAttribute(idx)
-            
-            #Delete cat  field
-            idx = smoothed.fields().indexFromName('cat')
-            if idx != -1:
-                smoothed.deleteAttribute(idx)
-            
-            #Delete fid field
-            idx = smoothed.fields().indexFromName('fid')
-            if idx != -1:
-                smoothed.deleteAttribute(idx)
                 
+                            
+                fixed=processing.run("native:fixgeometries", {
+                    'INPUT': joined,
+                    'METHOD': 1,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }, context=context, feedback=feedback)['OUTPUT']
                 
-            # Close editing session and save changes
-            smoothed.commitChanges() 
+                
+                dissolve=processing.run("native:dissolve", {
+                    'INPUT': fixed,
+                    'FIELD': 'DB_ID',
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }, context=context, feedback=feedback)['OUTPUT']
 
-            # Save the renamed layer to the final output
-            QgsVectorFileWriter.writeAsVectorFormat(smoothed, catchments, 'utf-8', smoothed.crs(), 'ESRI Shapefile')
 
-            
-            ratio=processing.run("native:fieldcalculator", {
-                'INPUT':smoothed, 
-                'FIELD_NAME': "Ratio",
-                'FIELD_TYPE': 1,
-                'FORMULA':'"Volume(m3)"/"Contr_area"',
-                'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
-            
-            
-            sorted=processing.run("native:orderbyexpression", {   
-                'INPUT': ratio,
-                'EXPRESSION': "Ratio",
-                'ASCENDING': False,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']      
-            
+                smoothed=processing.run("native:smoothgeometry", { 
+                    'INPUT': dissolve,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }, context=context, feedback=feedback)['OUTPUT']
 
+                # Open editing session
+                smoothed.startEditing()
+                
+                #Delete value  field
+                idx = smoothed.fields().indexFromName('value')
+                if idx != -1:
+                    smoothed.deleteAttribute(idx)
+                
+                #Delete cat  field
+                idx = smoothed.fields().indexFromName('cat')
+                if idx != -1:
+                    smoothed.deleteAttribute(idx)
+                
+                #Delete fid field
+                idx = smoothed.fields().indexFromName('fid')
+                if idx != -1:
+                    smoothed.deleteAttribute(idx)
+                    
+                    
+                # Close editing session and save changes
+                smoothed.commitChanges() 
 
-            #Eliminating no data from depth raster
-            
-            expression = f'((A > 0) * A)'
                 
-            nodata = processing.run("gdal:rastercalculator", {
-                'INPUT_A': FillReg,
-                'BAND_A': 1,
-                'FORMULA': expression,
-                'NO_DATA': 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback)['OUTPUT']
+                ratio=processing.run("native:fieldcalculator", {
+                    'INPUT':smoothed, 
+                    'FIELD_NAME': "Ratio",
+                    'FIELD_TYPE': 1,
+                    'FORMULA':'"Volume(m3)"/"Contr_area"',
+                    'OUTPUT': 'TEMPORARY_OUTPUT'}, context=context, feedback=feedback)['OUTPUT']
+                
+                
+                sorted=processing.run("native:orderbyexpression", {   
+                    'INPUT': ratio,
+                    'EXPRESSION': "Ratio",
+                    'ASCENDING': False,
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }, context=context, feedback=feedback)['OUTPUT']      
 
-            # Save the catchment result for this combination (you can save it to a temporary layer)
-            catchment_layer = sorted
+                # Append the result to the list of combined catchments
+                combined_catchments.append(sorted)            
 
-            # Append the result to the list of combined catchments
-            combined_catchments.append(catchment_layer)            
+        if curves_path:
+            storage.write_curves(curves_path, curves, step)
 
         if len(combined_catchments) > 1:
             final_catchments = processing.run("native:mergevectorlayers", {
                 'LAYERS': combined_catchments,
                 'CRS': dem.crs().toWkt(),
-                'OUTPUT': catchments
+                'OUTPUT': 'TEMPORARY_OUTPUT'
             }, context=context, feedback=feedback)['OUTPUT']
         else:
             final_catchments = combined_catchments[0]
 
-        return {'Catchments': final_catchments}
\ No newline at end of file
+        # Written once, in bulk, with the spatial and DB_ID/height/length/Ratio indexes of a GeoPackage
+        write_layer(final_catchments, catchments)
+
+        return {'Catchments': final_catchments, 'Curves': curves_path}
\ No newline at end of file
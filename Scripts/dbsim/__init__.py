@@ -0,0 +1,6 @@
+"""Array engines shared by the DB simulator processing scripts.
+
+The modules in this package only depend on NumPy and GDAL, so they can be
+called from the QGIS processing scripts as well as from plain Python.
+Numba is used when it is installed to compile the sequential kernels.
+"""
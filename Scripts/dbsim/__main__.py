@@ -0,0 +1,28 @@
+"""Command line of the batch runner: ``python -m dbsim manifest.json --workers 4``.
+
+Run from the Scripts folder with the Python of QGIS (e.g. the OSGeo4W
+shell), so ``qgis`` and ``processing`` can be imported.
+"""
+
+import argparse
+import sys
+
+from .batch import run_manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m dbsim', description='Run the DB simulator pipeline over the jobs of a manifest.')
+    parser.add_argument('manifest', help='JSON manifest of the jobs')
+    parser.add_argument('--workers', type=int, default=1, help='jobs run at the same time, each in its own process')
+    parser.add_argument('--summary', help='path of the JSON summary (summary.json in the output folder by default)')
+    args = parser.parse_args(argv)
+    summary = run_manifest(args.manifest, args.workers, args.summary)
+    for job in summary['jobs']:
+        stages = ', '.join(f'{stage["name"]} {stage.get("seconds", 0):.1f} s' for stage in job['stages'])
+        print(f'{job["name"]}: {job["status"]} ({stages})')
+    print(f'{len(summary["jobs"]) - len(summary["failed"])} of {len(summary["jobs"])} jobs done in {summary["seconds"]:.1f} s')
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+"""Optional dependencies."""
+
+try:
+    from numba import njit as _njit
+except ImportError:
+    _njit = None
+
+# Whether ``jit`` compiles, for kernels with a vectorized fallback
+NUMBA = _njit is not None
+
+
+def jit(func):
+    """Compile ``func`` with numba when available, otherwise run it as Python."""
+    if _njit is None:
+        return func
+    return _njit(cache=True)(func)
@@ -0,0 +1,297 @@
+"""Raster algebra evaluated in one pass over blocks of rows.
+
+Chains of ``qgis:rastercalculator`` calls wrote every link to a temporary
+GeoTIFF that the next link read back. Here an expression is built from
+``Raster`` leaves with the Python operators and only evaluated when it is
+written: every block of rows of the inputs is read once, the whole
+expression is computed on it in memory and only the declared outputs are
+written. Several outputs can be written in the same pass, sharing the
+blocks read and the common parts of their expressions. The inputs are read
+through the shared ``blocks`` cache, like in the other engines.
+
+A cell is nodata in the result when one of the inputs it depends on is
+nodata, as in the raster calculator; ``Raster.filled`` reads the nodata
+cells of an input as a value instead, and ``where`` only depends on the
+branch it picks.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from . import blocks, raster_io
+
+# Cells read per input and block
+BLOCK_CELLS = 2 ** 22
+
+
+class Expression:
+    """Node of a raster expression, combined with the arithmetic, comparison and logical operators."""
+
+    def _apply(self, func, *args):
+        return Operation(func, (self,) + tuple(_node(arg) for arg in args))
+
+    def __add__(self, other):
+        return self._apply(np.add, other)
+
+    def __radd__(self, other):
+        return _node(other)._apply(np.add, self)
+
+    def __sub__(self, other):
+        return self._apply(np.subtract, other)
+
+    def __rsub__(self, other):
+        return _node(other)._apply(np.subtract, self)
+
+    def __mul__(self, other):
+        return self._apply(np.multiply, other)
+
+    def __rmul__(self, other):
+        return _node(other)._apply(np.multiply, self)
+
+    def __truediv__(self, other):
+        return self._apply(np.true_divide, other)
+
+    def __rtruediv__(self, other):
+        return _node(other)._apply(np.true_divide, self)
+
+    def __neg__(self):
+        return self._apply(np.negative)
+
+    def __abs__(self):
+        return self._apply(np.absolute)
+
+    def __lt__(self, other):
+        return self._apply(np.less, other)
+
+    def __le__(self, other):
+        return self._apply(np.less_equal, other)
+
+    def __gt__(self, other):
+        return self._apply(np.greater, other)
+
+    def __ge__(self, other):
+        return self._apply(np.greater_equal, other)
+
+    def __eq__(self, other):
+        return self._apply(np.equal, other)
+
+    def __ne__(self, other):
+        return self._apply(np.not_equal, other)
+
+    def __and__(self, other):
+        return self._apply(np.logical_and, other)
+
+    def __or__(self, other):
+        return self._apply(np.logical_or, other)
+
+    def __invert__(self):
+        return self._apply(np.logical_not)
+
+    __hash__ = object.__hash__
+
+    def leaves(self):
+        return []
+
+    def terms(self):
+        """Nested description of the expression, with the raster sources as given (e.g. to hash it)."""
+        raise NotImplementedError
+
+    def compute(self, block):
+        raise NotImplementedError
+
+
+class Constant(Expression):
+
+    def __init__(self, value):
+        self.value = value
+
+    def terms(self):
+        return 'constant', self.value
+
+    def compute(self, block):
+        return np.asarray(self.value), True
+
+
+class Raster(Expression):
+    """Band of a raster layer or path, read block by block."""
+
+    def __init__(self, source, band=1, fill=None):
+        self.source = source
+        self.band = band
+        self.fill = fill
+
+    @property
+    def key(self):
+        return raster_io.source_path(self.source), self.band
+
+    def filled(self, value):
+        """The same band with its nodata cells read as ``value``."""
+        return Raster(self.source, self.band, value)
+
+    def leaves(self):
+        return [self]
+
+    def terms(self):
+        return 'raster', self.source, self.band, self.fill
+
+    def compute(self, block):
+        values, nodata = block.read(self)
+        valid = raster_io.valid_mask(values, nodata)
+        if self.fill is None:
+            return values, valid
+        return np.where(valid, values, self.fill), True
+
+
+class Operation(Expression):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def leaves(self):
+        return [leaf for arg in self.args for leaf in arg.leaves()]
+
+    def terms(self):
+        return (self.func.__name__,) + self.args
+
+    def compute(self, block):
+        values, valid = zip(*(block.compute(arg) for arg in self.args))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = self.func(*values)
+        return result, _all(valid)
+
+
+class Where(Expression):
+
+    def __init__(self, condition, true, false):
+        self.args = (condition, true, false)
+
+    def leaves(self):
+        return [leaf for arg in self.args for leaf in arg.leaves()]
+
+    def terms(self):
+        return ('where',) + self.args
+
+    def compute(self, block):
+        (condition, c_valid), (true, t_valid), (false, f_valid) = (block.compute(arg) for arg in self.args)
+        condition = np.asarray(condition, dtype=bool)
+        valid = np.logical_and(c_valid, np.where(condition, t_valid, f_valid))
+        return np.where(condition, true, false), valid
+
+
+def _node(value):
+    return value if isinstance(value, Expression) else Constant(value)
+
+
+def _all(valid):
+    masks = [mask for mask in valid if mask is not True]
+    if not masks:
+        return True
+    return np.logical_and.reduce(np.broadcast_arrays(*masks))
+
+
+def where(condition, true, false):
+    """``true`` where ``condition`` holds and ``false`` elsewhere, cell by cell."""
+    return Where(_node(condition), _node(true), _node(false))
+
+
+def minimum(a, b):
+    return _node(a)._apply(np.minimum, b)
+
+
+def maximum(a, b):
+    return _node(a)._apply(np.maximum, b)
+
+
+class Output(namedtuple('Output', 'expression destination dtype nodata')):
+    """Declared result of a pass: ``expression`` written to ``destination`` as ``dtype`` with ``nodata``."""
+
+
+class _Block:
+    """Rows ``row`` to ``row + rows`` of every input, each read once, and the values computed on them."""
+
+    def __init__(self, sources, row, rows, cols):
+        self.sources = sources
+        self.row = row
+        self.rows = rows
+        self.cols = cols
+        self.arrays = {}
+        self.computed = {}
+
+    def read(self, raster):
+        if raster.key not in self.arrays:
+            path, nodata = self.sources[raster.key]
+            self.arrays[raster.key] = blocks.read_window(path, self.row, 0, self.rows, self.cols, raster.band), nodata
+        return self.arrays[raster.key]
+
+    def compute(self, node):
+        # Nodes are keyed by identity, == builds an expression
+        if id(node) not in self.computed:
+            self.computed[id(node)] = node.compute(self)
+        return self.computed[id(node)]
+
+
+def evaluate(outputs, feedback=None):
+    """Write every ``Output`` in a single pass over the blocks of their inputs.
+
+    The outputs take the grid of the first input. Other inputs whose
+    corners are more than ``raster_io.GRID_TOLERANCE`` cells off that grid
+    (e.g. the output of a GRASS or GDAL tool with its own region) are
+    resampled onto it by nearest neighbour. Returns the list of destination
+    paths.
+    """
+    outputs = [Output(_node(o.expression), raster_io.output_path(o.destination, 'expression.tif'), np.dtype(o.dtype), o.nodata)
+               for o in outputs]
+    leaves = {leaf.key: leaf for o in outputs for leaf in o.expression.leaves()}
+    if not leaves:
+        raise ValueError('The expressions do not read any raster')
+    sources, info, reference = {}, None, None
+    for key, leaf in leaves.items():
+        path = key[0]
+        if info is None:
+            info, reference = raster_io.raster_info(path), path
+        elif not raster_io.same_grid(raster_io.raster_info(path), info):
+            try:
+                path = raster_io.warp_to_grid(path, info)
+            except RuntimeError as e:
+                raise ValueError(f'{key[0]} is not on the grid of {reference} and could not be resampled onto it: {e}')
+            if feedback is not None:
+                feedback.pushInfo(f'{key[0]} is not on the grid of {reference}; resampled onto it by nearest neighbour')
+        ds = raster_io.open_raster(path)
+        sources[key] = path, ds.GetRasterBand(leaf.band).GetNoDataValue()
+        ds = None
+
+    rows, cols = info.shape
+    targets = [raster_io.create_raster(o.destination, info, o.dtype, o.nodata) for o in outputs]
+    step = max(BLOCK_CELLS // max(cols, 1), 1)
+    for row in range(0, rows, step):
+        block = _Block(sources, row, min(step, rows - row), cols)
+        for o, target in zip(outputs, targets):
+            values, valid = block.compute(o.expression)
+            values = np.broadcast_to(values, (block.rows, cols))
+            if valid is not True and o.nodata is not None:
+                values = np.where(valid, values, o.nodata)
+            target.GetRasterBand(1).WriteArray(np.asarray(values).astype(o.dtype), 0, row)
+        if feedback is not None:
+            feedback.setProgress(100 * (row + block.rows) / rows)
+    for target in targets:
+        target.GetRasterBand(1).FlushCache()
+    targets = None
+    return [o.destination for o in outputs]
+
+
+def calculate(expression, destination=None, dtype=np.float32, nodata=-9999.0, feedback=None):
+    """Write one expression, returning the destination path."""
+    return evaluate([Output(expression, destination, dtype, nodata)], feedback)[0]
+
+
+def run_calculate(parameters, feedback=None):
+    """Processing style entry point of ``calculate``.
+
+    ``EXPRESSION`` is the expression, ``OUTPUT`` the destination and the
+    optional ``DTYPE`` and ``NODATA`` those of the result. Returns
+    ``{'OUTPUT': path}``.
+    """
+    return {'OUTPUT': calculate(parameters['EXPRESSION'], parameters.get('OUTPUT'), parameters.get('DTYPE', 'float32'),
+                                parameters.get('NODATA', -9999.0), feedback)}
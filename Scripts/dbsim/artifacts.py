@@ -0,0 +1,332 @@
+"""Persistent cache of the rasters and vectors derived by the tools, across runs.
+
+The tools are run again and again on the same DEM with small parameter
+changes, and every run derived the same filled DEM, flow accumulation,
+stream rasters and stream vectors. ``run`` and ``call`` look a step up
+before running it: the key is a hash of the algorithm, of its plain
+parameters and of the contents of its input files (memory layers are
+hashed by their features), so the key changes when an input changes and
+not when it is only renamed. The key also holds a digest of the ``dbsim``
+source files and, for ``processing.run`` steps, the QGIS and GDAL
+versions, so an update of the code that made an output invalidates it. On
+a hit the stored outputs are copied to
+the destinations of the step; on a miss the step runs and its file outputs
+are stored.
+
+Entries live in ``DBSIM_CACHE_DIR`` (``~/.cache/dbsim`` by default) and are
+evicted least recently used first when the folder grows past
+``DBSIM_CACHE_MB`` (0 disables the cache). The digests of large inputs are
+remembered by path, size and modification time, so an unchanged DEM is
+only read once.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from . import raster_io
+
+CACHE_MB = 20480
+
+# Bytes hashed at a time
+CHUNK = 8 * 2 ** 20
+
+
+class Uncacheable(Exception):
+    """A parameter or output that cannot be hashed or stored, so the step runs without the cache."""
+
+
+def default_folder():
+    folder = os.environ.get('DBSIM_CACHE_DIR')
+    if folder:
+        return folder
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else None
+    return os.path.join(base or os.path.join(os.path.expanduser('~'), '.cache'), 'dbsim')
+
+
+def _is_file(value):
+    return isinstance(value, str) and value != raster_io.TEMPORARY_OUTPUT and os.path.isfile(value.split('|')[0])
+
+
+def _destination_format(value):
+    if isinstance(value, str) and value and value != raster_io.TEMPORARY_OUTPUT:
+        return os.path.splitext(value.split('|')[0])[1].lower()
+    return bool(value)
+
+
+_source_version = None
+
+
+def source_version():
+    """Digest of the source files of ``dbsim``, computed once per process."""
+    global _source_version
+    if _source_version is None:
+        digest = hashlib.blake2b(digest_size=20)
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            digest.update(os.path.basename(path).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        _source_version = digest.hexdigest()
+    return _source_version
+
+
+def processing_version():
+    """Versions of QGIS and GDAL, which the algorithms of ``processing.run`` come with."""
+    try:
+        from qgis.core import Qgis
+        qgis = Qgis.version()
+    except ImportError:
+        qgis = None
+    from osgeo import gdal
+    return {'qgis': qgis, 'gdal': gdal.VersionInfo()}
+
+
+class ArtifactCache:
+    """Folder of outputs keyed by the digest of the step that made them."""
+
+    def __init__(self, folder=None, max_mb=None):
+        self.folder = folder or default_folder()
+        self.max_bytes = int((CACHE_MB if max_mb is None else max_mb) * 2 ** 20)
+        self.entries = os.path.join(self.folder, 'entries')
+        self._digests = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    # Hashing
+
+    def _digest_index(self):
+        if self._digests is None:
+            try:
+                with open(os.path.join(self.folder, 'digests.json')) as f:
+                    self._digests = json.load(f)
+            except (OSError, ValueError):
+                self._digests = {}
+        return self._digests
+
+    def _save_digest_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.folder, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._digests, f)
+        os.replace(path, os.path.join(self.folder, 'digests.json'))
+
+    def file_digest(self, path):
+        """Digest of the contents of a file and its sidecars, remembered by path, size and modification time."""
+        path = os.path.abspath(path)
+        digest = hashlib.blake2b(digest_size=20)
+        index = self._digest_index()
+        changed = False
+        for name in raster_io.sidecar_files(path):
+            stat = os.stat(name)
+            stamp = [stat.st_size, stat.st_mtime_ns]
+            known = index.get(name)
+            if known is None or known[:2] != stamp:
+                part = hashlib.blake2b(digest_size=20)
+                with open(name, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK), b''):
+                        part.update(chunk)
+                known = stamp + [part.hexdigest()]
+                index[name] = known
+                changed = True
+            digest.update(known[2].encode())
+        if changed:
+            self._save_digest_index()
+        return digest.hexdigest()
+
+    def describe(self, value):
+        """JSON-able description of a parameter, with input files replaced by their digest."""
+        if hasattr(value, 'terms'):
+            return self.describe(value.terms())
+        if hasattr(value, 'getFeatures'):
+            return self._layer_digest(value)
+        if hasattr(value, 'source'):
+            value = value.source()
+        if isinstance(value, dict):
+            return {str(key): self.describe(item) for key, item in sorted(value.items())}
+        if isinstance(value, (list, tuple)):
+            return [self.describe(item) for item in value]
+        if _is_file(value):
+            path, _, layer = value.partition('|')
+            return {'file': self.file_digest(path), 'layer': layer}
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if hasattr(value, 'toString'):
+            return value.toString()
+        raise Uncacheable(f'Cannot hash {value!r}')
+
+    def _layer_digest(self, layer):
+        source = layer.source()
+        if _is_file(source):
+            return self.describe(source)
+        if layer.providerType() != 'memory':
+            raise Uncacheable(f'Cannot hash the layer {layer.name()}')
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(layer.crs().authid().encode())
+        for feature in layer.getFeatures():
+            digest.update(bytes(feature.geometry().asWkb()))
+            digest.update(repr(feature.attributes()).encode())
+        return {'features': digest.hexdigest()}
+
+    def key(self, algorithm, parameters, destinations=(), ignore=(), version=None):
+        """Digest of a step: the algorithm, its parameters, the contents of its inputs and the code.
+
+        Only the format of the ``destinations`` counts (the lower-cased
+        extension of a path, or whether a temporary output is requested), so
+        the same step written elsewhere is still a hit, but not one written
+        to another format; ``ignore`` names the parameters that do not
+        change the result (e.g. a memory budget).
+        ``version`` describes the code running the step besides ``dbsim``
+        (``processing_version`` for ``processing.run``).
+        """
+        described = {}
+        for name, value in parameters.items():
+            if name in ignore:
+                continue
+            if name in destinations or (isinstance(value, str) and value == raster_io.TEMPORARY_OUTPUT):
+                described[name] = _destination_format(value)
+            else:
+                described[name] = self.describe(value)
+        text = json.dumps([algorithm, described, source_version(), version], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    # Entries
+
+    def get(self, key):
+        """Manifest of the entry ``key``, marked as used, or None."""
+        path = os.path.join(self.entries, key, 'manifest.json')
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        os.utime(path, (now, now))
+        return manifest
+
+    def put(self, key, results):
+        """Store the file outputs of a step, returning its manifest.
+
+        ``results`` maps the output names to paths or plain values; a
+        layer object among them raises ``Uncacheable``.
+        """
+        os.makedirs(self.entries, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f'{key}.', dir=self.entries)
+        manifest = {'files': {}, 'values': {}}
+        try:
+            for name, value in results.items():
+                if _is_file(value):
+                    folder = os.path.join(staging, name)
+                    os.makedirs(folder)
+                    for path in raster_io.sidecar_files(value):
+                        shutil.copy2(path, folder)
+                    manifest['files'][name] = os.path.basename(value)
+                elif value is None or isinstance(value, (bool, int, float, str)):
+                    manifest['values'][name] = value
+                else:
+                    raise Uncacheable(f'Output {name} is not a file')
+            with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            try:
+                os.rename(staging, os.path.join(self.entries, key))
+            except OSError:
+                # Stored meanwhile by another process
+                shutil.rmtree(staging, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+        return manifest
+
+    def restore(self, key, manifest, destinations):
+        """Outputs of a stored entry, copied to ``destinations`` (``{name: path}``) or to temporary files."""
+        results = dict(manifest['values'])
+        for name, filename in manifest['files'].items():
+            folder = os.path.join(self.entries, key, name)
+            destination = destinations.get(name)
+            if not destination or destination == raster_io.TEMPORARY_OUTPUT:
+                destination = raster_io.temp_filename(filename)
+            stem = os.path.splitext(destination)[0]
+            for stored in os.listdir(folder):
+                suffix = stored[len(os.path.splitext(filename)[0]):]
+                shutil.copyfile(os.path.join(folder, stored), stem + suffix)
+            results[name] = destination
+        return results
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.entries, '*', '**', '*'), recursive=True)
+                   if os.path.isfile(path))
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its budget."""
+        entries = []
+        for name in os.listdir(self.entries) if os.path.isdir(self.entries) else []:
+            manifest = os.path.join(self.entries, name, 'manifest.json')
+            if not os.path.exists(manifest):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(os.path.join(self.entries, name)) for f in files)
+            entries.append((os.path.getmtime(manifest), size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.entries, name), ignore_errors=True)
+            total -= size
+        return total
+
+
+_shared = None
+
+
+def shared_cache():
+    """The cache configured by ``DBSIM_CACHE_DIR`` and ``DBSIM_CACHE_MB``."""
+    global _shared
+    if _shared is None:
+        max_mb = os.environ.get('DBSIM_CACHE_MB')
+        _shared = ArtifactCache(max_mb=float(max_mb) if max_mb else None)
+    return _shared
+
+
+def _cached(algorithm, parameters, execute, destinations=(), ignore=(), feedback=None, cache=None, version=None):
+    cache = cache or shared_cache()
+    if not cache.enabled:
+        return execute()
+    try:
+        key = cache.key(algorithm, parameters, destinations, ignore, version() if version else None)
+    except Uncacheable:
+        return execute()
+    manifest = cache.get(key)
+    if manifest is not None:
+        if feedback is not None:
+            feedback.pushInfo(f'{algorithm}: reusing the outputs of an identical earlier run ({key[:12]})')
+        return cache.restore(key, manifest, {name: parameters.get(name) for name in destinations})
+    results = execute()
+    try:
+        cache.put(key, results)
+    except (Uncacheable, OSError):
+        pass
+    return results
+
+
+def run(runner, algorithm, parameters, destinations=(), ignore=(), cache=None, **kwargs):
+    """``runner(algorithm, parameters, **kwargs)`` (e.g. ``processing.run``) through the cache.
+
+    ``destinations`` names the output parameters holding paths (outputs
+    set to TEMPORARY_OUTPUT are found on their own); the results of a hit
+    are copied there.
+    """
+    return _cached(algorithm, parameters, lambda: runner(algorithm, parameters, **kwargs),
+                   destinations, ignore, kwargs.get('feedback'), cache, processing_version)
+
+
+def call(function, parameters, feedback=None, destinations=(), ignore=(), cache=None):
+    """Processing style entry point of ``dbsim`` (``function(parameters, feedback)``) through the cache."""
+    algorithm = f'{function.__module__}.{function.__name__}'
+    return _cached(algorithm, parameters, lambda: function(parameters, feedback=feedback),
+                   destinations, ignore, feedback, cache)
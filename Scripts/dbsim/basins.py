@@ -0,0 +1,73 @@
+"""Labelling the basins draining into a set of outlets.
+
+Replacement for the ``grass7:r.stream.basins`` add-on: all outlets are
+walked upstream together, one reverse-flow traversal for every basin. A
+cell takes the label of the first outlet met when following the flow down
+from it, so the basin of an outlet nested upstream of another one is cut
+out of the downstream basin.
+"""
+
+import numpy as np
+
+from . import blocks, raster_io
+from .flow import donors
+
+
+def label_basins(direction, cells, labels):
+    """Label every cell draining into the outlet ``cells`` (flat indices).
+
+    ``labels`` holds the label (e.g. the DB_ID) of each outlet cell; several
+    cells may share a label, like the cells under one bund. Direction uses
+    the GRASS coding of ``flow``. Returns an int32 array of the shape of
+    ``direction`` with 0 where a cell drains into no outlet.
+    """
+    basins = np.zeros(direction.size, dtype=np.int32)
+    frontier = np.asarray(cells, dtype=np.int64).ravel()
+    basins[frontier] = labels
+    frontier = np.unique(frontier)
+    while frontier.size:
+        found, position = donors(direction, frontier)
+        # Labelled cells are outlets of their own basin (or already reached)
+        keep = basins[found] == 0
+        found, position = found[keep], position[keep]
+        basins[found] = basins[frontier[position]]
+        frontier = found
+    return basins.reshape(direction.shape)
+
+
+def outlets_from_raster(outlets, nodata=None):
+    """Outlet cells and labels of a raster holding the label of each outlet and 0 elsewhere."""
+    values = np.where(raster_io.valid_mask(outlets, nodata), outlets, 0).astype(np.int32).ravel()
+    cells = np.flatnonzero(values > 0)
+    return cells, values[cells]
+
+
+def basins_window(basins, margin=2):
+    """Window ``(row, col, rows, cols)`` of the labelled cells of ``basins`` plus ``margin`` cells.
+
+    Everything upstream of the outlets lies inside, so filling and pond
+    computations can run on the window alone. None when no cell is labelled.
+    """
+    return raster_io.data_window(basins > 0, margin)
+
+
+def run_stream_basins(parameters, feedback=None):
+    """Processing style replacement of ``grass7:r.stream.basins``.
+
+    ``direction`` is the flow direction raster (GRASS coding), ``outlets``
+    a raster on the same grid with the label of each outlet cell (0 or
+    nodata elsewhere), for instance the bunds rasterized by their ID, and
+    ``basins`` the destination. Returns ``{'basins': path, 'window': ...}``
+    where ``window`` comes from ``basins_window``.
+    """
+    direction, info = blocks.read_raster(parameters['direction'])
+    outlets, outlets_info = blocks.read_raster(parameters['outlets'])
+    if direction.shape != outlets.shape:
+        raise ValueError('The flow direction and outlet rasters must share the same grid')
+    cells, labels = outlets_from_raster(outlets, outlets_info.nodata)
+    if feedback is not None:
+        feedback.pushInfo(f'Labelling the basins of {np.unique(labels).size} outlets from {cells.size} cells')
+    basins = label_basins(direction, cells, labels)
+    path = raster_io.output_path(parameters.get('basins'), 'basins.tif')
+    raster_io.write_raster(path, basins, info, 0)
+    return {'basins': path, 'window': basins_window(basins)}
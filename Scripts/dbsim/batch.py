@@ -0,0 +1,252 @@
+"""Headless batch runs of the whole bund siting pipeline.
+
+The scripts are chained as a declared graph of stages: every stage names
+the script it runs and where each input comes from, a field of the job or
+an output of an earlier stage. A manifest lists the jobs (one catchment
+each) with their inputs and parameter overrides; the jobs run in a pool
+of processes, each starting QGIS once without a project or an interface,
+and every stage of a job writes its outputs to the folder of the job.
+The run ends with ``summary.json`` holding the status, timings and outputs
+of every stage of every job.
+
+Manifest::
+
+    {"output_folder": "runs/2024-07-01",
+     "parameters": {"simulation": {"Spacing": 60}},
+     "jobs": [{"name": "farm_12", "dem": "farm_12/dem.tif",
+               "fields": "farm_12/fields.gpkg", "catchment": "farm_12/catchment.gpkg",
+               "parameters": {"simulation": {"Height": 2}},
+               "stages": ["simulation"]}]}
+
+Relative paths are read from the folder of the manifest. ``stages`` limits
+a job to some stages and the ones they depend on.
+"""
+
+import importlib.util
+import json
+import os
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+# Input of a stage read from the job manifest
+Job = namedtuple('Job', 'field')
+
+# Input of a stage read from an output of an earlier stage
+Out = namedtuple('Out', 'stage output')
+
+
+class Stage(namedtuple('Stage', 'name script parameters outputs')):
+    """Step of the pipeline: ``script`` run with ``parameters`` writing ``outputs`` (``{name: extension}``)."""
+
+    @property
+    def dependencies(self):
+        return {value.stage for value in self.parameters.values() if isinstance(value, Out)}
+
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PIPELINE = (
+    Stage('terrain', 'D8 Terrain processing.py',
+          {'DEM': Job('dem'), 'ZFactor': 1, 'MinSlope': 0.0, 'Memory': 2000},
+          {'OutputFillDEM': 'tif', 'OutputHshd': 'tif', 'OutputFlowAcc': 'tif', 'OutputFlowDir': 'tif'}),
+    Stage('flowpaths', 'Area threshold.py',
+          {'FilledDEM': Out('terrain', 'OutputFillDEM'), 'FlowAcc': Out('terrain', 'OutputFlowAcc'),
+           'AreaThr': 1, 'Memory': 2000},
+          {'streams_ras': 'tif', 'FlowPaths': 'gpkg', 'flowdir': 'tif'}),
+    Stage('streamreach', 'Stream reach.py',
+          {'FlowNetwork': Out('flowpaths', 'FlowPaths'), 'D8FlowDir': Out('flowpaths', 'flowdir'),
+           'DEMFill': Out('terrain', 'OutputFillDEM'), 'ClassValue': 1},
+          {'OutStreamReach': 'gpkg', 'OutCatchments': 'gpkg'}),
+    Stage('simulation', 'DB simulation tool.py',
+          {'FB': Job('fields'), 'UnfilledDEM': Job('dem'), 'FlowAcc': Out('terrain', 'OutputFlowAcc'),
+           'Flowpaths': Out('flowpaths', 'FlowPaths'), 'Checkbox': True,
+           'StreamReach': Out('streamreach', 'OutStreamReach'), 'CatchmentBoundary': Job('catchment'),
+           'Spacing': 60, 'Height': 3, 'Length': 20, 'Checkbox2': False, 'Z': 1, 'Workers': 0},
+          {'PotentialDB': 'gpkg'}),
+    Stage('catchments', 'DB_catchments.py',
+          {'DB_locations': Out('simulation', 'PotentialDB'), 'FilledDEM': Out('terrain', 'OutputFillDEM'),
+           'FlowDir': Out('terrain', 'OutputFlowDir'), 'Z': 1, 'Polygonize': True},
+          {'Catchments': 'gpkg', 'Depth': 'tif'}),
+)
+
+
+def plan(pipeline, stages=None):
+    """Stages to run, in order, to get ``stages`` (all by default) and everything they depend on."""
+    by_name = {stage.name: stage for stage in pipeline}
+    unknown = set(stages or ()) - set(by_name)
+    if unknown:
+        raise ValueError(f'Unknown stages: {", ".join(sorted(unknown))}')
+    wanted = set(stages or by_name)
+    pending = list(wanted)
+    while pending:
+        for dependency in by_name[pending.pop()].dependencies:
+            if dependency not in wanted:
+                wanted.add(dependency)
+                pending.append(dependency)
+    return [stage for stage in pipeline if stage.name in wanted]
+
+
+def stage_parameters(stage, job, outputs, folder, overrides=None):
+    """Parameters of ``stage`` for ``job``, with the outputs of earlier stages and the destinations in ``folder``."""
+    parameters = {}
+    for name, value in stage.parameters.items():
+        if isinstance(value, Job):
+            if value.field not in job:
+                raise KeyError(f'Job {job.get("name")} has no "{value.field}"')
+            value = job[value.field]
+        elif isinstance(value, Out):
+            value = outputs[value.stage][value.output]
+        parameters[name] = value
+    parameters.update(overrides or {})
+    for name, extension in stage.outputs.items():
+        parameters[name] = os.path.join(folder, f'{stage.name}_{name}.{extension}')
+    return parameters
+
+
+def load_manifest(path):
+    """Jobs of a manifest file, with paths made absolute and the shared parameters merged."""
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    shared = manifest.get('parameters', {})
+    jobs = []
+    for job in manifest['jobs']:
+        job = dict(job)
+        for field in ('dem', 'fields', 'catchment'):
+            if field in job and not os.path.isabs(job[field]):
+                job[field] = os.path.join(base, job[field])
+        parameters = {stage: dict(values) for stage, values in shared.items()}
+        for stage, values in job.get('parameters', {}).items():
+            parameters.setdefault(stage, {}).update(values)
+        job['parameters'] = parameters
+        jobs.append(job)
+    folder = manifest.get('output_folder', 'output')
+    return jobs, folder if os.path.isabs(folder) else os.path.join(base, folder)
+
+
+_qgis = None
+
+
+def start_qgis():
+    """Start QGIS without interface and register the processing providers, once per process."""
+    global _qgis
+    if _qgis is not None:
+        return _qgis
+    from qgis.core import QgsApplication
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', QgsApplication.prefixPath() or '/usr'), True)
+    _qgis = QgsApplication([], False)
+    _qgis.initQgis()
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    from qgis.analysis import QgsNativeAlgorithms
+    if QgsApplication.processingRegistry().providerById('native') is None:
+        QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+    return _qgis
+
+
+def load_algorithm(script):
+    """Algorithm defined in a script of the Scripts folder, without the script provider."""
+    from qgis.core import QgsProcessingAlgorithm
+    path = os.path.join(SCRIPTS, script)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(script)[0].replace(' ', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for value in vars(module).values():
+        if isinstance(value, type) and issubclass(value, QgsProcessingAlgorithm) and value.__module__ == module.__name__:
+            algorithm = value()
+            algorithm.initAlgorithm()
+            return algorithm
+    raise ValueError(f'{script} does not define a processing algorithm')
+
+
+def _feedback(log_path):
+    from qgis.core import QgsProcessingFeedback
+
+    class LogFeedback(QgsProcessingFeedback):
+        """Feedback writing the messages of the algorithms to the log of the job."""
+
+        def __init__(self):
+            super().__init__()
+            self.log = open(log_path, 'a')
+
+        def pushInfo(self, info):
+            self.log.write(f'{info}\n')
+
+        def pushWarning(self, warning):
+            self.log.write(f'WARNING {warning}\n')
+
+        def reportError(self, error, fatalError=False):
+            self.log.write(f'ERROR {error}\n')
+
+    return LogFeedback()
+
+
+def run_job(job, folder, pipeline=PIPELINE):
+    """Run the stages of one job in this process, returning its summary."""
+    import processing
+    from qgis.core import QgsProcessingContext
+    start_qgis()
+    folder = os.path.join(folder, job['name'])
+    os.makedirs(folder, exist_ok=True)
+    feedback = _feedback(os.path.join(folder, 'log.txt'))
+    summary = {'name': job['name'], 'status': 'ok', 'stages': []}
+    outputs = {}
+    started = time.time()
+    try:
+        for stage in plan(pipeline, job.get('stages')):
+            stage_started, cpu_started = time.time(), time.process_time()
+            record = {'name': stage.name, 'script': stage.script}
+            summary['stages'].append(record)
+            try:
+                parameters = stage_parameters(stage, job, outputs, folder, job['parameters'].get(stage.name))
+                feedback.pushInfo(f'--- {stage.name}: {stage.script}')
+                context = QgsProcessingContext()
+                results = processing.run(load_algorithm(stage.script), parameters, context=context, feedback=feedback)
+                outputs[stage.name] = {name: results.get(name) or parameters[name] for name in stage.outputs}
+                record.update(status='ok', outputs=outputs[stage.name])
+            except Exception as e:
+                record.update(status='failed', error=f'{type(e).__name__}: {e}')
+                feedback.pushInfo(traceback.format_exc())
+                summary['status'] = 'failed'
+                break
+            finally:
+                record['seconds'] = round(time.time() - stage_started, 3)
+                record['cpu_seconds'] = round(time.process_time() - cpu_started, 3)
+    finally:
+        feedback.log.close()
+    summary['seconds'] = round(time.time() - started, 3)
+    return summary
+
+
+def run_manifest(path, workers=1, summary_path=None):
+    """Run every job of a manifest, ``workers`` at a time, and write the JSON summary of the run.
+
+    Returns the summary. A failed job does not stop the others.
+    """
+    jobs, folder = load_manifest(path)
+    os.makedirs(folder, exist_ok=True)
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('Job names must be unique, they name the output folders')
+    started = time.time()
+    summary = {'manifest': os.path.abspath(path), 'output_folder': folder, 'workers': workers,
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'jobs': []}
+    if workers <= 1:
+        summary['jobs'] = [run_job(job, folder) for job in jobs]
+    else:
+        from .candidates import _context
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_context()) as pool:
+            futures = [pool.submit(run_job, job, folder) for job in jobs]
+            for job, future in zip(jobs, futures):
+                try:
+                    summary['jobs'].append(future.result())
+                except Exception as e:
+                    summary['jobs'].append({'name': job['name'], 'status': 'failed', 'error': f'{type(e).__name__}: {e}', 'stages': []})
+    summary['seconds'] = round(time.time() - started, 3)
+    summary['failed'] = [job['name'] for job in summary['jobs'] if job['status'] != 'ok']
+    summary_path = summary_path or os.path.join(folder, 'summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
@@ -0,0 +1,453 @@
+"""Benchmarks of the array engines on synthetic terrains.
+
+Every case generates a terrain of a given kind and size from a fixed seed
+and runs the stages of a simulation on it with the engines of ``dbsim``:
+sink filling, D8 accumulation, extraction of the 2 to 50 ha streams,
+stations along them, candidate and transect evaluation, overlap
+suppression of the bunds and the stage-storage volumes behind them. Each
+stage records its wall and CPU time, memory and throughput (cells/s, or
+candidates/s for the point stages), and a few checks on the known
+drainage of the terrain make sure a faster engine still routes the water
+the same way. Cases run one at a time in a fresh process, so the peak
+memory of a case is its own.
+
+Only NumPy and GDAL are needed (numba when installed), so it runs headless
+next to QGIS or on a plain Linux box::
+
+    python -m dbsim.benchmark --sizes 1000 2000 --output before.json
+    python -m dbsim.benchmark --sizes 1000 2000 --output after.json --compare before.json
+
+Results hold the commit, versions and machine; comparing two result files
+lists the stages whose time grew past ``--tolerance``. Terrains of 10000
+and 20000 cells a side need about 8 and 30 GB of memory.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import blocks, candidates, fill, flow, profiling, raster_io, selection, stations, storage, transects
+from .raster_io import RasterInfo
+
+TERRAIN_SIZES = (1000, 2000, 5000, 10000, 20000)
+DEFAULT_SIZES = (1000, 2000)
+
+CELLSIZE = 1.0
+
+# Defaults of the simulation tool
+SPACING = 60.0
+HEIGHT = 3.0
+LENGTH = 20.0
+AREA_RANGE = (2, 50)
+
+# Rows generated at a time
+GENERATE_ROWS = 1024
+
+# Stages shorter than this are compared but never reported as regressions (timer noise)
+MIN_SECONDS = 0.05
+
+
+def _upsample_add(out, coarse, amplitude):
+    """Add ``coarse`` bilinearly stretched over ``out`` times ``amplitude``, by blocks of rows."""
+    rows, cols = out.shape
+    cr, cc = coarse.shape
+    c = np.linspace(0, cc - 1.0, cols)
+    c0 = np.minimum(c.astype(np.int64), cc - 2)
+    wc = (c - c0).astype(np.float32)
+    r = np.linspace(0, cr - 1.0, rows)
+    r0 = np.minimum(r.astype(np.int64), cr - 2)
+    wr = (r - r0).astype(np.float32)[:, None]
+    for start in range(0, rows, GENERATE_ROWS):
+        block = slice(start, start + GENERATE_ROWS)
+        top = coarse[r0[block]]
+        bottom = coarse[r0[block] + 1]
+        lines = top + (bottom - top) * wr[block]
+        out[block] += amplitude * (lines[:, c0] + (lines[:, c0 + 1] - lines[:, c0]) * wc)
+
+
+def fractal(size, rng, amplitude, persistence=0.5, finest=4):
+    """Value noise summed over octaves, from half the terrain down to ``finest`` cells."""
+    out = np.zeros((size, size), dtype=np.float32)
+    cell = size / 2
+    weight = 1.0
+    while cell >= finest:
+        n = int(math.ceil(size / cell)) + 2
+        _upsample_add(out, rng.standard_normal((n, n)).astype(np.float32), amplitude * weight)
+        cell /= 2
+        weight *= persistence
+    return out
+
+
+def _tilted(size, slope=0.02):
+    # Regional slope down to the south edge
+    return ((size - np.arange(size, dtype=np.float32)) * CELLSIZE * slope)[:, None]
+
+
+def hills(size, rng):
+    """Fractal hills on a regional slope."""
+    dem = fractal(size, rng, 15.0)
+    dem += _tilted(size)
+    return dem, None
+
+
+def gullies(size, rng):
+    """Valleys draining into meandering V gullies that run north to south.
+
+    The valley sides slope down to the nearest gully, so all the streams
+    should follow the gully floors, returned as the known channels.
+    """
+    dem = fractal(size, rng, 2.0, finest=16)
+    dem += _tilted(size)
+    count = max(size // 250, 2)
+    depth, half_width, side_slope = 5.0, 6.0, 0.05
+    centres = (np.arange(count) + 0.5) * size / count
+    phase = rng.uniform(0, 2 * np.pi, count)
+    wavelength = rng.uniform(200, 400, count)
+    amplitude = min(size / count / 4, 30.0)
+    channels = np.zeros((size, size), dtype=bool)
+    cols = np.arange(size, dtype=np.float32)
+    for start in range(0, size, GENERATE_ROWS):
+        rows = np.arange(start, min(start + GENERATE_ROWS, size), dtype=np.float32)
+        nearest = np.full((rows.size, size), np.inf, dtype=np.float32)
+        for centre, p, w in zip(centres, phase, wavelength):
+            axis = centre + amplitude * np.sin(2 * np.pi * rows / w + p)
+            np.minimum(nearest, np.abs(cols[None, :] - axis[:, None]), out=nearest)
+        dem[start:start + rows.size] += side_slope * CELLSIZE * nearest - depth * np.clip(1 - nearest / half_width, 0, None)
+        channels[start:start + rows.size] = nearest <= 1
+    return dem, channels
+
+
+def flats(size, rng):
+    """Hills cut into 1 m terraces, most of the terrain lying on flats."""
+    dem, _ = hills(size, rng)
+    np.floor(dem, out=dem)
+    return dem, None
+
+
+def pits(size, rng):
+    """Hills pitted with a depression every 50 x 50 cells on average."""
+    dem, _ = hills(size, rng)
+    count = size * size // 2500
+    rows, cols = rng.integers(0, size, count), rng.integers(0, size, count)
+    radii, depths = rng.integers(2, 13, count), rng.uniform(0.5, 3.0, count)
+    for r, c, radius, depth in zip(rows, cols, radii, depths):
+        r0, r1, c0, c1 = max(r - radius, 0), min(r + radius + 1, size), max(c - radius, 0), min(c + radius + 1, size)
+        dr = np.arange(r0, r1)[:, None] - r
+        dc = np.arange(c0, c1)[None, :] - c
+        dem[r0:r1, c0:c1] -= (depth * np.clip(1 - (dr ** 2 + dc ** 2) / radius ** 2, 0, None)).astype(np.float32)
+    return dem, None
+
+
+TERRAINS = {'hills': hills, 'gullies': gullies, 'flats': flats, 'pits': pits}
+
+
+def terrain_info(size):
+    """Georeference of a synthetic terrain: ``CELLSIZE`` cells from the origin, no projection."""
+    return RasterInfo((0.0, CELLSIZE, 0.0, size * CELLSIZE, 0.0, -CELLSIZE), '', -9999.0, (size, size))
+
+
+def stream_parts(direction, streams, info):
+    """Polylines of the stream cells, one per reach between heads and junctions, as cell centres.
+
+    Every reach starts at a stream cell with no or several stream cells
+    draining into it and ends at the first cell starting another reach.
+    """
+    recv = flow.receivers(direction)
+    stream = streams.ravel()
+    linked = stream & (recv >= 0)
+    linked[linked] = stream[recv[linked]]
+    inflow = np.bincount(recv[linked], minlength=stream.size)
+    starts = np.flatnonzero(stream & (inflow != 1))
+    part = np.arange(starts.size)
+    cells, parts, order = [starts], [part], [np.zeros(starts.size, dtype=np.int64)]
+    current, step = starts, 0
+    while current.size:
+        step += 1
+        following = linked[current]
+        current, part = recv[current[following]], part[following]
+        cells.append(current)
+        parts.append(part)
+        order.append(np.full(current.size, step, dtype=np.int64))
+        # A reach ends on the first cell of the next one
+        going = inflow[current] == 1
+        current, part = current[going], part[going]
+    cells, parts, order = np.concatenate(cells), np.concatenate(parts), np.concatenate(order)
+    ordered = np.lexsort((order, parts))
+    cells, parts = cells[ordered], parts[ordered]
+    gt = info.geotransform
+    r, c = np.divmod(cells, info.shape[1])
+    x, y = gt[0] + (c + 0.5) * gt[1], gt[3] + (r + 0.5) * gt[5]
+    bounds = np.flatnonzero(np.diff(parts)) + 1
+    return [list(zip(px, py)) for px, py in zip(np.split(x, bounds), np.split(y, bounds)) if px.size > 1]
+
+
+def bund_cells(xl, yl, xr, yr, info):
+    """Flat indices of the cells under the bund lines and the index of their line."""
+    step = info.cellsize / 2
+    n = max(int(math.ceil(LENGTH / step)), 1)
+    t = np.linspace(0, 1, n + 1)
+    x = xl[:, None] + (xr - xl)[:, None] * t
+    y = yl[:, None] + (yr - yl)[:, None] * t
+    gt = info.geotransform
+    r = np.floor((y - gt[3]) / gt[5]).astype(np.int64)
+    c = np.floor((x - gt[0]) / gt[1]).astype(np.int64)
+    line = np.repeat(np.arange(xl.size), t.size).reshape(r.shape)
+    inside = (r >= 0) & (r < info.shape[0]) & (c >= 0) & (c < info.shape[1])
+    return r[inside] * info.shape[1] + c[inside], line[inside]
+
+
+class _Console:
+    """Feedback printing the messages, for the stages that report progress."""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def pushInfo(self, info):
+        if self.verbose:
+            print(info, flush=True)
+
+    def setProgress(self, progress):
+        pass
+
+    def isCanceled(self):
+        return False
+
+
+def run_case(terrain, size, seed=0, workers=0, verbose=False):
+    """Generate one terrain and run every stage on it, returning the record of the case."""
+    rng = np.random.default_rng(seed)
+    feedback = _Console(verbose)
+    started = time.perf_counter()
+    dem, channels = TERRAINS[terrain](size, rng)
+    generated = time.perf_counter() - started
+    info = terrain_info(size)
+    cells = dem.size
+    folder = tempfile.mkdtemp(prefix='dbsim_benchmark_')
+    profiler = profiling.Profiler(feedback, f'{terrain} {size}')
+    counts = {}
+    try:
+        profiler.start('fill')
+        filled = fill.fill_depressions(dem, info.nodata, 0.0, info.cellsize)
+        profiler.finish()
+        counts['fill'] = cells, 'cells'
+
+        profiler.start('accumulation')
+        acc, direction = flow.d8_accumulation(filled, info.nodata)
+        profiler.finish()
+        counts['accumulation'] = cells, 'cells'
+
+        profiler.start('streams')
+        area = acc * (info.cell_area / 10000)
+        streams = (area >= AREA_RANGE[0]) & (area <= AREA_RANGE[1])
+        parts = stream_parts(direction, streams, info)
+        profiler.finish()
+        counts['streams'] = cells, 'cells'
+
+        profiler.start('stations')
+        points = stations.stations(parts, SPACING) if parts else None
+        profiler.finish()
+        n = 0 if points is None else points.x.size
+        counts['stations'] = n, 'candidates'
+
+        # Rasters read by the candidate and storage stages, written outside the timings
+        dem_path = raster_io.write_raster(os.path.join(folder, 'dem.tif'), dem, info, info.nodata)
+        acc_path = raster_io.write_raster(os.path.join(folder, 'acc.tif'), acc, info)
+        filled_path = raster_io.write_raster(os.path.join(folder, 'filled.tif'), filled, info, info.nodata)
+        direction_path = raster_io.write_raster(os.path.join(folder, 'direction.tif'), direction, info, 0)
+        del area
+
+        bunds = 0
+        if n:
+            profiler.start('transects', dem_path, acc_path)
+            evaluated = candidates.evaluate(acc_path, dem_path, points.x, points.y, points.l_perp, points.part + 1,
+                                            [HEIGHT], [LENGTH / 2], info.cell_area / 10000, AREA_RANGE,
+                                            workers=workers, feedback=feedback)
+            profiler.finish()
+            counts['transects'] = n, 'candidates'
+
+            profiler.start('overlaps')
+            _, _, index = selection.scenario_matrix(evaluated.keep, evaluated.left_range, evaluated.right_range, [HEIGHT])
+            xl, yl, xr, yr = transects.line_ends(points.x[index], points.y[index], points.l_perp[index], LENGTH / 2)
+            keep = selection.suppress_overlaps(xl, yl, xr, yr, evaluated.contr_area[index])
+            profiler.finish()
+            counts['overlaps'] = len(index), 'candidates'
+
+            xl, yl, xr, yr = xl[keep], yl[keep], xr[keep], yr[keep]
+            bunds = int(keep.sum())
+        if bunds:
+            outlets = np.zeros(cells, dtype=np.int32)
+            under, line = bund_cells(xl, yl, xr, yr, info)
+            outlets[under] = line + 1
+            outlets_path = raster_io.write_raster(os.path.join(folder, 'outlets.tif'), outlets.reshape(dem.shape), info, 0)
+            del outlets
+
+            profiler.start('volumes', filled_path, direction_path, outlets_path)
+            volumes = storage.run_stage_storage({'DEM': filled_path, 'DIRECTION': direction_path, 'OUTLETS': outlets_path,
+                                                 'BUNDS': [(label, label, HEIGHT) for label in range(1, bunds + 1)]}, feedback)
+            profiler.finish(list(volumes['PONDS'].values()))
+            counts['volumes'] = bunds, 'bunds'
+
+        checks = drainage_checks(dem, filled, direction, acc, streams, channels)
+        checks['bunds'] = bunds
+    finally:
+        blocks.release()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    stages = []
+    for record in profiler.stages:
+        items, unit = counts[record.name]
+        stage = record._asdict()
+        stage.update(items=items, unit=unit, rate=items / record.wall if record.wall > 0 else None)
+        stages.append(stage)
+    rss, peak = profiling.memory()
+    return {'terrain': terrain, 'size': size, 'seed': seed, 'cells': cells, 'generate': generated,
+            'peak_rss': peak, 'checks': checks, 'stages': stages}
+
+
+def drainage_checks(dem, filled, direction, acc, streams, channels=None):
+    """Checks of the routing: nothing left undrained, all the water leaving the raster, streams in the known channels."""
+    valid = raster_io.valid_mask(dem)
+    checks = {
+        'filled_below_dem': int((filled[valid] < dem[valid]).sum()),
+        'undrained_cells': int((valid & (direction == 0)).sum()),
+        # Every valid cell ends in one cell draining out of the raster
+        'outflow_balance': float(acc[direction < 0].sum() / valid.sum()),
+        'stream_cells': int(streams.sum()),
+    }
+    if channels is not None:
+        near = channels.copy()
+        for code in range(1, 9):
+            near |= flow._shifted(channels, code, False)
+        checks['streams_in_channels'] = float((streams & near).sum() / max(int(streams.sum()), 1))
+    return checks
+
+
+def warm_up(workers=0):
+    """Run the stages once on a small terrain, so compiling the numba kernels stays out of the timings."""
+    run_case('pits', 256, workers=workers)
+
+
+def _case_in_process(terrain, size, seed, workers, verbose):
+    warm_up(workers)
+    return run_case(terrain, size, seed, workers, verbose)
+
+
+def _commit():
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=folder, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=folder, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty.strip())
+
+
+def environment():
+    """Commit, versions and machine of a benchmark run."""
+    commit, dirty = _commit()
+    try:
+        from osgeo import gdal
+        gdal_version = gdal.__version__
+    except (ImportError, AttributeError):
+        gdal_version = None
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {'commit': commit, 'dirty': dirty, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'gdal': gdal_version, 'numba': numba_version,
+            'platform': platform.platform(), 'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()}
+
+
+def run_suite(terrains=tuple(TERRAINS), sizes=DEFAULT_SIZES, seed=0, workers=0, isolate=True, verbose=False):
+    """Run every terrain at every size, each case in a fresh process unless ``isolate`` is False."""
+    results = {'environment': environment(), 'parameters': {'seed': seed, 'workers': workers, 'cellsize': CELLSIZE,
+               'spacing': SPACING, 'height': HEIGHT, 'length': LENGTH, 'area_range': AREA_RANGE}, 'cases': []}
+    if not isolate:
+        warm_up(workers)
+    for size in sizes:
+        for terrain in terrains:
+            print(f'{terrain} {size} x {size}', flush=True)
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1, mp_context=candidates._context()) as pool:
+                    case = pool.submit(_case_in_process, terrain, size, seed, workers, verbose).result()
+            else:
+                case = run_case(terrain, size, seed, workers, verbose)
+            results['cases'].append(case)
+            for stage in case['stages']:
+                print(f'  {stage["name"]:<13}{stage["wall"]:9.2f} s{stage["rate"] or 0:14,.0f} {stage["unit"]}/s'
+                      f'{stage["peak_rss"] / 2 ** 20:9.0f} MB', flush=True)
+    return results
+
+
+def compare(before, after, tolerance=1.25):
+    """Stages of ``after`` slower than in ``before`` by more than ``tolerance`` times, and changed checks.
+
+    Returns ``(rows, regressions)``, rows being ``(case, stage, before, after, ratio)``.
+    """
+    def stages(results):
+        return {(case['terrain'], case['size'], stage['name']): stage['wall']
+                for case in results['cases'] for stage in case['stages']}
+
+    def checks(results):
+        return {(case['terrain'], case['size']): case['checks'] for case in results['cases']}
+
+    old, new = stages(before), stages(after)
+    rows, regressions = [], []
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] > 0 else float('inf')
+        rows.append((f'{key[0]} {key[1]}', key[2], old[key], new[key], ratio))
+        if ratio > tolerance and new[key] > MIN_SECONDS:
+            regressions.append(f'{key[0]} {key[1]} {key[2]}: {ratio:.2f}x slower')
+    old_checks, new_checks = checks(before), checks(after)
+    for key in sorted(set(old_checks) & set(new_checks)):
+        for name, value in new_checks[key].items():
+            known = old_checks[key].get(name)
+            if known is not None and not math.isclose(known, value, rel_tol=1e-6):
+                regressions.append(f'{key[0]} {key[1]} {name}: {known} -> {value}')
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m dbsim.benchmark', description='Benchmark the dbsim engines on synthetic terrains.')
+    parser.add_argument('--terrains', nargs='+', choices=sorted(TERRAINS), default=list(TERRAINS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES), help=f'cells a side, e.g. {TERRAIN_SIZES}')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=0, help='processes evaluating the candidates (0 runs them in the case process)')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown reported as a regression')
+    parser.add_argument('--inline', action='store_true', help='run the cases in this process')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.terrains, args.sizes, args.seed, args.workers, not args.inline, args.verbose)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        before = json.load(f)
+    rows, regressions = compare(before, results, args.tolerance)
+    print(f'\nCompared with {before["environment"].get("commit")}')
+    for case, stage, old, new, ratio in rows:
+        print(f'  {case:<14}{stage:<13}{old:9.2f} s{new:9.2f} s{ratio:7.2f}x')
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
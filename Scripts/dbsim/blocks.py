@@ -0,0 +1,201 @@
+"""Shared reader of raster blocks with an LRU cache.
+
+The stages of a run read the same DEM, flow accumulation and flow
+direction rasters again and again (sampling points, transects, filling,
+labelling basins, cropping). ``BlockCache`` opens every raster once and
+keeps the blocks it decoded, up to a memory budget, dropping the least
+recently used ones first. Blocks follow the native blocks of the file
+(tiles, or strips grouped into blocks of a useful size), so a cached block
+is decoded exactly once. Windows are assembled from the blocks, so a
+window read twice is served from memory. Whole rasters are read straight
+through GDAL and not cached, which would hold the raster twice, once in
+the caller's array and once in its blocks.
+
+Datasets are read under a lock of their own and the cache under another
+one, and GDAL releases the GIL while decoding, so threads reading
+different rasters do not wait for each other. A block is dropped when the
+file it came from changes on disk. Each process has its own cache; the
+process pool of ``candidates`` maps its rasters with ``numpy.memmap``
+instead.
+"""
+
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from . import raster_io
+
+# Smallest cached block; strips of the native block size are grouped up to it
+MIN_BLOCK_CELLS = 2 ** 16
+
+# Memory budget of the shared cache
+CACHE_MB = 1024
+
+
+class CacheStats(namedtuple('CacheStats', 'hits misses bytes_read cached_bytes')):
+    """Block reads served from memory (``hits``) or decoded from disk (``misses``)."""
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class BlockCache:
+    """LRU cache of the blocks of raster bands, holding at most ``max_mb``."""
+
+    def __init__(self, max_mb=CACHE_MB):
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.blocks = OrderedDict()
+        self.datasets = {}
+        self.cached_bytes = 0
+        self.hits = self.misses = self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def _dataset(self, path):
+        # (dataset, lock, info, block shape) of a path, opened again with its blocks dropped when the file changed
+        signature = _signature(path)
+        with self._lock:
+            entry = self.datasets.get(path)
+            if entry is not None and entry[-1] == signature:
+                return entry[:-1]
+            if entry is not None:
+                self._forget(path)
+        ds = raster_io.open_raster(path)
+        entry = (ds, threading.Lock(), raster_io.raster_info(path), block_shape(ds), signature)
+        with self._lock:
+            self.datasets[path] = entry
+        return entry[:-1]
+
+    def _forget(self, path):
+        for key in [key for key in self.blocks if key[0] == path]:
+            self.cached_bytes -= self.blocks.pop(key).nbytes
+        self.datasets.pop(path, None)
+
+    def info(self, raster):
+        """``RasterInfo`` of a raster layer or path."""
+        return self._dataset(raster_io.source_path(raster))[2]
+
+    def _block(self, path, dataset, band, block_row, block_col):
+        key = (path, band, block_row, block_col)
+        with self._lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+        ds, ds_lock, info, (block_rows, block_cols) = dataset
+        rows, cols = info.shape
+        row, col = block_row * block_rows, block_col * block_cols
+        with ds_lock:
+            block = raster_io.read_window(ds, row, col, min(block_rows, rows - row), min(block_cols, cols - col), band)
+        block.setflags(write=False)
+        with self._lock:
+            self.misses += 1
+            self.bytes_read += block.nbytes
+            if block.nbytes <= self.max_bytes and key not in self.blocks:
+                self.blocks[key] = block
+                self.cached_bytes += block.nbytes
+                while self.cached_bytes > self.max_bytes:
+                    self.cached_bytes -= self.blocks.popitem(last=False)[1].nbytes
+        return block
+
+    def read_window(self, raster, row, col, rows, cols, band=1):
+        """Copy of a ``rows`` x ``cols`` window starting at (``row``, ``col``), assembled from cached blocks."""
+        path = raster_io.source_path(raster)
+        # Checked once per window, so the blocks of a file changed on disk are not served
+        dataset = self._dataset(path)
+        block_rows, block_cols = dataset[3]
+        out = None
+        for block_row in range(row // block_rows, (row + rows - 1) // block_rows + 1):
+            for block_col in range(col // block_cols, (col + cols - 1) // block_cols + 1):
+                block = self._block(path, dataset, band, block_row, block_col)
+                if out is None:
+                    out = np.empty((rows, cols), dtype=block.dtype)
+                r0, c0 = block_row * block_rows, block_col * block_cols
+                r1, c1 = max(row, r0), max(col, c0)
+                r2, c2 = min(row + rows, r0 + block.shape[0]), min(col + cols, c0 + block.shape[1])
+                out[r1 - row:r2 - row, c1 - col:c2 - col] = block[r1 - r0:r2 - r0, c1 - c0:c2 - c0]
+        return out
+
+    def read_raster(self, raster, band=1, dtype=None):
+        """Whole band, returning ``(array, RasterInfo)`` like ``raster_io.read_raster``.
+
+        Read straight through the open dataset, bypassing the blocks.
+        """
+        ds, ds_lock, info, _ = self._dataset(raster_io.source_path(raster))
+        with ds_lock:
+            array = raster_io.read_window(ds, 0, 0, info.shape[0], info.shape[1], band)
+        with self._lock:
+            self.bytes_read += array.nbytes
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array, info
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(self.hits, self.misses, self.bytes_read, self.cached_bytes)
+
+    def clear(self):
+        """Drop every block and the references to the datasets, and reset the counters.
+
+        GDAL closes a dataset once no reader still holds it.
+        """
+        with self._lock:
+            self.blocks.clear()
+            self.datasets.clear()
+            self.cached_bytes = 0
+            self.hits = self.misses = self.bytes_read = 0
+
+
+_shared = BlockCache()
+
+
+def block_shape(ds, band=1):
+    """``(rows, cols)`` of the cached blocks of a dataset: its native blocks, strips grouped up to ``MIN_BLOCK_CELLS``."""
+    cols, rows = ds.GetRasterBand(band).GetBlockSize()
+    rows *= max(-(-MIN_BLOCK_CELLS // (rows * cols)), 1)
+    return min(rows, ds.RasterYSize), min(cols, ds.RasterXSize)
+
+
+def shared_cache():
+    """The cache shared by the engines of this process."""
+    return _shared
+
+
+def read_window(raster, row, col, rows, cols, band=1):
+    return _shared.read_window(raster, row, col, rows, cols, band)
+
+
+def read_raster(raster, band=1, dtype=None):
+    return _shared.read_raster(raster, band, dtype)
+
+
+def raster_info(raster):
+    return _shared.info(raster)
+
+
+def report(feedback=None):
+    """Push the hit rate and bytes read of the shared cache, returning its ``CacheStats``."""
+    stats = _shared.stats()
+    if feedback is not None:
+        feedback.pushInfo(f'Raster block cache: {100 * stats.hit_rate:.1f}% hits over {stats.hits + stats.misses} block reads, '
+                          f'{stats.bytes_read / 2 ** 20:.1f} MB read from disk')
+    return stats
+
+
+def release(feedback=None):
+    """Report and empty the shared cache at the end of a run, dropping the rasters it held open."""
+    stats = report(feedback)
+    _shared.clear()
+    return stats
@@ -0,0 +1,231 @@
+"""Evaluation of candidate bund points, reach by reach, optionally in a process pool.
+
+Sampling the contributing area and elevation, the elevation-drop filter
+and the transect profiles of a point only involve the points of its own
+reach, so the reaches are split into spatially compact chunks of about the
+same number of points and evaluated independently. With several workers the chunks run in
+a ``ProcessPoolExecutor``; the rasters are copied once to uncompressed
+``.npy`` files that every worker maps read-only, so they are neither
+pickled nor decoded again per chunk. The chunk results are merged in the
+input order, and the overlap between bunds of different reaches is left
+to the caller.
+"""
+
+import multiprocessing
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import blocks, raster_io, sample
+from .selection import elevation_drop_filter
+from .transects import Transects, transect_coordinates
+
+# Rows copied at a time when sharing a raster
+SHARE_ROWS = 1024
+
+
+class SharedRaster(namedtuple('SharedRaster', 'path info')):
+    """Raster copied to an uncompressed ``.npy`` file that the workers map read-only."""
+
+    def array(self):
+        return np.load(self.path, mmap_mode='r')
+
+
+class Candidates(namedtuple('Candidates', 'contr_area elevation candidate keep left_range right_range')):
+    """Evaluated points: sampled values, ``candidate`` mask, ``(H, n)`` drop filter ``keep`` and ``(L, n)`` bank ranges.
+
+    ``keep`` and the ranges are only computed for the candidates (False and
+    NaN elsewhere).
+    """
+
+
+def share_raster(raster, name):
+    """Copy a raster layer or path to a ``.npy`` file in blocks of rows."""
+    info = raster_io.raster_info(raster)
+    rows, cols = info.shape
+    ds = raster_io.open_raster(raster)
+    first = raster_io.read_window(ds, 0, 0, min(SHARE_ROWS, rows), cols)
+    path = raster_io.temp_filename(f'{name}.npy')
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=first.dtype, shape=(rows, cols))
+    array[:first.shape[0]] = first
+    for row in range(first.shape[0], rows, SHARE_ROWS):
+        block = raster_io.read_window(ds, row, 0, min(SHARE_ROWS, rows - row), cols)
+        array[row:row + block.shape[0]] = block
+    array.flush()
+    ds = array = None
+    return SharedRaster(path, info)
+
+
+def _sample(source, x, y):
+    if isinstance(source, SharedRaster):
+        return sample.sample_array(source.array(), source.info, x, y)
+    return sample.sample_raster(source, x, y)
+
+
+def _cellsize(source):
+    info = source.info if isinstance(source, SharedRaster) else blocks.raster_info(source)
+    return info.cellsize
+
+
+def evaluate_chunk(flowacc, dem, x, y, angle, reach, heights, half_lengths, scale, area_range=(2, 50)):
+    """Evaluate the points of whole reaches.
+
+    ``flowacc`` and ``dem`` are raster layers, paths or ``SharedRaster``;
+    the contributing area is the sampled accumulation times ``scale`` and
+    candidates are the points on a reach (``reach`` > 0) with a
+    contributing area inside ``area_range``. Returns ``Candidates``.
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    angle, reach = np.asarray(angle, dtype=np.float64), np.asarray(reach, dtype=np.float64)
+    heights, half_lengths = np.atleast_1d(heights), np.atleast_1d(half_lengths)
+    n = x.size
+    contr_area = _sample(flowacc, x, y) * scale
+    elevation = _sample(dem, x, y)
+    with np.errstate(invalid='ignore'):
+        candidate = (reach > 0) & (contr_area > area_range[0]) & (contr_area < area_range[1])
+    keep = np.zeros((heights.size, n), dtype=bool)
+    left_range = np.full((half_lengths.size, n), np.nan)
+    right_range = np.full((half_lengths.size, n), np.nan)
+    index = np.flatnonzero(candidate)
+    if index.size:
+        keep[:, index] = elevation_drop_filter(reach[index], contr_area[index], elevation[index], heights)
+        # The longest transect is sampled once; the shorter ones are read from its profile
+        offsets, tx, ty = transect_coordinates(x[index], y[index], angle[index], half_lengths.max(), _cellsize(dem) / 2)
+        profiles = Transects(offsets, _sample(dem, tx, ty), offsets.size // 2)
+        left_range[:, index], right_range[:, index] = profiles.ranges(half_lengths)
+    return Candidates(contr_area, elevation, candidate, keep, left_range, right_range)
+
+
+def _evaluate_task(task):
+    index, args = task
+    return index, evaluate_chunk(*args)
+
+
+def _spread_bits(values):
+    # Bits of 16 bit integers moved to the even positions, to interleave two of them into a Morton code
+    values = values.astype(np.uint64)
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton_order(x, y):
+    """Indices sorting the points ``(x, y)`` along a Morton (Z-order) curve over their extent."""
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if not x.size:
+        return np.zeros(0, dtype=np.int64)
+
+    def quantized(values):
+        low, span = values.min(), np.ptp(values)
+        return np.zeros(values.size) if span == 0 else np.round((values - low) / span * 0xFFFF)
+
+    code = _spread_bits(quantized(x)) | (_spread_bits(quantized(y)) << np.uint64(1))
+    return np.argsort(code, kind='stable')
+
+
+def reach_chunks(reach, chunks, x=None, y=None):
+    """Split the point indices into at most ``chunks`` groups of whole reaches of similar size.
+
+    With the coordinates of the points the groups are also spatially
+    compact: the reaches are ordered along a Morton curve through the
+    centres of their bounding boxes and the curve is cut into runs of
+    similar numbers of points, so the window each worker gathers from stays
+    near its own reaches. Points off the reaches (``reach`` <= 0) do not
+    depend on each other and are placed one by one.
+    """
+    reach = np.asarray(reach)
+    if x is not None and y is not None:
+        return _compact_chunks(reach, chunks, np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    labels, inverse, counts = np.unique(reach, return_inverse=True, return_counts=True)
+    chunks = max(min(int(chunks), labels.size), 1)
+    # Largest reaches first, each to the lightest chunk
+    load = np.zeros(chunks, dtype=np.int64)
+    chunk_of = np.empty(labels.size, dtype=np.int64)
+    for label in np.argsort(-counts, kind='stable'):
+        chunk = int(np.argmin(load))
+        chunk_of[label] = chunk
+        load[chunk] += counts[label]
+    point_chunk = chunk_of[inverse.ravel()]
+    return [np.flatnonzero(point_chunk == chunk) for chunk in range(chunks) if load[chunk]]
+
+
+def _compact_chunks(reach, chunks, x, y):
+    # Units of work: whole reaches, and every point off the reaches on its own
+    on = reach > 0
+    labels, inverse = np.unique(reach[on], return_inverse=True)
+    unit = np.empty(reach.size, dtype=np.int64)
+    unit[on] = inverse.ravel()
+    unit[~on] = labels.size + np.arange(np.count_nonzero(~on))
+    units = labels.size + np.count_nonzero(~on)
+    if not units:
+        return []
+    counts = np.bincount(unit, minlength=units)
+    chunks = max(min(int(chunks), units), 1)
+    bounds = [np.full(units, np.inf), np.full(units, -np.inf), np.full(units, np.inf), np.full(units, -np.inf)]
+    np.minimum.at(bounds[0], unit, x)
+    np.maximum.at(bounds[1], unit, x)
+    np.minimum.at(bounds[2], unit, y)
+    np.maximum.at(bounds[3], unit, y)
+    centre_x = np.nan_to_num((bounds[0] + bounds[1]) / 2)
+    centre_y = np.nan_to_num((bounds[2] + bounds[3]) / 2)
+    # The curve is cut where the points of each unit, counted from their middle, cross a multiple of the load
+    order = morton_order(centre_x, centre_y)
+    middle = np.cumsum(counts[order]) - counts[order] / 2
+    chunk_of = np.empty(units, dtype=np.int64)
+    chunk_of[order] = np.minimum((middle * chunks / reach.size).astype(np.int64), chunks - 1)
+    point_chunk = chunk_of[unit]
+    return [index for index in (np.flatnonzero(point_chunk == chunk) for chunk in range(chunks)) if index.size]
+
+
+def _context():
+    context = multiprocessing.get_context('spawn')
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        # Embedded interpreter (QGIS): the workers are started with the Python of the installation
+        context.set_executable(os.path.join(sys.exec_prefix, 'python.exe' if os.name == 'nt' else os.path.join('bin', 'python3')))
+    return context
+
+
+def evaluate(flowacc, dem, x, y, angle, reach, heights, half_lengths, scale, area_range=(2, 50),
+             workers=0, chunks_per_worker=4, feedback=None):
+    """Evaluate all points, in ``workers`` processes when more than one.
+
+    Same arguments and result as ``evaluate_chunk``, for points of any
+    number of reaches.
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    angle, reach = np.asarray(angle, dtype=np.float64), np.nan_to_num(np.asarray(reach, dtype=np.float64))
+    if workers is None or workers <= 1 or x.size == 0:
+        return evaluate_chunk(flowacc, dem, x, y, angle, reach, heights, half_lengths, scale, area_range)
+
+    chunks = reach_chunks(reach, workers * chunks_per_worker, x, y)
+    if feedback is not None:
+        feedback.pushInfo(f'Evaluating {x.size} points of {np.unique(reach).size} reaches in {len(chunks)} chunks on {workers} processes')
+    shared_acc, shared_dem = share_raster(flowacc, 'flowacc'), share_raster(dem, 'dem')
+    tasks = [(index, (shared_acc, shared_dem, x[index], y[index], angle[index], reach[index],
+                      heights, half_lengths, scale, area_range)) for index in chunks]
+
+    heights, half_lengths = np.atleast_1d(heights), np.atleast_1d(half_lengths)
+    merged = Candidates(np.full(x.size, np.nan), np.full(x.size, np.nan), np.zeros(x.size, dtype=bool),
+                        np.zeros((heights.size, x.size), dtype=bool),
+                        np.full((half_lengths.size, x.size), np.nan), np.full((half_lengths.size, x.size), np.nan))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_context()) as pool:
+            for done, (index, result) in enumerate(pool.map(_evaluate_task, tasks), 1):
+                merged.contr_area[index] = result.contr_area
+                merged.elevation[index] = result.elevation
+                merged.candidate[index] = result.candidate
+                merged.keep[:, index] = result.keep
+                merged.left_range[:, index] = result.left_range
+                merged.right_range[:, index] = result.right_range
+                if feedback is not None:
+                    feedback.setProgress(100 * done / len(tasks))
+    finally:
+        for shared in (shared_acc, shared_dem):
+            try:
+                os.remove(shared.path)
+            except OSError:
+                pass
+    return merged
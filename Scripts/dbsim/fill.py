@@ -0,0 +1,218 @@
+"""Priority-flood depression filling (Wang & Liu 2006, Barnes et al. 2014).
+
+Drop-in replacement for ``saga:fillsinksxxlwangliu``: cells on the raster edge
+(or next to nodata) are seeded into a priority queue and the DEM is flooded
+inwards from the lowest spill cell, so each cell ends at the lowest elevation
+from which water can still leave the raster.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+from . import blocks, raster_io
+from ._compat import jit
+from .flow import upstream_mask
+from .raster_io import valid_mask
+
+# D8 neighbour offsets
+ROW_OFFSETS = np.array([-1, -1, -1, 0, 0, 1, 1, 1], dtype=np.int64)
+COL_OFFSETS = np.array([-1, 0, 1, -1, 1, -1, 0, 1], dtype=np.int64)
+DIAGONAL = np.array([True, False, True, False, False, True, False, True])
+
+
+@jit
+def _raise(value, floor, step):
+    # Smallest elevation strictly above ``floor`` when a minimum slope is used
+    if step > 0.0:
+        value = floor + step
+        if value <= floor:
+            value = np.nextafter(floor, np.inf)
+    elif value < floor:
+        value = floor
+    return value
+
+
+@jit
+def _flood(z, filled, closed, heap, eps_card, eps_diag, row_offsets, col_offsets, diagonal):
+    # Priority-flood from the seeded heap; cells raised in a depression go
+    # through a plain queue (Barnes et al. 2014, priority-flood+)
+    rows, cols = z.shape
+    pit = [0]
+    pit.pop()
+    head = 0
+    while head < len(pit) or len(heap) > 0:
+        if head < len(pit):
+            cell = pit[head]
+            head += 1
+        else:
+            if head > 0:
+                pit.clear()
+                head = 0
+            cell = heapq.heappop(heap)[1]
+        r = cell // cols
+        c = cell - r * cols
+        spill = filled[r, c]
+        for k in range(8):
+            nr = r + row_offsets[k]
+            nc = c + col_offsets[k]
+            if nr < 0 or nc < 0 or nr >= rows or nc >= cols or closed[nr, nc]:
+                continue
+            closed[nr, nc] = True
+            step = eps_diag if diagonal[k] else eps_card
+            if z[nr, nc] <= spill + step:
+                filled[nr, nc] = _raise(z[nr, nc], spill, step)
+                pit.append(nr * cols + nc)
+            else:
+                filled[nr, nc] = z[nr, nc]
+                heapq.heappush(heap, (float(filled[nr, nc]), nr * cols + nc))
+    return filled
+
+
+@jit
+def _priority_flood(z, valid, filled, eps_card, eps_diag, row_offsets, col_offsets, diagonal):
+    rows, cols = z.shape
+    closed = np.zeros((rows, cols), dtype=np.bool_)
+    # Typed empty heap, so the same code runs under numba and plain Python
+    heap = [(0.0, 0)]
+    heap.pop()
+
+    for r in range(rows):
+        for c in range(cols):
+            if not valid[r, c]:
+                closed[r, c] = True
+                filled[r, c] = z[r, c]
+                continue
+            edge = r == 0 or c == 0 or r == rows - 1 or c == cols - 1
+            if not edge:
+                for k in range(8):
+                    if not valid[r + row_offsets[k], c + col_offsets[k]]:
+                        edge = True
+                        break
+            if edge:
+                closed[r, c] = True
+                filled[r, c] = z[r, c]
+                heapq.heappush(heap, (float(z[r, c]), r * cols + c))
+    return _flood(z, filled, closed, heap, eps_card, eps_diag, row_offsets, col_offsets, diagonal)
+
+
+@jit
+def _refill(z, region, valid, filled, eps_card, eps_diag, row_offsets, col_offsets, diagonal):
+    # Cells outside ``region`` keep their filled elevation and act as spill
+    # points for the region; region cells on the array edge or next to
+    # nodata are outlets like in a full fill
+    rows, cols = z.shape
+    closed = np.zeros((rows, cols), dtype=np.bool_)
+    heap = [(0.0, 0)]
+    heap.pop()
+
+    for r in range(rows):
+        for c in range(cols):
+            if region[r, c] and valid[r, c]:
+                continue
+            closed[r, c] = True
+            if not valid[r, c]:
+                continue
+            for k in range(8):
+                nr = r + row_offsets[k]
+                nc = c + col_offsets[k]
+                if 0 <= nr < rows and 0 <= nc < cols and region[nr, nc] and valid[nr, nc]:
+                    heapq.heappush(heap, (float(filled[r, c]), r * cols + c))
+                    break
+    for r in range(rows):
+        for c in range(cols):
+            if closed[r, c]:
+                continue
+            edge = r == 0 or c == 0 or r == rows - 1 or c == cols - 1
+            if not edge:
+                for k in range(8):
+                    if not valid[r + row_offsets[k], c + col_offsets[k]]:
+                        edge = True
+                        break
+            if edge:
+                closed[r, c] = True
+                filled[r, c] = z[r, c]
+                heapq.heappush(heap, (float(z[r, c]), r * cols + c))
+    return _flood(z, filled, closed, heap, eps_card, eps_diag, row_offsets, col_offsets, diagonal)
+
+
+def fill_depressions(dem, nodata=None, min_slope=0.0, cellsize=1.0, out=None):
+    """Fill all depressions of ``dem`` so every cell drains to the raster edge.
+
+    ``dem`` may be an in-memory array or a ``np.memmap``; pass a memmap as
+    ``out`` to keep the filled surface out of core as well. ``min_slope`` is
+    the minimum slope in degrees imposed on filled areas (SAGA ``MINSLOPE``);
+    with 0 the depressions are filled flat.
+    """
+    if out is None:
+        out = np.empty(dem.shape, dtype=np.result_type(dem.dtype, np.float32))
+    eps_card = math.tan(math.radians(min_slope)) * cellsize
+    eps_diag = eps_card * math.sqrt(2.0)
+    return _priority_flood(dem, valid_mask(dem, nodata), out, eps_card, eps_diag,
+                           ROW_OFFSETS, COL_OFFSETS, DIAGONAL)
+
+
+def run_fill_sinks(parameters, feedback=None):
+    """Processing style entry point taking the ``saga:fillsinksxxlwangliu`` parameters.
+
+    ``ELEV`` is a raster layer or path, ``MINSLOPE`` the minimum slope in
+    degrees and ``FILLED`` the destination (or ``TEMPORARY_OUTPUT``).
+    Returns ``{'FILLED': path}``.
+    """
+    dem, info = blocks.read_raster(parameters['ELEV'])
+    if not np.issubdtype(dem.dtype, np.floating):
+        dem = dem.astype(np.float32)
+    filled_path = raster_io.output_path(parameters.get('FILLED'), 'filled.tif')
+    if feedback is not None:
+        feedback.pushInfo(f'Filling sinks of a {info.shape[0]} x {info.shape[1]} DEM (priority-flood)')
+    filled = fill_depressions(dem, info.nodata, parameters.get('MINSLOPE', 0.0), info.cellsize)
+    raster_io.write_raster(filled_path, filled, info, info.nodata)
+    return {'FILLED': filled_path}
+
+
+def refill_local(filled, new_dem, direction, nodata=None, min_slope=0.0, cellsize=1.0):
+    """Fill ``new_dem``, a copy of the depression free ``filled`` with some cells burnt in.
+
+    Only the burnt cells and the cells draining through them (following
+    ``direction``, the D8 directions of ``filled``) can end at a different
+    elevation than in ``filled``, so only that region is flooded again, from
+    the spill elevations of the cells around it. The cost grows with the
+    area behind the burnt cells instead of the size of the DEM.
+    """
+    out = np.array(filled, dtype=np.result_type(filled.dtype, new_dem.dtype, np.float32))
+    burnt = np.flatnonzero(valid_mask(new_dem, nodata) & (new_dem != filled))
+    if not burnt.size:
+        return out
+    region = upstream_mask(direction, burnt)
+    rows, cols = np.nonzero(region)
+    r0, c0 = max(rows.min() - 1, 0), max(cols.min() - 1, 0)
+    r1, c1 = min(rows.max() + 2, region.shape[0]), min(cols.max() + 2, region.shape[1])
+    window = (slice(r0, r1), slice(c0, c1))
+    eps_card = math.tan(math.radians(min_slope)) * cellsize
+    eps_diag = eps_card * math.sqrt(2.0)
+    z = new_dem[window]
+    _refill(z, region[window], valid_mask(z, nodata), out[window], eps_card, eps_diag,
+            ROW_OFFSETS, COL_OFFSETS, DIAGONAL)
+    return out
+
+
+def run_refill_local(parameters, feedback=None):
+    """Processing style entry point for ``refill_local``.
+
+    ``ELEV`` is the DEM with the raised cells burnt in, ``FILLED_DEM`` the
+    filled DEM it was derived from, ``DIRECTION`` the flow direction raster
+    of the filled DEM (GRASS coding) and ``FILLED`` the destination.
+    Returns ``{'FILLED': path}``.
+    """
+    new_dem, info = blocks.read_raster(parameters['ELEV'])
+    filled, _ = blocks.read_raster(parameters['FILLED_DEM'])
+    direction, _ = blocks.read_raster(parameters['DIRECTION'])
+    if not new_dem.shape == filled.shape == direction.shape:
+        raise ValueError('The burnt DEM, filled DEM and flow direction rasters must share the same grid')
+    filled_path = raster_io.output_path(parameters.get('FILLED'), 'filled.tif')
+    if feedback is not None:
+        feedback.pushInfo('Re-filling the basins upstream of the burnt cells')
+    out = refill_local(filled, new_dem, direction, info.nodata, parameters.get('MINSLOPE', 0.0), info.cellsize)
+    raster_io.write_raster(filled_path, out, info, info.nodata)
+    return {'FILLED': filled_path}
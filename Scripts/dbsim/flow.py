@@ -0,0 +1,287 @@
+"""D8 flow directions and flow accumulation on NumPy arrays.
+
+Directions use the GRASS ``r.watershed``/``r.stream.extract`` coding, so the
+rasters written here can be used wherever the GRASS outputs were used:
+code ``k`` points 45 * k degrees counter-clockwise from east (1 = NE, 2 = N,
+... 8 = E). Negative codes mark cells draining out of the raster (or into
+nodata) and 0 marks nodata or undrained cells.
+
+The results are not identical to ``r.watershed``: it routes with an A*
+search over the unfilled surface and resolves flats its own way, while
+here every cell of the filled DEM drains to its steepest lower neighbour
+and flat cells to the nearest draining cell of the flat. Expect
+differences on flats, on ties between neighbours and wherever
+r.watershed does not follow the filled surface; the outputs have not
+been compared with GRASS on a reference DEM.
+"""
+
+import math
+
+import numpy as np
+
+from . import blocks, raster_io
+from ._compat import NUMBA, jit
+from .raster_io import valid_mask
+
+# Row / column offset of the downstream cell for each direction code (index 0 unused)
+CODE_ROW = np.array([0, -1, -1, -1, 0, 1, 1, 1, 0], dtype=np.int64)
+CODE_COL = np.array([0, 1, 0, -1, -1, -1, 0, 1, 1], dtype=np.int64)
+CODE_DIST = np.array([0.0, math.sqrt(2.0), 1.0, math.sqrt(2.0), 1.0,
+                      math.sqrt(2.0), 1.0, math.sqrt(2.0), 1.0])
+
+
+def _shifted(array, code, fill_value):
+    """View of ``array`` aligned so each cell sees its neighbour in direction ``code``."""
+    dr, dc = CODE_ROW[code], CODE_COL[code]
+    rows, cols = array.shape
+    out = np.full((rows, cols), fill_value, dtype=array.dtype)
+    out[max(0, -dr):rows - max(0, dr), max(0, -dc):cols - max(0, dc)] = \
+        array[max(0, dr):rows - max(0, -dr), max(0, dc):cols - max(0, -dc)]
+    return out
+
+
+def d8_flow_direction(filled, nodata=None, routable=None):
+    """Steepest descent D8 directions of a depression free DEM.
+
+    Cells without a lower neighbour inside a flat are routed towards the
+    nearest cell of the same elevation that already drains (breadth first),
+    so every cell of a filled DEM gets a direction. Cells on the edge of the
+    raster or next to nodata drain out of the raster when no neighbour is
+    lower. ``routable`` restricts flat routing to a part of the array (used
+    to keep halo cells of a tile out of it).
+    """
+    valid = valid_mask(filled, nodata)
+    z = np.where(valid, filled, np.inf).astype(np.float64)
+    rows, cols = z.shape
+    direction = np.zeros((rows, cols), dtype=np.int16)
+    best = np.zeros((rows, cols), dtype=np.float64)
+    outlet = np.zeros((rows, cols), dtype=np.int16)
+
+    for code in range(1, 9):
+        neighbour = _shifted(z, code, np.nan)
+        with np.errstate(invalid='ignore'):
+            drop = (z - neighbour) / CODE_DIST[code]
+        steeper = valid & (drop > best)
+        direction[steeper] = code
+        best[steeper] = drop[steeper]
+        # First direction leaving the raster or entering nodata, used for outlets
+        leaves = valid & (outlet == 0) & ~np.isfinite(neighbour)
+        outlet[leaves] = -code
+
+    undrained = valid & (direction == 0)
+    edge_outlet = undrained & (outlet != 0)
+    direction[edge_outlet] = outlet[edge_outlet]
+
+    # Route flats towards the cells that already drain
+    flat = undrained & (outlet == 0)
+    drains = valid & (direction != 0)
+    if routable is not None:
+        flat &= routable
+        drains &= routable
+    cells = np.flatnonzero(flat)
+    if cells.size:
+        if NUMBA:
+            _route_flats(z, direction, flat, drains, cells, CODE_ROW, CODE_COL)
+        else:
+            _route_flats_vectorized(z, direction, flat, drains, cells)
+    return direction
+
+
+@jit
+def _route_flats(z, direction, flat, drains, cells, code_row, code_col):
+    # Breadth first over the flat cells only, one level at a time: a cell of
+    # the next level points to its first draining neighbour (in code order)
+    # of the same elevation, as reached at the end of the previous level
+    rows, cols = z.shape
+    queued = np.zeros(z.shape, dtype=np.bool_)
+    level = [0]
+    level.pop()
+    for cell in cells:
+        r = cell // cols
+        c = cell - r * cols
+        for code in range(1, 9):
+            nr = r + code_row[code]
+            nc = c + code_col[code]
+            if 0 <= nr < rows and 0 <= nc < cols and drains[nr, nc] and z[nr, nc] == z[r, c]:
+                queued[r, c] = True
+                level.append(cell)
+                break
+    while len(level) > 0:
+        for cell in level:
+            r = cell // cols
+            c = cell - r * cols
+            for code in range(1, 9):
+                nr = r + code_row[code]
+                nc = c + code_col[code]
+                if 0 <= nr < rows and 0 <= nc < cols and drains[nr, nc] and z[nr, nc] == z[r, c]:
+                    direction[r, c] = code
+                    break
+        following = [0]
+        following.pop()
+        for cell in level:
+            r = cell // cols
+            c = cell - r * cols
+            drains[r, c] = True
+        for cell in level:
+            r = cell // cols
+            c = cell - r * cols
+            for code in range(1, 9):
+                nr = r + code_row[code]
+                nc = c + code_col[code]
+                if 0 <= nr < rows and 0 <= nc < cols and flat[nr, nc] and not queued[nr, nc] and z[nr, nc] == z[r, c]:
+                    queued[nr, nc] = True
+                    following.append(nr * cols + nc)
+        level = following
+    return direction
+
+
+def _neighbours(cells, code, shape):
+    # Flat index of the neighbour of ``cells`` in direction ``code``, -1 outside the raster
+    rows, cols = shape
+    r, c = np.divmod(cells, cols)
+    nr, nc = r + CODE_ROW[code], c + CODE_COL[code]
+    return np.where((nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols), nr * cols + nc, -1)
+
+
+def _route_flats_vectorized(z, direction, flat, drains, cells):
+    # Same levels as ``_route_flats`` with NumPy on the cells of each level,
+    # used when numba is not installed
+    z, flat, drains, codes = z.ravel(), flat.ravel(), drains.ravel(), direction.ravel()
+
+    def draining_code(level):
+        # First code (0 if none) pointing to a draining neighbour of the same elevation
+        found = np.zeros(level.size, dtype=np.int16)
+        for code in range(8, 0, -1):
+            neighbour = _neighbours(level, code, direction.shape)
+            hit = neighbour >= 0
+            hit[hit] = drains[neighbour[hit]] & (z[neighbour[hit]] == z[level[hit]])
+            found[hit] = code
+        return found
+
+    queued = np.zeros(z.size, dtype=bool)
+    level = cells[draining_code(cells) != 0]
+    queued[level] = True
+    while level.size:
+        codes[level] = draining_code(level)
+        drains[level] = True
+        following = []
+        for code in range(1, 9):
+            neighbour = _neighbours(level, code, direction.shape)
+            inside = neighbour >= 0
+            neighbour, source = neighbour[inside], level[inside]
+            neighbour = np.unique(neighbour[flat[neighbour] & ~queued[neighbour] & (z[neighbour] == z[source])])
+            queued[neighbour] = True
+            following.append(neighbour)
+        level = np.concatenate(following)
+    return direction
+
+
+def receivers(direction):
+    """Flat index of the downstream cell of every cell, -1 where flow leaves the raster."""
+    rows, cols = direction.shape
+    code = np.where(direction > 0, direction, 0).astype(np.int64)
+    r = np.arange(rows, dtype=np.int64)[:, None] + CODE_ROW[code]
+    c = np.arange(cols, dtype=np.int64)[None, :] + CODE_COL[code]
+    inside = (code > 0) & (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+    return np.where(inside, r * cols + c, -1).ravel()
+
+
+def donors(direction, cells):
+    """Cells draining directly into ``cells`` (flat indices).
+
+    Returns the donor cells and, for each of them, the position of its
+    receiver in ``cells``. Only the neighbours of ``cells`` are visited, so
+    walking upstream costs the size of the upstream area, not of the raster.
+    """
+    rows, cols = direction.shape
+    codes = direction.ravel()
+    r, c = np.divmod(np.asarray(cells, dtype=np.int64), cols)
+    found, position = [], []
+    for code in range(1, 9):
+        dr, dc = r - CODE_ROW[code], c - CODE_COL[code]
+        inside = np.flatnonzero((dr >= 0) & (dr < rows) & (dc >= 0) & (dc < cols))
+        candidate = dr[inside] * cols + dc[inside]
+        hit = codes[candidate] == code
+        found.append(candidate[hit])
+        position.append(inside[hit])
+    return np.concatenate(found), np.concatenate(position)
+
+
+def upstream_mask(direction, seeds):
+    """Boolean mask of ``seeds`` and every cell draining into them."""
+    mask = np.zeros(direction.size, dtype=bool)
+    frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+    mask[frontier] = True
+    while frontier.size:
+        frontier, _ = donors(direction, frontier)
+        frontier = frontier[~mask[frontier]]
+        mask[frontier] = True
+    return mask.reshape(direction.shape)
+
+
+def topological_levels(recv, active=None):
+    """Yield cells level by level so every cell comes after all its donors (Kahn)."""
+    n = recv.size
+    has = recv >= 0
+    indegree = np.bincount(recv[has], minlength=n).astype(np.int64)
+    start = indegree == 0
+    if active is not None:
+        start &= active.ravel()
+    frontier = np.flatnonzero(start)
+    while frontier.size:
+        yield frontier
+        down = recv[frontier]
+        down = down[down >= 0]
+        if not down.size:
+            break
+        cells, counts = np.unique(down, return_counts=True)
+        indegree[cells] -= counts
+        frontier = cells[indegree[cells] == 0]
+
+
+def flow_accumulation(recv, weights=None, active=None):
+    """Accumulate ``weights`` (one per cell by default) downstream along ``recv``.
+
+    The result includes the cell itself, like ``r.watershed -a``.
+    """
+    n = recv.size
+    if weights is None:
+        acc = np.ones(n, dtype=np.float64)
+    else:
+        acc = np.array(weights, dtype=np.float64).ravel()
+    if active is not None:
+        acc[~active.ravel()] = 0.0
+    for frontier in topological_levels(recv, active):
+        down = recv[frontier]
+        keep = down >= 0
+        cells, inverse = np.unique(down[keep], return_inverse=True)
+        acc[cells] += np.bincount(inverse, weights=acc[frontier[keep]], minlength=cells.size)
+    return acc
+
+
+def d8_accumulation(filled, nodata=None):
+    """Return ``(accumulation, direction)`` of a filled DEM in one pass."""
+    valid = valid_mask(filled, nodata)
+    direction = d8_flow_direction(filled, nodata)
+    acc = flow_accumulation(receivers(direction), active=valid).reshape(filled.shape)
+    return acc, direction
+
+
+def run_flow_accumulation(parameters, feedback=None):
+    """Processing style replacement of ``grass7:r.watershed`` with ``-s -a`` (see the module notes on the differences).
+
+    ``elevation`` is the filled DEM, ``accumulation`` and the optional
+    ``drainage`` are the destinations (or ``TEMPORARY_OUTPUT``). Returns the
+    written paths.
+    """
+    filled, info = blocks.read_raster(parameters['elevation'])
+    if feedback is not None:
+        feedback.pushInfo(f'Calculating D8 flow direction and accumulation of a {info.shape[0]} x {info.shape[1]} DEM')
+    acc, direction = d8_accumulation(filled, info.nodata)
+    results = {}
+    results['accumulation'] = raster_io.write_raster(
+        raster_io.output_path(parameters.get('accumulation'), 'accumulation.tif'), acc, info)
+    if parameters.get('drainage'):
+        results['drainage'] = raster_io.write_raster(
+            raster_io.output_path(parameters['drainage'], 'drainage.tif'), direction, info, 0)
+    return results
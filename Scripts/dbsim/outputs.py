@@ -0,0 +1,70 @@
+"""Vector outputs kept in memory during a run and written once at the end.
+
+The tools used to overwrite their destination files after every stage with
+the intermediate state of the layer. ``Outputs`` only records the layer
+currently standing for each destination and writes every declared output
+once, when the run finishes, in the format of its extension (see
+``results``). With ``debug`` every staged layer is also dumped to a
+scratch folder, numbered in the order of the stages.
+"""
+
+import os
+
+from qgis.core import QgsCoordinateTransformContext, QgsProcessingUtils, QgsVectorFileWriter
+
+from . import results
+
+
+def write_layer(layer, path, driver=None):
+    """Write ``layer`` to ``path`` with its indexes, raising ``IOError`` when the writer fails.
+
+    The driver follows the extension of ``path`` unless given.
+    """
+    driver = driver or results.driver_for(path)
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = driver
+    options.fileEncoding = 'utf-8'
+    options.layerOptions = results.layer_options(driver)
+    error = QgsVectorFileWriter.writeAsVectorFormatV3(layer, path, QgsCoordinateTransformContext(), options)
+    if error[0] != QgsVectorFileWriter.NoError:
+        raise IOError(f'Could not write {path}: {error[1]}')
+    if driver == 'GPKG':
+        results.index_gpkg(path)
+    return path
+
+
+class Outputs:
+    """Current layer of every declared output of a tool."""
+
+    def __init__(self, feedback=None, debug=False, folder=None):
+        self.feedback = feedback
+        self.debug = debug
+        self.folder = folder
+        self.layers = {}
+        self.stages = 0
+
+    def stage(self, destination, layer, name=None):
+        """Record ``layer`` as the state of ``destination`` (skipped when it is not requested)."""
+        self.stages += 1
+        if self.debug:
+            self.dump(layer, name or 'stage')
+        if destination:
+            self.layers[destination] = layer
+        return layer
+
+    def dump(self, layer, name):
+        """Write an intermediate layer to the debug folder."""
+        if self.folder is None:
+            self.folder = os.path.join(QgsProcessingUtils.tempFolder(), 'intermediates')
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f'{self.stages:02d}_{name}.gpkg')
+        write_layer(layer, path, 'GPKG')
+        if self.feedback is not None:
+            self.feedback.pushInfo(f'Intermediate layer {name} written to {path}')
+        return path
+
+    def write(self):
+        """Write every output once, returning ``{destination: layer}``."""
+        for destination, layer in self.layers.items():
+            write_layer(layer, destination)
+        return dict(self.layers)
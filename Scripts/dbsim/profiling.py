@@ -0,0 +1,229 @@
+"""Timings and memory of the stages of a run, pushed to the feedback and saved as JSON.
+
+A run of the simulation tool chains tens of processing calls and array
+engines, and the banners of the feedback do not tell which one takes the
+time on a given dataset. ``Profiler`` wraps every stage and records its
+wall and CPU time (child processes such as GRASS included), the peak
+resident memory of the process when it ends, the features of its vector
+inputs and outputs and the bytes of the files it wrote. Every stage pushes
+one line to the feedback, and ``write`` saves the report next to the
+outputs, so runs on different datasets or commits can be compared.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from . import raster_io
+
+
+class StageRecord(namedtuple('StageRecord', 'name wall cpu peak_rss rss features_in features_out bytes_written')):
+    """Measures of one stage; memory and bytes are in bytes, feature counts None for rasters and plain values."""
+
+    def line(self):
+        def mb(value):
+            return f'{value / 2 ** 20:.0f} MB' if value is not None else 'n/a'
+
+        def count(value):
+            return '-' if value is None else str(value)
+
+        return (f'{self.name}: {self.wall:.2f} s wall, {self.cpu:.2f} s CPU, peak RSS {mb(self.peak_rss)}, '
+                f'features {count(self.features_in)} -> {count(self.features_out)}, {mb(self.bytes_written)} written')
+
+
+def _cpu_seconds():
+    times = os.times()
+    # Children are only counted once waited for, which processing does for the GRASS and GDAL commands
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def memory():
+    """``(rss, peak_rss)`` of this process in bytes, None where the platform does not tell."""
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None, None
+        return counters.WorkingSetSize, counters.PeakWorkingSetSize
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    peak = peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        rss = None
+    return rss, peak
+
+
+def _vector_path(value):
+    if not isinstance(value, str) or value.startswith('memory:'):
+        return None
+    path, _, options = value.partition('|')
+    if not os.path.isfile(path):
+        return None
+    layer = options.split('layername=')[1].split('|')[0] if 'layername=' in options else None
+    return path, layer
+
+
+def feature_count(value):
+    """Features of a vector layer, path or list of them; None when ``value`` holds no vector data."""
+    if isinstance(value, (list, tuple)):
+        counts = [count for count in map(feature_count, value) if count is not None]
+        return sum(counts) if counts else None
+    if hasattr(value, 'featureCount'):
+        count = value.featureCount()
+        return count if count >= 0 else None
+    source = _vector_path(value)
+    if source is None:
+        return None
+    try:
+        from osgeo import gdal
+        ds = gdal.OpenEx(source[0], gdal.OF_VECTOR)
+    except Exception:
+        return None
+    if ds is None:
+        return None
+    layers = [ds.GetLayerByName(source[1])] if source[1] else [ds.GetLayer(i) for i in range(ds.GetLayerCount())]
+    return sum(layer.GetFeatureCount() for layer in layers if layer is not None)
+
+
+def file_bytes(value):
+    """Bytes of the files (and their sidecars) a value points to, layers by their source."""
+    if isinstance(value, (list, tuple)):
+        return sum(map(file_bytes, value))
+    if hasattr(value, 'source'):
+        value = value.source()
+    if not isinstance(value, str):
+        return 0
+    path = value.split('|')[0]
+    if not os.path.isfile(path):
+        return 0
+    return sum(os.path.getsize(name) for name in raster_io.sidecar_files(path))
+
+
+def _values(parameters):
+    # Values of a parameter or results dict, or the value itself
+    return list(parameters.values()) if isinstance(parameters, dict) else [parameters]
+
+
+class _Stage:
+
+    def __init__(self, name, inputs):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = []
+        self.wall = time.perf_counter()
+        self.cpu = _cpu_seconds()
+
+
+class Profiler:
+    """Records the stages of a run, one at a time."""
+
+    def __init__(self, feedback=None, name=None):
+        self.feedback = feedback
+        self.name = name
+        self.stages = []
+        self.started = time.perf_counter()
+        self.cpu_started = _cpu_seconds()
+        self.current = None
+
+    def start(self, name, *inputs):
+        """Open the stage ``name`` reading ``inputs`` (layers, paths or parameter dicts), closing the open one."""
+        if self.current is not None:
+            self.finish()
+        self.current = _Stage(name, [value for inputs in inputs for value in _values(inputs)])
+        return self.current
+
+    def finish(self, *outputs):
+        """Close the open stage, which wrote ``outputs``, and push its line to the feedback."""
+        stage, self.current = self.current, None
+        if stage is None:
+            return None
+        wall = time.perf_counter() - stage.wall
+        cpu = _cpu_seconds() - stage.cpu
+        stage.outputs.extend(value for outputs in outputs for value in _values(outputs))
+        rss, peak = memory()
+        record = StageRecord(stage.name, wall, cpu, peak, rss, feature_count(stage.inputs),
+                             feature_count(stage.outputs), file_bytes(stage.outputs))
+        self.stages.append(record)
+        if self.feedback is not None:
+            self.feedback.pushInfo(f'[profile] {record.line()}')
+        return record
+
+    @contextmanager
+    def stage(self, name, *inputs):
+        """Context of a stage; the outputs are added to the ``outputs`` list of the yielded stage."""
+        stage = self.start(name, *inputs)
+        try:
+            yield stage
+        finally:
+            if self.current is stage:
+                self.finish()
+
+    def run(self, name, function, *args, **kwargs):
+        """``function(*args, **kwargs)`` (e.g. ``processing.run``) as the stage ``name``, returning its results.
+
+        The dicts among the arguments are read as the inputs of the stage
+        and the returned results as its outputs.
+        """
+        self.start(name, *[arg for arg in args if isinstance(arg, dict)])
+        try:
+            results = function(*args, **kwargs)
+        except BaseException:
+            self.finish()
+            raise
+        self.finish(results)
+        return results
+
+    def summary(self):
+        """The report as a JSON-able dict, the slowest stages first in ``slowest``."""
+        if self.current is not None:
+            self.finish()
+        rss, peak = memory()
+        stages = [record._asdict() for record in self.stages]
+        return {
+            'name': self.name,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'wall': time.perf_counter() - self.started,
+            'cpu': _cpu_seconds() - self.cpu_started,
+            'peak_rss': peak,
+            'bytes_written': sum(record.bytes_written for record in self.stages),
+            'stages': stages,
+            'slowest': [record.name for record in sorted(self.stages, key=lambda record: -record.wall)[:5]],
+        }
+
+    def write(self, path):
+        """Save the report to ``path`` and push the totals, returning the path."""
+        summary = self.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        if self.feedback is not None:
+            self.feedback.pushInfo(f'[profile] {len(self.stages)} stages in {summary["wall"]:.1f} s wall, '
+                                   f'{summary["cpu"]:.1f} s CPU; slowest: {", ".join(summary["slowest"])}. Report: {path}')
+        return path
+
+
+def report_path(destination, suffix='_profile.json'):
+    """Path of the report of the run writing ``destination``, next to it (in the temporary folder for memory layers)."""
+    if not destination or destination == raster_io.TEMPORARY_OUTPUT or destination.startswith('memory:'):
+        return raster_io.temp_filename('profile.json')
+    return os.path.splitext(destination.split('|')[0])[0] + suffix
@@ -0,0 +1,238 @@
+"""Reading and writing rasters as NumPy arrays through GDAL."""
+
+import os
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+TEMPORARY_OUTPUT = 'TEMPORARY_OUTPUT'
+
+# Distance, in cells, within which the corners of two grids are the same
+GRID_TOLERANCE = 0.01
+
+# Files written next to an output that belong to it, after the stem of its name
+SIDECARS = {'.shp': ('.shx', '.dbf', '.prj', '.cpg', '.qpj'), '.tif': ('.tif.aux.xml',)}
+
+_GDAL_TYPES = {
+    np.dtype('uint8'): gdal.GDT_Byte,
+    np.dtype('int16'): gdal.GDT_Int16,
+    np.dtype('uint16'): gdal.GDT_UInt16,
+    np.dtype('int32'): gdal.GDT_Int32,
+    np.dtype('uint32'): gdal.GDT_UInt32,
+    np.dtype('float32'): gdal.GDT_Float32,
+    np.dtype('float64'): gdal.GDT_Float64,
+}
+
+
+class RasterInfo(namedtuple('RasterInfo', 'geotransform projection nodata shape')):
+    """Georeference of a raster: GDAL geotransform, WKT projection, nodata and (rows, cols)."""
+
+    @property
+    def cellsize(self):
+        return abs(self.geotransform[1])
+
+    @property
+    def cell_area(self):
+        return abs(self.geotransform[1] * self.geotransform[5])
+
+
+def valid_mask(array, nodata=None):
+    """Cells holding data: finite and different from ``nodata``."""
+    valid = np.isfinite(array)
+    if nodata is not None:
+        valid &= array != nodata
+    return valid
+
+
+def source_path(layer):
+    """Path of a QgsRasterLayer, or the value itself when a path was given."""
+    if hasattr(layer, 'source'):
+        return layer.source()
+    return str(layer)
+
+
+def temp_filename(name):
+    """Temporary file in the QGIS processing folder, or the system temp folder outside QGIS."""
+    try:
+        from qgis.core import QgsProcessingUtils
+    except ImportError:
+        folder = tempfile.mkdtemp(prefix='processing_dbsim_')
+        return os.path.join(folder, name)
+    return QgsProcessingUtils.generateTempFilename(name)
+
+
+def output_path(path, name):
+    """Resolve a raster destination, replacing TEMPORARY_OUTPUT by a temporary file."""
+    if not path or path == TEMPORARY_OUTPUT:
+        return temp_filename(name)
+    return path
+
+
+def sidecar_files(path):
+    """``path`` and its sidecar files that exist."""
+    stem, extension = os.path.splitext(path)
+    return [path] + [stem + sidecar for sidecar in SIDECARS.get(extension.lower(), ()) if os.path.exists(stem + sidecar)]
+
+
+def raster_info(path):
+    ds = gdal.Open(source_path(path))
+    band = ds.GetRasterBand(1)
+    info = RasterInfo(ds.GetGeoTransform(), ds.GetProjection(), band.GetNoDataValue(),
+                      (ds.RasterYSize, ds.RasterXSize))
+    ds = None
+    return info
+
+
+def read_raster(path, band=1, dtype=None):
+    """Read a raster band into memory, returning ``(array, RasterInfo)``."""
+    ds = gdal.Open(source_path(path))
+    rb = ds.GetRasterBand(band)
+    array = rb.ReadAsArray()
+    if dtype is not None:
+        array = array.astype(dtype, copy=False)
+    info = RasterInfo(ds.GetGeoTransform(), ds.GetProjection(), rb.GetNoDataValue(),
+                      (ds.RasterYSize, ds.RasterXSize))
+    ds = None
+    return array, info
+
+
+def write_raster(path, array, info, nodata=None):
+    """Write ``array`` as a single band GeoTIFF with the georeference in ``info``."""
+    rows, cols = array.shape
+    gdal_type = _GDAL_TYPES[np.dtype(array.dtype)]
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, cols, rows, 1, gdal_type,
+                       options=['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'])
+    ds.SetGeoTransform(info.geotransform)
+    ds.SetProjection(info.projection)
+    band = ds.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    band.FlushCache()
+    ds = None
+    return path
+
+
+def open_raster(path, update=False):
+    return gdal.Open(source_path(path), gdal.GA_Update if update else gdal.GA_ReadOnly)
+
+
+def read_window(ds, row, col, rows, cols, band=1):
+    """Read a ``rows`` x ``cols`` window starting at (``row``, ``col``) of an open dataset."""
+    return ds.GetRasterBand(band).ReadAsArray(col, row, cols, rows)
+
+
+def create_raster(path, info, dtype, nodata=None):
+    """Create an empty single band GeoTIFF to be written window by window."""
+    rows, cols = info.shape
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, cols, rows, 1, _GDAL_TYPES[np.dtype(dtype)],
+                       options=['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'])
+    ds.SetGeoTransform(info.geotransform)
+    ds.SetProjection(info.projection)
+    if nodata is not None:
+        ds.GetRasterBand(1).SetNoDataValue(nodata)
+    return ds
+
+
+def data_window(mask, margin=0):
+    """Window ``(row, col, rows, cols)`` holding the True cells of ``mask`` and ``margin`` cells around them.
+
+    None when ``mask`` has no True cell.
+    """
+    rows, cols = np.nonzero(np.any(mask, axis=1))[0], np.nonzero(np.any(mask, axis=0))[0]
+    if not rows.size:
+        return None
+    r0, c0 = max(rows[0] - margin, 0), max(cols[0] - margin, 0)
+    r1, c1 = min(rows[-1] + 1 + margin, mask.shape[0]), min(cols[-1] + 1 + margin, mask.shape[1])
+    return int(r0), int(c0), int(r1 - r0), int(c1 - c0)
+
+
+def window_info(info, row, col, rows, cols):
+    """Georeference of the window of ``info`` starting at (``row``, ``col``), on the same grid."""
+    gt = info.geotransform
+    geotransform = (gt[0] + col * gt[1] + row * gt[2], gt[1], gt[2],
+                    gt[3] + col * gt[4] + row * gt[5], gt[4], gt[5])
+    return RasterInfo(geotransform, info.projection, info.nodata, (rows, cols))
+
+
+def window_extent(info, row, col, rows, cols):
+    """Map extent ``(xmin, ymin, xmax, ymax)`` of a window of a north-up raster."""
+    gt = window_info(info, row, col, rows, cols).geotransform
+    x0, y0 = gt[0], gt[3]
+    x1, y1 = x0 + cols * gt[1], y0 + rows * gt[5]
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def same_grid(info, other, tolerance=GRID_TOLERANCE):
+    """Whether two rasters have the same shape and corners within ``tolerance`` cells."""
+    if info.shape != other.shape:
+        return False
+    rows, cols = info.shape
+    cell = min(abs(info.geotransform[1]), abs(info.geotransform[5]))
+    for row, col in ((0, 0), (rows, cols)):
+        for a in (0, 3):
+            offset = [gt[a] + col * gt[a + 1] + row * gt[a + 2] for gt in (info.geotransform, other.geotransform)]
+            if abs(offset[0] - offset[1]) > tolerance * cell:
+                return False
+    return True
+
+
+def warp_to_grid(path, info, destination=None, resampling='near'):
+    """Resample a raster onto the grid of ``info`` as a warped VRT, nearest neighbour by default.
+
+    Cells of the grid outside the raster are nodata. Returns the path of
+    the VRT.
+    """
+    rows, cols = info.shape
+    destination = destination or temp_filename('warped.vrt')
+    ds = gdal.Warp(destination, source_path(path), format='VRT', outputBounds=window_extent(info, 0, 0, rows, cols),
+                   width=cols, height=rows, dstSRS=info.projection or None, resampleAlg=resampling)
+    if ds is None:
+        raise RuntimeError(gdal.GetLastErrorMsg())
+    ds = None
+    return destination
+
+
+def read_raster_window(path, row, col, rows, cols, band=1):
+    """Read a window of a raster band, returning ``(array, RasterInfo)`` of the window."""
+    ds = open_raster(path)
+    array = read_window(ds, row, col, rows, cols, band)
+    rb = ds.GetRasterBand(band)
+    info = RasterInfo(ds.GetGeoTransform(), ds.GetProjection(), rb.GetNoDataValue(),
+                      (ds.RasterYSize, ds.RasterXSize))
+    ds = None
+    return array, window_info(info, row, col, rows, cols)
+
+
+def crop_raster(path, window, destination=None, band=1):
+    """Copy the ``(row, col, rows, cols)`` window of a raster to ``destination``, on the same grid."""
+    array, info = read_raster_window(path, *window, band=band)
+    destination = output_path(destination, 'window.tif')
+    return write_raster(destination, array, info, info.nodata)
+
+
+def expand_raster(path, reference, destination=None, fill_value=0):
+    """Write a raster cropped from ``reference`` back onto the whole grid of ``reference``.
+
+    Cells outside the window take ``fill_value``, which is also the nodata
+    of the result.
+    """
+    array, info = read_raster(path)
+    full = raster_info(reference)
+    gt, ref = info.geotransform, full.geotransform
+    col = int(round((gt[0] - ref[0]) / ref[1]))
+    row = int(round((gt[3] - ref[3]) / ref[5]))
+    destination = output_path(destination, 'expanded.tif')
+    ds = create_raster(destination, full, array.dtype, fill_value)
+    band = ds.GetRasterBand(1)
+    band.Fill(fill_value)
+    band.WriteArray(np.where(valid_mask(array, info.nodata), array, fill_value).astype(array.dtype), col, row)
+    band.FlushCache()
+    ds = None
+    return destination
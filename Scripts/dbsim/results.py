@@ -0,0 +1,61 @@
+"""Results store: GeoPackage or FlatGeobuf outputs with spatial and attribute indexes.
+
+Shapefiles truncate field names, stop at 2 GB and have no indexes, so the
+results of thousands of scenarios end up in one file that has to be
+scanned to find a height and length. The tools now write the format of the
+destination extension: a GeoPackage gets its R-tree and an index on the
+scenario fields, so loading one scenario is an indexed query; FlatGeobuf
+gets its packed spatial index. Other extensions still get a shapefile.
+"""
+
+import os
+import sqlite3
+
+# Fields indexed in GeoPackage outputs when the table has them
+INDEXED_FIELDS = ('DB_ID', 'Height (m)', 'Length (m)', 'Ratio')
+
+DRIVERS = {'.gpkg': 'GPKG', '.fgb': 'FlatGeobuf'}
+
+
+def driver_for(path):
+    """OGR driver of the output ``path`` after its extension, ``ESRI Shapefile`` by default."""
+    return DRIVERS.get(os.path.splitext(path)[1].lower(), 'ESRI Shapefile')
+
+
+def layer_options(driver):
+    """Layer creation options building the spatial index of ``driver``."""
+    if driver in ('GPKG', 'FlatGeobuf'):
+        return ['SPATIAL_INDEX=YES']
+    return []
+
+
+def _index_name(table, field):
+    name = ''.join(c if c.isalnum() else '_' for c in f'{table}_{field}'.lower())
+    return f'idx_{name}'
+
+
+def index_gpkg(path, fields=INDEXED_FIELDS):
+    """Create the attribute indexes of every feature table of the GeoPackage ``path``.
+
+    Returns ``{table: [indexed fields]}``. All indexes are created in one
+    transaction.
+    """
+    indexed = {}
+    with sqlite3.connect(path) as db:
+        tables = [row[0] for row in db.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features'")]
+        for table in tables:
+            columns = {row[1] for row in db.execute(f'PRAGMA table_info("{table}")')}
+            indexed[table] = [field for field in fields if field in columns]
+            for field in indexed[table]:
+                db.execute(f'CREATE INDEX IF NOT EXISTS "{_index_name(table, field)}" ON "{table}" ("{field}")')
+    return indexed
+
+
+def scenario_filter(height=None, length=None):
+    """Expression selecting one scenario on the indexed fields, for a feature request or subset string."""
+    terms = []
+    if height is not None:
+        terms.append(f'"Height (m)" = {height:g}')
+    if length is not None:
+        terms.append(f'"Length (m)" = {length:g}')
+    return ' AND '.join(terms)
@@ -0,0 +1,116 @@
+"""Sampling rasters at points in one vectorized gather.
+
+Replaces buffering the points and running zonal statistics on every buffer:
+the points are converted to cell coordinates, the window of the raster
+covering them is read once and the values are gathered with fancy indexing.
+"""
+
+import numpy as np
+
+from . import blocks
+from .raster_io import valid_mask
+
+NEAREST = 'nearest'
+BILINEAR = 'bilinear'
+
+
+def cell_coordinates(info, x, y):
+    """Continuous ``(row, col)`` of map coordinates, cell ``(i, j)`` spanning ``[i, i + 1)``."""
+    gt = info.geotransform
+    col = (np.asarray(x, dtype=np.float64) - gt[0]) / gt[1]
+    row = (np.asarray(y, dtype=np.float64) - gt[3]) / gt[5]
+    return row, col
+
+
+def _gather(array, nodata, i, j):
+    # Values of the cells (i, j) as float64 and whether they hold data; only the gathered cells are cast and masked
+    values = array[i, j]
+    return values.astype(np.float64), valid_mask(values, nodata)
+
+
+def _nearest(array, nodata, row, col):
+    i, j = np.floor(row).astype(np.int64), np.floor(col).astype(np.int64)
+    inside = (i >= 0) & (i < array.shape[0]) & (j >= 0) & (j < array.shape[1])
+    values = np.full(row.shape, np.nan)
+    gathered, valid = _gather(array, nodata, i[inside], j[inside])
+    values[inside] = np.where(valid, gathered, np.nan)
+    return values
+
+
+def _bilinear(array, nodata, row, col):
+    # Weighted mean of the four nearest cell centres holding data
+    row, col = row - 0.5, col - 0.5
+    i0, j0 = np.floor(row).astype(np.int64), np.floor(col).astype(np.int64)
+    fr, fc = row - i0, col - j0
+    total = np.zeros(row.shape)
+    weight = np.zeros(row.shape)
+    for di, dj, w in ((0, 0, (1 - fr) * (1 - fc)), (0, 1, (1 - fr) * fc),
+                      (1, 0, fr * (1 - fc)), (1, 1, fr * fc)):
+        i, j = i0 + di, j0 + dj
+        ok = (i >= 0) & (i < array.shape[0]) & (j >= 0) & (j < array.shape[1])
+        gathered, valid = _gather(array, nodata, i[ok], j[ok])
+        ok[ok] = valid
+        total[ok] += w[ok] * gathered[valid]
+        weight[ok] += w[ok]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight > 0, total / weight, np.nan)
+
+
+def sample(array, info, x, y, method=NEAREST, row_offset=0, col_offset=0):
+    """Values of ``array`` at the points ``(x, y)``, NaN outside the raster or on nodata.
+
+    ``row_offset`` and ``col_offset`` locate ``array`` in the raster of
+    ``info`` when it is a window of it. Only the cells under the points are
+    read, cast and checked for nodata, never the whole array.
+    """
+    row, col = cell_coordinates(info, x, y)
+    row, col = row - row_offset, col - col_offset
+    if method == BILINEAR:
+        return _bilinear(array, info.nodata, row, col)
+    return _nearest(array, info.nodata, row, col)
+
+
+def _window(info, x, y):
+    # Window (r0, c0, r1, c1) of the raster covering the points, None when they all fall outside
+    if not np.size(x):
+        return None
+    row, col = cell_coordinates(info, x, y)
+    rows, cols = info.shape
+    r0 = int(min(max(np.floor(np.nanmin(row)) - 1, 0), rows))
+    c0 = int(min(max(np.floor(np.nanmin(col)) - 1, 0), cols))
+    r1 = int(max(min(np.floor(np.nanmax(row)) + 2, rows), r0))
+    c1 = int(max(min(np.floor(np.nanmax(col)) + 2, cols), c0))
+    if r1 == r0 or c1 == c0:
+        return None
+    return r0, c0, r1, c1
+
+
+def sample_raster(raster, x, y, method=NEAREST):
+    """Sample a raster layer or path at the points, reading only the window that covers them.
+
+    The window goes through the shared block cache, so points sampled again
+    in the same area are not read twice.
+    """
+    info = blocks.raster_info(raster)
+    window = _window(info, x, y)
+    if window is None:
+        return np.full(np.shape(x), np.nan)
+    r0, c0, r1, c1 = window
+    array = blocks.read_window(raster, r0, c0, r1 - r0, c1 - c0)
+    return sample(array, info, x, y, method, r0, c0)
+
+
+def sample_array(array, info, x, y, method=NEAREST):
+    """Sample a whole-raster array, e.g. memory-mapped, touching only the window that covers the points."""
+    window = _window(info, x, y)
+    if window is None:
+        return np.full(np.shape(x), np.nan)
+    r0, c0, r1, c1 = window
+    return sample(np.asarray(array[r0:r1, c0:c1]), info, x, y, method, r0, c0)
+
+
+def sample_rasters(rasters, x, y, method=NEAREST):
+    """List with the values of each raster of ``rasters`` at the points ``(x, y)``."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return [sample_raster(raster, x, y, method) for raster in rasters]
@@ -0,0 +1,125 @@
+"""Selection of candidate bund points on columnar arrays."""
+
+import numpy as np
+
+from ._compat import jit
+
+
+@jit
+def _drop_filter(reach, elevation, heights, keep):
+    # Points come sorted by reach and contributing area; a point is kept when
+    # it sits at least ``height`` below the last point kept upstream of it
+    n = reach.size
+    for h in range(heights.size):
+        up = np.inf
+        for i in range(n):
+            if i == 0 or reach[i] != reach[i - 1]:
+                up = np.inf
+            if elevation[i] + heights[h] < up:
+                keep[h, i] = True
+                up = elevation[i]
+    return keep
+
+
+def elevation_drop_filter(reach, contr_area, elevation, heights):
+    """Keep-mask of the points with enough elevation drop to the next point kept upstream.
+
+    Points are walked down every reach in increasing contributing area;
+    a point is dropped when its elevation plus the bund height is not
+    below the elevation of the last point kept upstream on the same reach.
+    Returns a boolean ``(len(heights), n)`` array in the input order, all
+    heights computed from one sort.
+    """
+    reach = np.asarray(reach)
+    contr_area = np.asarray(contr_area, dtype=np.float64)
+    elevation = np.asarray(elevation, dtype=np.float64)
+    heights = np.atleast_1d(np.asarray(heights, dtype=np.float64))
+    order = np.lexsort((contr_area, reach))
+    keep = np.zeros((heights.size, reach.size), dtype=np.bool_)
+    _drop_filter(reach[order], elevation[order], heights, keep)
+    out = np.empty_like(keep)
+    out[:, order] = keep
+    return out
+
+
+def scenario_matrix(keep, left_range, right_range, heights, incised=False):
+    """Bunds of every height and length standing on banks high enough to hold them.
+
+    ``keep`` is the ``(H, n)`` mask from ``elevation_drop_filter`` and the
+    ranges the ``(L, n)`` bank ranges of each length; a bund is kept when
+    both banks rise above its height and, with ``incised``, less than
+    twice its height. The ``(H, L, n)`` matrix is evaluated by broadcasting
+    and returned as the ``(height, length, point)`` indices of the bunds.
+    """
+    heights = np.atleast_1d(np.asarray(heights, dtype=np.float64))[:, None, None]
+    left_range = np.asarray(left_range, dtype=np.float64)[None]
+    right_range = np.asarray(right_range, dtype=np.float64)[None]
+    with np.errstate(invalid='ignore'):
+        valid = np.asarray(keep, dtype=bool)[:, None, :] & (left_range > heights) & (right_range > heights)
+        if incised:
+            valid &= (left_range < 2 * heights) & (right_range < 2 * heights)
+    return np.nonzero(valid)
+
+
+def _point_segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length2 > 0, ((px - ax) * dx + (py - ay) * dy) / length2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def _orientation(px, py, qx, qy, rx, ry):
+    return (qx - px) * (ry - py) - (qy - py) * (rx - px)
+
+
+def segment_distance(ax, ay, bx, by, cx, cy, dx, dy):
+    """Distance between the segment ``a``-``b`` and the segments ``c``-``d`` (arrays)."""
+    crossing = ((_orientation(ax, ay, bx, by, cx, cy) * _orientation(ax, ay, bx, by, dx, dy) < 0) &
+                (_orientation(cx, cy, dx, dy, ax, ay) * _orientation(cx, cy, dx, dy, bx, by) < 0))
+    distance = np.minimum.reduce([_point_segment_distance(ax, ay, cx, cy, dx, dy),
+                                  _point_segment_distance(bx, by, cx, cy, dx, dy),
+                                  _point_segment_distance(cx, cy, ax, ay, bx, by),
+                                  _point_segment_distance(dx, dy, ax, ay, bx, by)])
+    return np.where(crossing, 0.0, distance)
+
+
+def suppress_overlaps(x0, y0, x1, y1, score, distance=0.0, groups=None):
+    """Greedy non-maximum suppression of overlapping bund lines.
+
+    Candidates are the segments ``(x0, y0)``-``(x1, y1)``, visited once in
+    decreasing ``score`` (the contributing area). A candidate is accepted
+    unless it lies within ``distance`` of a line already accepted in the
+    same group (e.g. the same height and length). Accepted lines are kept
+    in a grid of cells at least as large as a line, so each candidate is
+    only tested against the accepted lines around it. Returns the keep-mask
+    in the input order.
+    """
+    x0, y0 = np.asarray(x0, dtype=np.float64), np.asarray(y0, dtype=np.float64)
+    x1, y1 = np.asarray(x1, dtype=np.float64), np.asarray(y1, dtype=np.float64)
+    n = x0.size
+    keep = np.zeros(n, dtype=bool)
+    if not n:
+        return keep
+    if groups is None:
+        groups = [0] * n
+    xmin, xmax = np.minimum(x0, x1) - distance, np.maximum(x0, x1) + distance
+    ymin, ymax = np.minimum(y0, y1) - distance, np.maximum(y0, y1) + distance
+    cell = max(float(np.max(xmax - xmin)), float(np.max(ymax - ymin)), 1.0)
+    cx0, cx1 = np.floor(xmin / cell).astype(np.int64), np.floor(xmax / cell).astype(np.int64)
+    cy0, cy1 = np.floor(ymin / cell).astype(np.int64), np.floor(ymax / cell).astype(np.int64)
+
+    grid = {}
+    # Stable, so equal scores keep the input order
+    for i in np.argsort(-np.asarray(score, dtype=np.float64), kind='stable'):
+        cells = [(groups[i], gx, gy) for gx in range(cx0[i], cx1[i] + 1) for gy in range(cy0[i], cy1[i] + 1)]
+        near = {j for key in cells for j in grid.get(key, ())}
+        if near:
+            near = np.fromiter(near, dtype=np.int64)
+            if np.any(segment_distance(x0[i], y0[i], x1[i], y1[i], x0[near], y0[near], x1[near], y1[near]) <= distance):
+                continue
+        keep[i] = True
+        for key in cells:
+            grid.setdefault(key, []).append(i)
+    return keep
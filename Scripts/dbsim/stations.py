@@ -0,0 +1,89 @@
+"""Points at equal spacing along flow lines, computed for all lines at once.
+
+Every part of a polyline gets a station at its start and then one every
+``spacing`` along it, like walking the vertices and carrying the distance
+over from one segment to the next. Chainage is accumulated for all parts
+in one array and every station is placed on its segment with one
+``searchsorted``. The tangent at a station is the direction of the chord
+between the points half a ``window`` behind and ahead of it on the same
+part, which smooths the zig-zag of flow lines traced on raster cells.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+class Stations(namedtuple('Stations', 'x y chainage part tangent')):
+    """Stations along the flow lines, with the bearings of the transects across them."""
+
+    @property
+    def l_perp(self):
+        """Angle (math convention, degrees) of the left half of the transect, as ``360 - tangent``."""
+        return 360.0 - self.tangent
+
+    @property
+    def r_perp(self):
+        return self.l_perp + 180.0
+
+
+def _concatenate(parts):
+    # Vertices of the parts with vertices, the first and last vertex of each
+    # and its index among all parts; a part with a single vertex is doubled
+    # so that every part has a segment
+    parts = [np.asarray(part, dtype=np.float64).reshape(-1, 2) for part in parts]
+    index = np.array([i for i, part in enumerate(parts) if len(part)], dtype=np.int64)
+    parts = [np.repeat(parts[i], 2, axis=0) if len(parts[i]) == 1 else parts[i] for i in index]
+    sizes = np.array([len(part) for part in parts], dtype=np.int64)
+    last = np.cumsum(sizes) - 1
+    first = last - sizes + 1
+    vertices = np.concatenate(parts) if parts else np.zeros((0, 2))
+    return vertices, first, last, index
+
+
+def azimuth(dx, dy):
+    """Compass bearing in degrees (clockwise from north) of the direction ``(dx, dy)``."""
+    return np.degrees(np.arctan2(dx, dy)) % 360.0
+
+
+def _locate(vertices, chain, length, first, last, part, target):
+    # Coordinates at ``target`` along the concatenated chain, kept inside ``part``
+    segment = np.searchsorted(chain, target, side='right') - 1
+    segment = np.clip(segment, first[part], last[part] - 1)
+    start, end = vertices[segment], vertices[segment + 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(length[segment] > 0, (target - chain[segment]) / length[segment], 0.0)
+    return start[:, 0] + ratio * (end[:, 0] - start[:, 0]), start[:, 1] + ratio * (end[:, 1] - start[:, 1])
+
+
+def stations(parts, spacing, window=None):
+    """Stations every ``spacing`` along ``parts`` (sequences of ``(x, y)`` vertices).
+
+    Returns ``Stations`` arrays: coordinates, ``chainage`` from the start of
+    the part, index of the ``part`` in ``parts`` (empty parts get no
+    station) and the local ``tangent`` azimuth (compass degrees) over a
+    ``window`` centred on the station, two spacings unless given.
+    """
+    vertices, first, last, index = _concatenate(parts)
+    step = np.diff(vertices, axis=0)
+    length = np.hypot(step[:, 0], step[:, 1])
+    # The step from the last vertex of a part to the next part is not a segment
+    length[last[:-1]] = 0.0
+    chain = np.concatenate(([0.0], np.cumsum(length)))
+    part_start = chain[first]
+    part_length = chain[last] - part_start
+
+    counts = np.floor(part_length / spacing).astype(np.int64) + 1
+    part = np.repeat(np.arange(first.size), counts)
+    chainage = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) * float(spacing)
+
+    target = part_start[part] + chainage
+    x, y = _locate(vertices, chain, length, first, last, part, target)
+
+    # Smoothed tangent: chord across the window, clipped to the part
+    half = (2.0 * spacing if window is None else float(window)) / 2.0
+    start, end = part_start[part], part_start[part] + part_length[part]
+    xb, yb = _locate(vertices, chain, length, first, last, part, np.clip(target - half, start, end))
+    xa, ya = _locate(vertices, chain, length, first, last, part, np.clip(target + half, start, end))
+    tangent = azimuth(xa - xb, ya - yb)
+    return Stations(x, y, chainage, index[part], tangent)
@@ -0,0 +1,258 @@
+"""Stage-storage curves of the ponds impounded behind bunds.
+
+On a depression free DEM every cell of the basin of a bund drains down into
+the bund, so with the crest at elevation ``C`` the water over a basin cell
+stands at ``min(C, e)``, where ``e`` is the elevation at which the water of
+that cell escapes without crossing a bund (the DEM filled once with the
+bunds as walls). Sorting the cell and escape elevations of each basin once
+(two cumulative histograms) gives the impounded area and volume for any
+crest height, without burning the bund and filling the DEM again for every
+height.
+"""
+
+import csv
+from collections import namedtuple
+
+import numpy as np
+
+from . import blocks, raster_io
+from .basins import basins_window, label_basins, outlets_from_raster
+from .fill import refill_local
+from .raster_io import valid_mask
+
+# Elevation given to bund cells to turn them into walls
+WALL = 1.0e6
+
+
+class StageStorage(namedtuple('StageStorage', 'base elevations cumulative escapes escape_cumulative cell_area z_factor')):
+    """Pond behind one bund.
+
+    ``base`` is the lowest elevation under the bund, ``elevations`` and
+    ``escapes`` the sorted elevations and escape elevations of the basin
+    cells that can hold water, and the ``cumulative`` arrays their running
+    sums, starting at 0.
+    """
+
+    @property
+    def spill(self):
+        """Crest elevation above which the pond does not grow any more."""
+        return self.escapes[-1] if self.escapes.size else self.base
+
+    def storage(self, crest):
+        """``(area, volume)`` impounded with the water at ``crest``."""
+        wet = np.searchsorted(self.elevations, crest)
+        full = np.searchsorted(self.escapes, crest)
+        area = wet * self.cell_area
+        volume = (wet * crest - self.cumulative[wet]) - (full * crest - self.escape_cumulative[full])
+        return area, volume * self.cell_area * self.z_factor
+
+    def curve(self, step):
+        """Stages above the base every ``step`` up to the spill, with their areas and volumes."""
+        top = max(self.spill - self.base, 0.0)
+        stages = np.append(np.arange(0.0, top, step), top)
+        area, volume = self.storage(self.base + stages)
+        return stages, area, volume
+
+
+def escape_elevations(filled, outlets, direction, nodata=None):
+    """Elevation at which water leaves every cell without crossing a bund cell (``outlets`` > 0)."""
+    walls = np.array(filled, dtype=np.float64)
+    walls[outlets > 0] = WALL
+    return refill_local(filled, walls, direction, nodata)
+
+
+def stage_storage(elevation, escape, basins, outlets, nodata=None, cell_area=1.0, z_factor=1.0):
+    """Stage-storage curve of every labelled basin, as ``{label: StageStorage}``.
+
+    ``escape`` comes from ``escape_elevations``, ``basins`` holds the basin
+    labels (as from ``basins.label_basins``) and ``outlets`` the same labels
+    on the bund cells and 0 elsewhere.
+    """
+    valid = valid_mask(elevation, nodata)
+    labels = np.where(valid, basins, 0).astype(np.int64)
+    bund = valid & (outlets > 0)
+    size = labels.max() + 1 if labels.size else 1
+
+    base = np.full(size, np.inf)
+    np.minimum.at(base, labels[bund], elevation[bund].astype(np.float64))
+
+    # Cells that can hold water; the others drain around the bund at any height
+    pond = (labels > 0) & ~bund & (escape > elevation)
+    cell_labels = labels[pond]
+    cell_z = elevation[pond].astype(np.float64)
+    cell_e = escape[pond].astype(np.float64)
+    by_z = np.lexsort((cell_z, cell_labels))
+    by_e = np.lexsort((cell_e, cell_labels))
+    cell_labels, cell_z, cell_e = cell_labels[by_z], cell_z[by_z], cell_e[by_e]
+
+    present = np.flatnonzero(np.isfinite(base))
+    starts = np.searchsorted(cell_labels, present)
+    ends = np.searchsorted(cell_labels, present, side='right')
+    curves = {}
+    for label, lo, hi in zip(present, starts, ends):
+        elevations, escapes = cell_z[lo:hi], cell_e[lo:hi]
+        curves[int(label)] = StageStorage(base[label], elevations, np.concatenate(([0.0], np.cumsum(elevations))),
+                                          escapes, np.concatenate(([0.0], np.cumsum(escapes))), cell_area, z_factor)
+    return curves
+
+
+def ponds(elevation, escape, basins, outlets, crests, values, nodata=None):
+    """Raster of the ponds with the crest of the bund of basin ``label`` at ``crests[label]``.
+
+    Pond cells take ``values[label]`` (e.g. the DB_ID), other cells 0.
+    ``crests`` and ``values`` are arrays indexed by label; a NaN crest
+    leaves the basin dry.
+    """
+    labels = np.where(valid_mask(elevation, nodata), basins, 0).astype(np.int64)
+    with np.errstate(invalid='ignore'):
+        wet = (labels > 0) & (outlets == 0) & (elevation < crests[labels]) & (elevation < escape)
+    return np.where(wet, values[labels], 0).astype(np.int32)
+
+
+class PondStatistics(namedtuple('PondStatistics', 'volume cells max_depth cell_area')):
+    """Arrays indexed by label: impounded ``volume``, wet ``cells`` and ``max_depth``."""
+
+    @property
+    def area(self):
+        return self.cells * self.cell_area
+
+    def row(self, label):
+        """``(volume, area, max_depth)`` of one label, zeros when it holds no water."""
+        if not 0 < label < self.cells.size:
+            return 0.0, 0.0, 0.0
+        return float(self.volume[label]), float(self.area[label]), float(self.max_depth[label])
+
+
+def pond_statistics(depth, labels, cell_area=1.0, z_factor=1.0, nodata=None, bunds=None):
+    """Volume, wet cell count and maximum depth of the water over every label.
+
+    One ``np.bincount`` per statistic over the wet cells (``depth`` > 0 and
+    ``labels`` > 0) replaces polygonizing the ponds and running zonal
+    statistics on the polygons. The cells of the ``bunds`` mask are left
+    out, like in ``stage_storage``: the DEM filled with the bunds burnt in
+    stands a bund height above the original DEM on them, which is
+    embankment and not water.
+    """
+    with np.errstate(invalid='ignore'):
+        wet = valid_mask(depth, nodata) & (depth > 0) & (labels > 0)
+    if bunds is not None:
+        wet &= ~bunds
+    cell_labels = labels[wet].astype(np.int64)
+    cell_depth = depth[wet].astype(np.float64) * z_factor
+    size = int(labels.max()) + 1 if labels.size else 1
+    volume = np.bincount(cell_labels, weights=cell_depth * cell_area, minlength=size)
+    cells = np.bincount(cell_labels, minlength=size)
+    max_depth = np.zeros(size)
+    np.maximum.at(max_depth, cell_labels, cell_depth)
+    return PondStatistics(volume, cells, max_depth, cell_area)
+
+
+def run_pond_statistics(parameters, feedback=None):
+    """Processing style entry point of ``pond_statistics``.
+
+    ``DEPTH`` is the filled minus the original DEM, ``BASINS`` the labelled
+    basins on the same grid, the optional ``BUNDS`` a raster on the same
+    grid that is above 0 on the bund cells (e.g. the rasterized heights),
+    left out of the ponds, and ``Z`` the z factor. With a ``PONDS``
+    destination the wet cells are also written labelled by basin (0
+    elsewhere), to polygonize the impounded footprint for display.
+    Returns ``STATISTICS`` and ``PONDS``.
+    """
+    depth, info = blocks.read_raster(parameters['DEPTH'])
+    labels, _ = blocks.read_raster(parameters['BASINS'])
+    if depth.shape != labels.shape:
+        raise ValueError('The depth and basin rasters must share the same grid')
+    bunds = None
+    if parameters.get('BUNDS'):
+        heights, bunds_info = blocks.read_raster(parameters['BUNDS'])
+        if heights.shape != depth.shape:
+            raise ValueError('The bund and depth rasters must share the same grid')
+        with np.errstate(invalid='ignore'):
+            bunds = valid_mask(heights, bunds_info.nodata) & (heights > 0)
+    statistics = pond_statistics(depth, labels, info.cell_area, parameters.get('Z', 1.0), info.nodata, bunds)
+    if feedback is not None:
+        feedback.pushInfo(f'{int(np.count_nonzero(statistics.cells))} ponds, {int(statistics.cells.sum())} wet cells')
+    results = {'STATISTICS': statistics, 'PONDS': None}
+    if parameters.get('PONDS'):
+        with np.errstate(invalid='ignore'):
+            wet = valid_mask(depth, info.nodata) & (depth > 0) & (labels > 0)
+        if bunds is not None:
+            wet &= ~bunds
+        ponds = np.where(wet, labels, 0).astype(np.int32)
+        path = raster_io.output_path(parameters['PONDS'], 'ponds.tif')
+        results['PONDS'] = raster_io.write_raster(path, ponds, info, 0)
+    return results
+
+
+def write_curves(path, curves, step):
+    """Write ``{DB_ID: StageStorage}`` as a CSV table sampled every ``step`` metres."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['DB_ID', 'Stage (m)', 'Elevation', 'Area (m2)', 'Volume(m3)'])
+        for db_id, curve in sorted(curves.items()):
+            for stage, area, volume in zip(*curve.curve(step)):
+                writer.writerow([db_id, round(stage, 3), round(curve.base + stage, 3), area, round(volume, 3)])
+    return path
+
+
+def run_stage_storage(parameters, feedback=None):
+    """Processing style entry point computing the ponds of bunds of several heights.
+
+    ``DEM`` is the filled DEM, ``DIRECTION`` its flow directions (GRASS
+    coding), ``OUTLETS`` the bund sites rasterized by label on the same
+    grid, ``BUNDS`` a list of ``(label, DB_ID, height)`` and ``Z`` the z
+    factor. Bunds of different heights on the same site share its curve.
+
+    Returns ``CURVES`` (``{DB_ID: StageStorage}``), ``STORAGE``
+    (``{DB_ID: (area, volume)}``) and ``PONDS``, a raster per height with
+    the ponds labelled by DB_ID. Only the window holding the basins of the
+    bunds is filled and written; the pond rasters keep the DEM grid but
+    cover that window only.
+    """
+    grid = blocks.raster_info(parameters['DEM'])
+    direction, _ = blocks.read_raster(parameters['DIRECTION'])
+    outlets, outlets_info = blocks.read_raster(parameters['OUTLETS'])
+    if not grid.shape == direction.shape == outlets.shape:
+        raise ValueError('The DEM, flow direction and outlet rasters must share the same grid')
+    cells, labels = outlets_from_raster(outlets, outlets_info.nodata)
+    outlets = np.zeros(direction.size, dtype=np.int32)
+    outlets[cells] = labels
+    outlets = outlets.reshape(direction.shape)
+    if feedback is not None:
+        feedback.pushInfo(f'Computing the stage-storage curves of {np.unique(labels).size} bund sites')
+    basins = label_basins(direction, cells, labels)
+
+    # Everything upstream of the bunds lies in the window of their basins
+    window = basins_window(basins) or (0, 0) + direction.shape
+    row, col, rows, cols = window
+    block = (slice(row, row + rows), slice(col, col + cols))
+    dem, info = blocks.read_window(parameters['DEM'], *window), raster_io.window_info(grid, *window)
+    direction, outlets, basins = direction[block], outlets[block], basins[block]
+    if feedback is not None:
+        feedback.pushInfo(f'Filling a window of {rows} x {cols} cells out of {grid.shape[0]} x {grid.shape[1]}')
+    escape = escape_elevations(dem, outlets, direction, info.nodata)
+    sites = stage_storage(dem, escape, basins, outlets, info.nodata, info.cell_area, parameters.get('Z', 1.0))
+
+    curves, results = {}, {}
+    by_height = {}
+    for label, db_id, height in parameters['BUNDS']:
+        if label not in sites:
+            continue
+        curve = sites[label]
+        curves[db_id] = curve
+        area, volume = curve.storage(curve.base + height)
+        results[db_id] = (float(area), float(volume))
+        by_height.setdefault(height, []).append((label, db_id, curve))
+
+    size = int(basins.max()) + 1
+    pond_paths = {}
+    for height, bunds in by_height.items():
+        crests = np.full(size, np.nan)
+        values = np.zeros(size, dtype=np.int64)
+        for label, db_id, curve in bunds:
+            crests[label] = curve.base + height
+            values[label] = db_id
+        path = raster_io.temp_filename(f'ponds_{height}.tif')
+        raster_io.write_raster(path, ponds(dem, escape, basins, outlets, crests, values, info.nodata), info, 0)
+        pond_paths[height] = path
+    return {'CURVES': curves, 'STORAGE': results, 'PONDS': pond_paths}
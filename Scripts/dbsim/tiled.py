@@ -0,0 +1,311 @@
+"""Out-of-core D8 flow direction and accumulation for DEMs larger than RAM.
+
+The raster is processed in tiles read through GDAL windows. Directions are
+computed tile by tile with a one cell halo, except on flats: their cells
+are gathered from all tiles and routed together afterwards, so a flat cut
+by tile edges drains as it would on the whole raster. Accumulation
+takes two passes over the tiles: the first one accumulates every tile on its
+own and records, for each cell on the tile border, the cell where its flow
+leaves the tile. These exit cells form a small boundary graph that is solved
+in memory to get the flow entering every tile from its neighbours, and the
+second pass accumulates each tile again with that inflow added, which gives
+the same seamless result as accumulating the whole raster at once.
+"""
+
+import math
+
+import numpy as np
+
+from . import raster_io
+from .flow import CODE_COL, CODE_ROW, d8_flow_direction, flow_accumulation, topological_levels
+
+# Working memory of one tile cell during accumulation (receivers, indegree,
+# accumulation, exits, levels and the temporaries of np.unique)
+BYTES_PER_CELL = 96
+
+# Memory of one flat cell while the flats of all tiles are routed together
+FLAT_BYTES_PER_CELL = 64
+
+# Working memory of one cell when filling a DEM in one piece (the DEM and the
+# filled surface as float32, the valid and closed masks and a share of the
+# priority queue); sink filling is not tiled
+FILL_BYTES_PER_CELL = 24
+
+
+def fits_in_memory(path, memory_mb, bytes_per_cell=BYTES_PER_CELL):
+    """Whether the raster can be routed (or processed at ``bytes_per_cell``) in one piece within ``memory_mb``."""
+    rows, cols = raster_io.raster_info(path).shape
+    return rows * cols * bytes_per_cell <= memory_mb * 2 ** 20
+
+
+def fill_memory_mb(path):
+    """Memory needed to fill the DEM ``path``, which is always filled in one piece."""
+    rows, cols = raster_io.raster_info(path).shape
+    return rows * cols * FILL_BYTES_PER_CELL / 2 ** 20
+
+
+def tile_shape(shape, memory_mb):
+    """Largest square tile that keeps the working set of a tile within ``memory_mb``."""
+    side = int(math.sqrt(max(memory_mb, 1) * 2 ** 20 / BYTES_PER_CELL))
+    side = max(side, 256)
+    return min(shape[0], side), min(shape[1], side)
+
+
+def iter_tiles(shape, tile_rows, tile_cols):
+    """Yield ``(row, col, rows, cols)`` windows covering a raster of ``shape``."""
+    for row in range(0, shape[0], tile_rows):
+        for col in range(0, shape[1], tile_cols):
+            yield row, col, min(tile_rows, shape[0] - row), min(tile_cols, shape[1] - col)
+
+
+def tiled_flow_direction(filled_path, direction_path, memory_mb, feedback=None):
+    """Write D8 directions of a filled DEM tile by tile, reading a one cell halo.
+
+    The cells with a lower neighbour, or draining out of the raster, are
+    routed within their tile. The flat cells are kept with the directions
+    of their neighbours of the same elevation and routed together once all
+    tiles are read (``_route_flat_cells``), which gives the directions of
+    ``d8_flow_direction`` on the whole raster. The flat cells are held in
+    memory, about ``FLAT_BYTES_PER_CELL`` bytes each.
+    """
+    info = raster_io.raster_info(filled_path)
+    rows, cols = info.shape
+    tile_rows, tile_cols = tile_shape(info.shape, memory_mb)
+    src = raster_io.open_raster(filled_path)
+    dst = raster_io.create_raster(direction_path, info, np.int16, 0)
+    band = dst.GetRasterBand(1)
+    windows = list(iter_tiles(info.shape, tile_rows, tile_cols))
+    flat_cells, flat_same = [], []
+    for i, (row, col, h, w) in enumerate(windows):
+        r0, c0 = max(row - 1, 0), max(col - 1, 0)
+        r1, c1 = min(row + h + 1, rows), min(col + w + 1, cols)
+        window = raster_io.read_window(src, r0, c0, r1 - r0, c1 - c0)
+        # No flat routing here: the flat cells keep 0 and are routed with those of the other tiles
+        direction = d8_flow_direction(window, info.nodata, routable=np.zeros(window.shape, dtype=bool))
+        core = (slice(row - r0, row - r0 + h), slice(col - c0, col - c0 + w))
+        valid = raster_io.valid_mask(window, info.nodata)
+        local = np.flatnonzero(valid[core] & (direction[core] == 0))
+        if local.size:
+            lr, lc = np.divmod(local, w)
+            lr, lc = lr + row - r0, lc + col - c0
+            same = np.zeros(local.size, dtype=np.uint16)
+            for code in range(1, 9):
+                nr, nc = lr + CODE_ROW[code], lc + CODE_COL[code]
+                inside = (nr >= 0) & (nr < window.shape[0]) & (nc >= 0) & (nc < window.shape[1])
+                inside[inside] = valid[nr[inside], nc[inside]] & (window[nr[inside], nc[inside]] == window[lr[inside], lc[inside]])
+                same[inside] |= np.uint16(1 << code)
+            flat_cells.append((lr + r0) * cols + lc + c0)
+            flat_same.append(same)
+        band.WriteArray(direction[core], col, row)
+        if feedback is not None:
+            feedback.setProgress(40 * (i + 1) / len(windows))
+
+    if flat_cells:
+        cells, same = np.concatenate(flat_cells), np.concatenate(flat_same)
+        order = np.argsort(cells)
+        cells, same = cells[order], same[order]
+        if feedback is not None:
+            feedback.pushInfo(f'Routing {cells.size} flat cells across the tiles')
+        codes = _route_flat_cells(cells, same, info.shape)
+        for row, col, h, w in windows:
+            lo, hi = np.searchsorted(cells, [row * cols, (row + h) * cols])
+            r, c = np.divmod(cells[lo:hi], cols)
+            inside = (c >= col) & (c < col + w)
+            if not inside.any():
+                continue
+            direction = raster_io.read_window(dst, row, col, h, w)
+            direction[r[inside] - row, c[inside] - col] = codes[lo:hi][inside]
+            band.WriteArray(direction, col, row)
+    if feedback is not None:
+        feedback.setProgress(50)
+    band.FlushCache()
+    src = dst = None
+    return direction_path
+
+
+def _route_flat_cells(cells, same, shape):
+    """Codes of the flat cells ``cells`` (sorted flat indices), routed as in ``flow._route_flats``.
+
+    Bit ``k`` of ``same`` is set when the neighbour in direction ``k`` has
+    the same elevation; such a neighbour drains when it is not flat, or
+    once it is reached. Cells that cannot reach a draining cell keep 0.
+    """
+    n = cells.size
+    cols = shape[1]
+    rows_of, cols_of = np.divmod(cells, cols)
+    codes = np.zeros(n, dtype=np.int16)
+    draining = np.zeros(n, dtype=bool)
+    queued = np.zeros(n, dtype=bool)
+
+    def neighbour(level, code):
+        # Whether the neighbour ``code`` has the same elevation, and its position among the flat cells (-1 if not flat)
+        has = (same[level] >> np.uint16(code)) & np.uint16(1) > 0
+        index = (rows_of[level] + CODE_ROW[code]) * cols + cols_of[level] + CODE_COL[code]
+        position = np.minimum(np.searchsorted(cells, index), n - 1)
+        return has, np.where(has & (cells[position] == index), position, -1)
+
+    def draining_code(level):
+        # First code (0 if none) pointing to a draining neighbour of the same elevation
+        found = np.zeros(level.size, dtype=np.int16)
+        for code in range(8, 0, -1):
+            has, position = neighbour(level, code)
+            found[has & ((position < 0) | draining[np.maximum(position, 0)])] = code
+        return found
+
+    level = np.flatnonzero(draining_code(np.arange(n)) != 0)
+    queued[level] = True
+    while level.size:
+        codes[level] = draining_code(level)
+        draining[level] = True
+        following = []
+        for code in range(1, 9):
+            _, position = neighbour(level, code)
+            position = np.unique(position[position >= 0])
+            position = position[~queued[position]]
+            queued[position] = True
+            following.append(position)
+        level = np.concatenate(following)
+    return codes
+
+
+def _tile_receivers(direction, row, col, shape):
+    """Receivers inside the tile, and the global target of cells whose flow leaves it."""
+    h, w = direction.shape
+    code = np.where(direction > 0, direction, 0).astype(np.int64)
+    lr = np.arange(h, dtype=np.int64)[:, None] + CODE_ROW[code]
+    lc = np.arange(w, dtype=np.int64)[None, :] + CODE_COL[code]
+    gr, gc = lr + row, lc + col
+    in_raster = (code > 0) & (gr >= 0) & (gr < shape[0]) & (gc >= 0) & (gc < shape[1])
+    in_tile = in_raster & (lr >= 0) & (lr < h) & (lc >= 0) & (lc < w)
+    recv = np.where(in_tile, lr * w + lc, -1).ravel()
+    leaving = (in_raster & ~in_tile).ravel()
+    return recv, leaving, (gr * shape[1] + gc).ravel()
+
+
+def _global_index(local, row, col, width, cols):
+    return (row + local // width) * cols + col + local % width
+
+
+def _border(h, w):
+    """Local indices of the cells on the border of an ``h`` x ``w`` tile."""
+    mask = np.zeros((h, w), dtype=bool)
+    mask[0, :] = mask[-1, :] = mask[:, 0] = mask[:, -1] = True
+    return np.flatnonzero(mask)
+
+
+def _valid(direction, nodata):
+    if nodata is None:
+        return np.ones(direction.shape, dtype=bool)
+    return direction != nodata
+
+
+def tiled_flow_accumulation(direction_path, accumulation_path, memory_mb, feedback=None):
+    """Write the D8 flow accumulation of a direction raster without loading it whole."""
+    info = raster_io.raster_info(direction_path)
+    rows, cols = info.shape
+    tile_rows, tile_cols = tile_shape(info.shape, memory_mb)
+    windows = list(iter_tiles(info.shape, tile_rows, tile_cols))
+    src = raster_io.open_raster(direction_path)
+
+    # Pass 1: local accumulation and the exit reached from every border cell
+    exit_cells, exit_targets, exit_acc = [], [], []
+    border_cells, border_exits = [], []
+    for i, (row, col, h, w) in enumerate(windows):
+        direction = raster_io.read_window(src, row, col, h, w)
+        valid = _valid(direction, info.nodata)
+        recv, leaving, target = _tile_receivers(direction, row, col, info.shape)
+        levels = list(topological_levels(recv, valid))
+        acc = flow_accumulation(recv, active=valid)
+
+        exits = np.flatnonzero(leaving & valid.ravel())
+        exit_of = np.full(recv.size, -1, dtype=np.int64)
+        exit_of[exits] = exits
+        for frontier in reversed(levels):
+            down = recv[frontier]
+            keep = down >= 0
+            exit_of[frontier[keep]] = exit_of[down[keep]]
+
+        border = _border(h, w)
+        border = border[valid.ravel()[border]]
+        exit_cells.append(_global_index(exits, row, col, w, cols))
+        exit_targets.append(target[exits])
+        exit_acc.append(acc[exits])
+        reached = exit_of[border]
+        border_cells.append(_global_index(border, row, col, w, cols))
+        border_exits.append(np.where(reached >= 0, _global_index(reached, row, col, w, cols), -1))
+        if feedback is not None:
+            feedback.setProgress(50 + 25 * (i + 1) / len(windows))
+
+    # Boundary graph: every exit drains into the exit reached from the cell it flows into
+    exit_cells = np.concatenate(exit_cells)
+    exit_targets = np.concatenate(exit_targets)
+    exit_acc = np.concatenate(exit_acc)
+    border_cells = np.concatenate(border_cells)
+    border_exits = np.concatenate(border_exits)
+    order = np.argsort(border_cells)
+    border_cells, border_exits = border_cells[order], border_exits[order]
+    entered = np.zeros(exit_cells.size, dtype=bool)
+    next_exit = np.full(exit_cells.size, -1, dtype=np.int64)
+    if border_cells.size:
+        pos = np.minimum(np.searchsorted(border_cells, exit_targets), border_cells.size - 1)
+        entered = border_cells[pos] == exit_targets
+        next_exit[entered] = border_exits[pos[entered]]
+
+    order = np.argsort(exit_cells)
+    linked = next_exit >= 0
+    graph = np.full(exit_cells.size, -1, dtype=np.int64)
+    graph[linked] = order[np.searchsorted(exit_cells[order], next_exit[linked])]
+    outflow = flow_accumulation(graph, weights=exit_acc)
+
+    # Inflow received by every entry cell, grouped by tile
+    entry_cells = exit_targets[entered]
+    entry_flow = outflow[entered]
+    tiles_per_row = -(-cols // tile_cols)
+    entry_tile = (entry_cells // cols // tile_rows) * tiles_per_row + (entry_cells % cols) // tile_cols
+    order = np.argsort(entry_tile, kind='stable')
+    entry_cells, entry_flow, entry_tile = entry_cells[order], entry_flow[order], entry_tile[order]
+
+    # Pass 2: accumulate every tile again with the inflow from its neighbours
+    dst = raster_io.create_raster(accumulation_path, info, np.float64)
+    band = dst.GetRasterBand(1)
+    for i, (row, col, h, w) in enumerate(windows):
+        direction = raster_io.read_window(src, row, col, h, w)
+        valid = _valid(direction, info.nodata)
+        recv, _, _ = _tile_receivers(direction, row, col, info.shape)
+        tile_id = (row // tile_rows) * tiles_per_row + col // tile_cols
+        lo, hi = np.searchsorted(entry_tile, [tile_id, tile_id + 1])
+        cells = entry_cells[lo:hi]
+        local = (cells // cols - row) * w + cells % cols - col
+        weights = valid.ravel().astype(np.float64)
+        np.add.at(weights, local, entry_flow[lo:hi])
+        acc = flow_accumulation(recv, weights=weights, active=valid)
+        band.WriteArray(acc.reshape(h, w), col, row)
+        if feedback is not None:
+            feedback.setProgress(75 + 25 * (i + 1) / len(windows))
+    band.FlushCache()
+    src = dst = None
+    return accumulation_path
+
+
+def run_tiled_accumulation(parameters, feedback=None):
+    """Tiled counterpart of ``flow.run_flow_accumulation``.
+
+    Takes the filled DEM as ``elevation`` (or an existing ``direction``
+    raster), the ``accumulation`` and optional ``drainage`` destinations and
+    the ``memory`` budget in MB.
+    """
+    memory = parameters.get('memory', 2000)
+    direction = parameters.get('direction')
+    if not direction:
+        direction = raster_io.output_path(parameters.get('drainage'), 'drainage.tif')
+        if feedback is not None:
+            feedback.pushInfo(f'Calculating D8 flow direction in tiles of {tile_shape(raster_io.raster_info(parameters["elevation"]).shape, memory)} cells')
+        tiled_flow_direction(parameters['elevation'], direction, memory, feedback)
+    accumulation = raster_io.output_path(parameters.get('accumulation'), 'accumulation.tif')
+    if feedback is not None:
+        feedback.pushInfo('Calculating flow accumulation in tiles')
+    tiled_flow_accumulation(direction, accumulation, memory, feedback)
+    results = {'accumulation': accumulation}
+    if parameters.get('drainage'):
+        results['drainage'] = direction
+    return results
@@ -0,0 +1,97 @@
+"""Overlapping tiles for running the bund simulation over regional catchments.
+
+The catchment extent is cut into square tiles. Each tile is run on its
+``halo`` box, which extends the ``core`` box by at least the bund length
+plus the overlap-suppression distance, so the bunds near a core border
+see the same terrain and neighbouring bunds as in a single run. The flow
+lines are clipped to the halo box, though, and the stations are laid out
+along the clipped lines: a station starts every line where it enters the
+halo, so the stations (and bunds) of a tile can sit up to one spacing away
+from those of a single run, and the elevation drop filter only compares a
+point with the upstream points inside the halo, so it can keep a point
+that a single run would drop. When merging,
+a bund belongs to the tile whose core holds its centre point (cores are
+half-open boxes, so a point on a border belongs to exactly one tile), which
+removes the duplicates simulated in the halos of neighbouring tiles.
+"""
+
+import math
+import os
+import shutil
+import subprocess
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class Tile(namedtuple('Tile', 'row col core halo')):
+    """Tile of the grid; ``core`` and ``halo`` are ``(xmin, ymin, xmax, ymax)`` boxes."""
+
+    @property
+    def name(self):
+        return f'tile_{self.row}_{self.col}'
+
+
+def tile_grid(extent, size, halo):
+    """Tiles of ``size`` map units covering ``extent`` ``(xmin, ymin, xmax, ymax)``, with a ``halo``."""
+    xmin, ymin, xmax, ymax = extent
+    cols = max(int(math.ceil((xmax - xmin) / size)), 1)
+    rows = max(int(math.ceil((ymax - ymin) / size)), 1)
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            x0, y1 = xmin + col * size, ymax - row * size
+            # The last row and column are closed at the extent, so no point is left out
+            x1 = xmax if col == cols - 1 else x0 + size
+            y0 = ymin if row == rows - 1 else y1 - size
+            core = (x0, y0, x1, y1)
+            tiles.append(Tile(row, col, core, (x0 - halo, y0 - halo, x1 + halo, y1 + halo)))
+    return tiles
+
+
+def owned(x, y, tile, extent):
+    """Mask of the points ``(x, y)`` that belong to the core of ``tile``.
+
+    Cores are closed on the west and north sides; the east and south sides
+    are only closed at the border of the whole ``extent``.
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    x0, y0, x1, y1 = tile.core
+    east = (x <= x1) if x1 >= extent[2] else (x < x1)
+    south = (y >= y0) if y0 <= extent[1] else (y > y0)
+    return (x >= x0) & east & (y <= y1) & south
+
+
+def find_qgis_process():
+    """Path of the ``qgis_process`` command line runner of the installation, None when not found."""
+    names = ['qgis_process-qgis.bat', 'qgis_process-qgis-ltr.bat', 'qgis_process.exe'] if os.name == 'nt' else ['qgis_process']
+    for name in names:
+        path = shutil.which(name)
+        if path:
+            return path
+        # QGIS on Windows keeps its runners next to the apps folder holding Python
+        path = os.path.join(sys.exec_prefix, '..', '..', 'bin', name)
+        if os.path.exists(path):
+            return os.path.abspath(path)
+    return None
+
+
+def qgis_process_command(executable, algorithm, parameters):
+    """Arguments running ``algorithm`` with ``parameters`` (paths and plain values) through qgis_process."""
+    return [executable, 'run', algorithm, '--'] + [f'{key}={value}' for key, value in parameters.items()]
+
+
+def run_commands(commands, workers, feedback=None):
+    """Run the commands, ``workers`` at a time, raising ``RuntimeError`` on the first failure."""
+    def run(command):
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as pool:
+        for done, (command, result) in enumerate(zip(commands, pool.map(run, commands)), 1):
+            if result.returncode != 0:
+                raise RuntimeError(f'{" ".join(command[:3])} failed:\n{result.stdout}')
+            if feedback is not None:
+                feedback.pushInfo(f'Tile {done} of {len(commands)} done')
+                feedback.setProgress(100 * done / len(commands))
@@ -0,0 +1,95 @@
+"""Elevation profiles along bund transects, sampled for all transects at once.
+
+A transect crosses a candidate point perpendicular to the flow line: its
+left half goes ``half_length`` from the point along the ``angle`` (math
+convention, degrees counter-clockwise from east, as the ``L_perp`` field),
+its right half the same distance the opposite way. All transects are
+sampled as one ``(N, samples)`` array, column ``centre`` being the point.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from . import raster_io
+from .sample import NEAREST, sample_raster
+
+
+class Transects(namedtuple('Transects', 'offsets profile centre')):
+    """Sampled transects: ``offsets`` along the line (positive on the left half) and the ``profile`` rows."""
+
+    @property
+    def left(self):
+        return self.profile[:, self.centre:]
+
+    @property
+    def right(self):
+        return self.profile[:, :self.centre + 1]
+
+    @property
+    def minimum(self):
+        return np.fmin.reduce(self.profile, axis=1)
+
+    @property
+    def maximum(self):
+        return np.fmax.reduce(self.profile, axis=1)
+
+    @property
+    def left_range(self):
+        """Elevation range of the left half, like a zonal range along it."""
+        return np.fmax.reduce(self.left, axis=1) - np.fmin.reduce(self.left, axis=1)
+
+    @property
+    def right_range(self):
+        return np.fmax.reduce(self.right, axis=1) - np.fmin.reduce(self.right, axis=1)
+
+    def ranges(self, half_lengths):
+        """Left and right elevation ranges of the shorter transects of every half length.
+
+        The shorter transects are the samples of this profile within
+        ``half_length`` of the point, so one sampled longest transect serves
+        all lengths. Returns two ``(len(half_lengths), N)`` arrays.
+        """
+        half = self.offsets[self.centre:]
+        half_lengths = np.atleast_1d(np.asarray(half_lengths, dtype=np.float64))
+        shape = (half_lengths.size, self.profile.shape[0])
+        left, right = [], []
+        for half_length in half_lengths:
+            k = max(int(np.searchsorted(half, half_length + 1e-9, side='right')), 1)
+            left_half = self.profile[:, self.centre:self.centre + k]
+            right_half = self.profile[:, self.centre - k + 1:self.centre + 1]
+            left.append(np.fmax.reduce(left_half, axis=1) - np.fmin.reduce(left_half, axis=1))
+            right.append(np.fmax.reduce(right_half, axis=1) - np.fmin.reduce(right_half, axis=1))
+        return np.array(left, dtype=np.float64).reshape(shape), np.array(right, dtype=np.float64).reshape(shape)
+
+    def crest(self, height):
+        """Bund height needed along every transect for a level crest ``height`` above its lowest point."""
+        crest = self.minimum + np.asarray(height, dtype=np.float64)
+        return np.clip(crest[:, None] - self.profile, 0.0, None)
+
+
+def transect_coordinates(x, y, angle, half_length, step):
+    """Offsets and ``(N, samples)`` map coordinates of the transects, every ``step`` along them."""
+    n = max(int(np.ceil(half_length / step)), 1)
+    offsets = np.linspace(-half_length, half_length, 2 * n + 1)
+    rad = np.radians(np.asarray(angle, dtype=np.float64))[:, None]
+    tx = np.asarray(x, dtype=np.float64)[:, None] + offsets * np.cos(rad)
+    ty = np.asarray(y, dtype=np.float64)[:, None] + offsets * np.sin(rad)
+    return offsets, tx, ty
+
+
+def line_ends(x, y, angle, half_length):
+    """Coordinates ``(xl, yl, xr, yr)`` of the left and right ends of the transects."""
+    rad = np.radians(np.asarray(angle, dtype=np.float64))
+    dx, dy = half_length * np.cos(rad), half_length * np.sin(rad)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    return x + dx, y + dy, x - dx, y - dy
+
+
+def sample_transects(raster, x, y, angle, half_length, step=None, method=NEAREST):
+    """Sample ``raster`` along the transects, every half cell unless ``step`` is given."""
+    if step is None:
+        step = raster_io.raster_info(raster).cellsize / 2
+    offsets, tx, ty = transect_coordinates(x, y, angle, half_length, step)
+    profile = sample_raster(raster, tx, ty, method)
+    return Transects(offsets, profile, offsets.size // 2)
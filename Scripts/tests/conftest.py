@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The engines are imported as the scripts import them, from the Scripts folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,33 @@
+import numpy as np
+
+from dbsim import algebra, raster_io
+from dbsim.algebra import Output, Raster, evaluate, where
+
+A = np.array([[1, 2, -9999],
+              [4, -9999, 6]], dtype=np.float32)
+B = np.array([[10, 20, 30],
+              [5, 0, 60]], dtype=np.float32)
+
+
+def rasters(tmp_path):
+    info = raster_io.RasterInfo((0.0, 1.0, 0.0, 2.0, 0.0, -1.0), '', None, A.shape)
+    a = raster_io.write_raster(str(tmp_path / 'a.tif'), A, info, -9999)
+    b = raster_io.write_raster(str(tmp_path / 'b.tif'), B, info)
+    return Raster(a), Raster(b)
+
+
+def test_nodata_of_an_input_is_nodata_in_the_result(tmp_path, monkeypatch):
+    # One row per block, so the blocks are read and written one at a time
+    monkeypatch.setattr(algebra, 'BLOCK_CELLS', 3)
+    a, b = rasters(tmp_path)
+    total, filled = evaluate([Output(a + b, str(tmp_path / 'total.tif'), 'float32', -1),
+                              Output(a.filled(0) + b, str(tmp_path / 'filled.tif'), 'float32', -1)])
+    np.testing.assert_array_equal(raster_io.read_raster(total)[0], [[11, 22, -1], [9, -1, 66]])
+    np.testing.assert_array_equal(raster_io.read_raster(filled)[0], [[11, 22, 30], [9, 0, 66]])
+
+
+def test_where_only_depends_on_the_branch_it_picks(tmp_path):
+    a, b = rasters(tmp_path)
+    picked = algebra.calculate(where(b > 0, a, b), str(tmp_path / 'picked.tif'), nodata=-1)
+    # The nodata of a is only kept where b > 0 picks it
+    np.testing.assert_array_equal(raster_io.read_raster(picked)[0], [[1, 2, -1], [4, 0, 6]])
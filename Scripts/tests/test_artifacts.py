@@ -0,0 +1,37 @@
+from dbsim import raster_io
+from dbsim.artifacts import ArtifactCache
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+
+def test_key_holds_the_format_of_the_destinations(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    dem = write(tmp_path / 'dem.tif', 'dem')
+
+    def key(output):
+        return cache.key('step', {'INPUT': dem, 'OUTPUT': output}, destinations=('OUTPUT',))
+
+    # The same format written elsewhere is a hit, another format is not
+    assert key(str(tmp_path / 'a.gpkg')) == key(str(tmp_path / 'other' / 'b.GPKG'))
+    assert key(str(tmp_path / 'a.gpkg')) != key(str(tmp_path / 'b.shp'))
+    assert key(raster_io.TEMPORARY_OUTPUT) != key(str(tmp_path / 'a.gpkg'))
+
+
+def test_restore_copies_the_outputs_with_their_sidecars(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    first = tmp_path / 'first'
+    first.mkdir()
+    for extension in ('.shp', '.dbf', '.prj'):
+        write(first / f'lines{extension}', extension)
+    manifest = cache.put('k', {'OUTPUT': str(first / 'lines.shp'), 'COUNT': 3})
+
+    restored = cache.restore('k', cache.get('k'), {'OUTPUT': str(tmp_path / 'again.shp')})
+    assert manifest['files'] == {'OUTPUT': 'lines.shp'}
+    assert restored == {'OUTPUT': str(tmp_path / 'again.shp'), 'COUNT': 3}
+    for extension in ('.shp', '.dbf', '.prj'):
+        with open(tmp_path / f'again{extension}') as f:
+            assert f.read() == extension
@@ -0,0 +1,32 @@
+import numpy as np
+
+from dbsim.basins import basins_window, label_basins, outlets_from_raster
+from dbsim.flow import d8_flow_direction
+
+# Valley along the middle column sloping south: every cell of a row drains
+# sideways into the valley, which drains down to the last row
+ROWS, COLS = np.indices((6, 5))
+VALLEY = (5.0 * np.abs(COLS - 2) - ROWS).astype(np.float32)
+
+
+def test_nested_outlets_cut_their_basin_out():
+    direction = d8_flow_direction(VALLEY)
+    basins = label_basins(direction, [2 * 5 + 2, 4 * 5 + 2], [3, 7])
+    expected = np.zeros((6, 5), dtype=np.int32)
+    expected[:3] = 3
+    expected[3:5] = 7
+    np.testing.assert_array_equal(basins, expected)
+    assert basins_window(basins, margin=0) == (0, 0, 5, 5)
+
+
+def test_outlet_cells_sharing_a_label():
+    # A bund across the valley on row 3 covers three cells under one label
+    direction = d8_flow_direction(VALLEY)
+    outlets = np.zeros((6, 5), dtype=np.float32)
+    outlets[3, 1:4] = 12
+    outlets[0, 0] = -1
+    cells, labels = outlets_from_raster(outlets, nodata=-1)
+    np.testing.assert_array_equal(cells, [16, 17, 18])
+    basins = label_basins(direction, cells, labels)
+    assert np.all(basins[:4] == 12)
+    assert np.all(basins[4:] == 0)
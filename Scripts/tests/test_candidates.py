@@ -0,0 +1,52 @@
+import numpy as np
+
+from dbsim.candidates import morton_order, reach_chunks
+
+
+def scattered_reaches(seed=0):
+    # 40 short straight reaches scattered over 1 km, and 200 points off the reaches
+    rng = np.random.default_rng(seed)
+    x, y, reach = [], [], []
+    for label in range(1, 41):
+        n = rng.integers(20, 80)
+        cx, cy = rng.uniform(0, 1000, 2)
+        t = np.linspace(0, 1, n)
+        x.append(cx + 30 * t)
+        y.append(cy + 20 * t)
+        reach.append(np.full(n, label))
+    x.append(rng.uniform(0, 1000, 200))
+    y.append(rng.uniform(0, 1000, 200))
+    reach.append(np.zeros(200))
+    return np.concatenate(x), np.concatenate(y), np.concatenate(reach)
+
+
+def test_morton_order_visits_quadrants_in_turn():
+    x = [1.0, 0.0, 1.0, 0.0]
+    y = [1.0, 0.0, 0.0, 1.0]
+    np.testing.assert_array_equal(morton_order(x, y), [1, 2, 3, 0])
+    assert morton_order([], []).size == 0
+
+
+def test_chunks_cover_every_point_once_with_whole_reaches():
+    x, y, reach = scattered_reaches()
+    for chunks in (reach_chunks(reach, 8), reach_chunks(reach, 8, x, y)):
+        assert len(chunks) == 8
+        np.testing.assert_array_equal(np.sort(np.concatenate(chunks)), np.arange(reach.size))
+        for label in range(1, 41):
+            assert sum(np.any(reach[chunk] == label) for chunk in chunks) == 1
+
+
+def test_compact_chunks_are_smaller_and_balanced():
+    x, y, reach = scattered_reaches()
+
+    def mean_area(chunks):
+        return np.mean([np.ptp(x[chunk]) * np.ptp(y[chunk]) for chunk in chunks])
+
+    compact = reach_chunks(reach, 8, x, y)
+    assert mean_area(compact) < mean_area(reach_chunks(reach, 8)) / 2
+    sizes = [chunk.size for chunk in compact]
+    assert max(sizes) < 2 * reach.size / 8
+
+
+def test_no_points():
+    assert reach_chunks(np.zeros(0), 4, np.zeros(0), np.zeros(0)) == []
@@ -0,0 +1,36 @@
+import numpy as np
+
+from dbsim.fill import fill_depressions
+from dbsim.flow import CODE_COL, CODE_ROW
+
+
+def terrain(shape=(40, 50), seed=0):
+    # Rough surface full of pits, on a tilt so it is not one big flat once filled
+    rng = np.random.default_rng(seed)
+    rows = np.indices(shape)[0]
+    return (rng.random(shape) * 5 + 0.1 * rows).astype(np.float32)
+
+
+def test_fill_is_never_below_the_dem():
+    dem = terrain()
+    filled = fill_depressions(dem)
+    assert np.all(filled >= dem)
+    assert np.any(filled > dem)
+
+
+def test_fill_leaves_no_interior_pits():
+    dem = terrain()
+    filled = fill_depressions(dem, min_slope=0.01)
+    interior = filled[1:-1, 1:-1]
+    lowest = np.full(interior.shape, np.inf, dtype=np.float64)
+    for code in range(1, 9):
+        r, c = 1 + CODE_ROW[code], 1 + CODE_COL[code]
+        lowest = np.minimum(lowest, filled[r:r + interior.shape[0], c:c + interior.shape[1]])
+    # With a minimum slope every interior cell has a strictly lower neighbour
+    assert np.all(lowest < interior)
+
+
+def test_fill_keeps_a_depression_free_dem():
+    rows, cols = np.indices((20, 30))
+    dem = (rows + cols).astype(np.float32)
+    np.testing.assert_array_equal(fill_depressions(dem), dem)
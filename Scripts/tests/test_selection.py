@@ -0,0 +1,35 @@
+import numpy as np
+
+from dbsim.selection import elevation_drop_filter, segment_distance, suppress_overlaps
+
+
+def test_drop_filter_per_height_and_reach():
+    # Reach 1 walked down in increasing contributing area, given out of order; reach 2 starts again from the top
+    area = np.array([3.0, 1.0, 5.0, 2.0, 4.0, 1.0, 2.0])
+    elevation = np.array([8.0, 10.0, 6.0, 9.5, 7.9, 20.0, 19.5])
+    reach = np.array([1, 1, 1, 1, 1, 2, 2])
+    keep = elevation_drop_filter(reach, area, elevation, [1.0, 2.0])
+    np.testing.assert_array_equal(keep[0], [True, True, True, False, False, True, False])
+    np.testing.assert_array_equal(keep[1], [False, True, False, False, True, True, False])
+
+
+def test_drop_filter_of_no_points():
+    assert elevation_drop_filter([], [], [], [1.0, 2.0]).shape == (2, 0)
+
+
+def test_crossing_segments_touch():
+    assert segment_distance(0.0, 0.0, 2.0, 2.0, np.array([0.0]), np.array([2.0]), np.array([2.0]), np.array([0.0]))[0] == 0.0
+
+
+def test_suppression_keeps_the_largest_of_crossing_lines():
+    # Two crossing lines and one far away; the crossing line with the smaller contributing area goes
+    keep = suppress_overlaps([0, 0, 10], [0, 2, 0], [2, 2, 12], [2, 0, 2], [5.0, 8.0, 1.0])
+    np.testing.assert_array_equal(keep, [False, True, True])
+
+
+def test_suppression_within_distance_and_groups():
+    # Parallel lines 1 apart: kept apart with no distance, suppressed within 1.5, kept in different groups
+    x0, y0, x1, y1, score = [0, 0], [0, 1], [4, 4], [0, 1], [1.0, 2.0]
+    np.testing.assert_array_equal(suppress_overlaps(x0, y0, x1, y1, score), [True, True])
+    np.testing.assert_array_equal(suppress_overlaps(x0, y0, x1, y1, score, distance=1.5), [False, True])
+    np.testing.assert_array_equal(suppress_overlaps(x0, y0, x1, y1, score, distance=1.5, groups=[1, 2]), [True, True])
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from dbsim.stations import stations
+
+
+def test_stations_every_spacing_from_the_start_of_each_part():
+    points = stations([[(0, 0), (0, 100)], [(0, 0), (30, 0), (30, 40)]], 60)
+    np.testing.assert_array_equal(points.part, [0, 0, 1, 1])
+    np.testing.assert_array_equal(points.chainage, [0, 60, 0, 60])
+    # The second part turns north after 30 m, so its station at 60 m is 30 m up the second segment
+    np.testing.assert_allclose(np.c_[points.x, points.y], [[0, 0], [0, 60], [0, 0], [30, 30]])
+
+
+def test_part_is_the_input_index_with_empty_parts():
+    points = stations([[(0, 0), (0, 100)], [(5, 5)], [], [(0, 0), (0, 130)]], 60)
+    np.testing.assert_array_equal(points.part, [0, 0, 1, 3, 3, 3])
+    np.testing.assert_array_equal(points.chainage, [0, 60, 0, 0, 60, 120])
+
+
+def test_tangent_and_transect_bearings():
+    # Flowing east: compass tangent 90, transect halves at 360 - 90 and 180 more
+    points = stations([[(0, 0), (200, 0)]], 50)
+    np.testing.assert_allclose(points.tangent, 90.0)
+    np.testing.assert_allclose(points.l_perp, 270.0)
+    np.testing.assert_allclose(points.r_perp, 450.0)
+
+
+@pytest.mark.parametrize('parts', [[], [[], []]])
+def test_no_stations(parts):
+    assert stations(parts, 60).x.size == 0
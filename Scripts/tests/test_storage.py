@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from dbsim.fill import refill_local
+from dbsim.flow import d8_flow_direction
+from dbsim.storage import escape_elevations, pond_statistics, stage_storage
+
+# Valley draining south between ridges at 9, with a bund across it on row 3:
+# the two cells behind the bund (at 4 and 3) hold water up to the ridges
+BOWL = np.array([[9, 9, 9],
+                 [9, 4, 9],
+                 [9, 3, 9],
+                 [9, 2, 9],
+                 [9, 1, 9]], dtype=np.float32)
+
+
+def bowl():
+    outlets = np.zeros(BOWL.shape, dtype=np.int32)
+    outlets[3, 1] = 1
+    basins = np.ones(BOWL.shape, dtype=np.int32)
+    direction = d8_flow_direction(BOWL)
+    return outlets, basins, direction
+
+
+@pytest.mark.parametrize('crest, area, volume', [
+    (2.0, 0, 0.0),
+    (3.5, 1, 0.5),
+    (5.0, 2, 1.0 + 2.0),
+    (12.0, 2, 5.0 + 6.0),  # capped at the ridges
+])
+def test_stage_storage_of_a_bowl(crest, area, volume):
+    outlets, basins, direction = bowl()
+    escape = escape_elevations(BOWL, outlets, direction)
+    curve = stage_storage(BOWL, escape, basins, outlets, cell_area=4.0)[1]
+    assert curve.base == 2.0
+    assert curve.spill == 9.0
+    assert curve.storage(crest) == pytest.approx((area * 4.0, volume * 4.0))
+
+
+def test_pond_statistics_match_stage_storage():
+    # The DEM refilled with the bund burnt in holds the same water, once the bund cell is left out
+    outlets, basins, direction = bowl()
+    new_dem = BOWL.copy()
+    new_dem[3, 1] = 5.0
+    depth = refill_local(BOWL, new_dem, direction) - BOWL
+    statistics = pond_statistics(depth, basins, cell_area=4.0, bunds=outlets > 0)
+    curve = stage_storage(BOWL, escape_elevations(BOWL, outlets, direction), basins, outlets, cell_area=4.0)[1]
+    assert statistics.volume[1] == pytest.approx(curve.storage(5.0)[1])
+    assert statistics.cells[1] == 2
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from dbsim import raster_io
+from dbsim.fill import fill_depressions
+from dbsim.flow import run_flow_accumulation
+from dbsim.tiled import run_tiled_accumulation
+
+
+def whole_and_tiled(tmp_path, dem, nodata=None):
+    # The smallest tiles are 256 cells a side, so a raster over 256 cells a side is split with a 1 MB budget
+    info = raster_io.RasterInfo((0.0, 1.0, 0.0, float(dem.shape[0]), 0.0, -1.0), '', nodata, dem.shape)
+    elevation = raster_io.write_raster(str(tmp_path / 'filled.tif'), dem, info, nodata)
+    whole = run_flow_accumulation({'elevation': elevation, 'accumulation': str(tmp_path / 'acc.tif'),
+                                   'drainage': str(tmp_path / 'dir.tif')})
+    tiled = run_tiled_accumulation({'elevation': elevation, 'accumulation': str(tmp_path / 'acc_tiled.tif'),
+                                    'drainage': str(tmp_path / 'dir_tiled.tif'), 'memory': 1})
+    return [[raster_io.read_raster(results[name])[0] for results in (whole, tiled)] for name in ('drainage', 'accumulation')]
+
+
+def assert_seamless(tmp_path, dem, nodata=None):
+    (direction, tiled_direction), (acc, tiled_acc) = whole_and_tiled(tmp_path, dem, nodata)
+    np.testing.assert_array_equal(tiled_direction, direction)
+    np.testing.assert_allclose(tiled_acc, acc)
+
+
+def terrain(shape, seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.indices(shape)
+    return (rng.random(shape) * 5 + 0.1 * rows + 0.05 * cols).astype(np.float32)
+
+
+def test_tiled_equals_untiled_without_flats(tmp_path):
+    assert_seamless(tmp_path, fill_depressions(terrain((300, 280), seed=1), min_slope=0.1))
+
+
+def test_tiled_equals_untiled_on_filled_flats(tmp_path):
+    # Filled without a minimum slope, as the terrain tool does by default
+    dem = fill_depressions(terrain((300, 280), seed=2))
+    dem[40:60, 100:130] = -9999
+    assert_seamless(tmp_path, dem, nodata=-9999)
+
+
+@pytest.mark.parametrize('outlet', ['east', 'corner'])
+def test_flat_spanning_tiles(tmp_path, outlet):
+    # One flat over the four tiles, walled on three sides, so every cell drains towards the open edge
+    dem = np.full((300, 300), 5.0, dtype=np.float32)
+    dem[0, :] = dem[-1, :] = dem[:, 0] = dem[:, -1] = 9.0
+    if outlet == 'east':
+        dem[1:-1, -1] = 5.0
+    else:
+        dem[-1, -1] = 4.0
+    (direction, tiled_direction), (acc, tiled_acc) = whole_and_tiled(tmp_path, dem)
+    assert np.all(tiled_direction != 0)
+    np.testing.assert_array_equal(tiled_direction, direction)
+    np.testing.assert_allclose(tiled_acc, acc)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from dbsim.transects import Transects, line_ends, transect_coordinates
+
+
+def test_ranges_of_every_half_length():
+    # One transect sampled at -2..2 around the point: the right half is read up to the centre, the left half from it
+    profile = Transects(np.linspace(-2.0, 2.0, 5), np.array([[5.0, 3.0, 1.0, 4.0, 8.0]]), 2)
+    left, right = profile.ranges([1.0, 2.0])
+    np.testing.assert_array_equal(left, [[3.0], [7.0]])
+    np.testing.assert_array_equal(right, [[2.0], [4.0]])
+    assert profile.left_range[0] == 7.0 and profile.right_range[0] == 4.0
+
+
+def test_ranges_skip_samples_outside_the_raster():
+    profile = Transects(np.linspace(-2.0, 2.0, 5), np.array([[np.nan, 3.0, 1.0, 4.0, np.nan]]), 2)
+    left, right = profile.ranges([2.0])
+    np.testing.assert_array_equal(left, [[3.0]])
+    np.testing.assert_array_equal(right, [[2.0]])
+
+
+def test_coordinates_follow_the_angle():
+    offsets, tx, ty = transect_coordinates([10.0], [20.0], [90.0], 2.0, 1.0)
+    np.testing.assert_array_equal(offsets, [-2.0, -1.0, 0.0, 1.0, 2.0])
+    np.testing.assert_allclose(tx, [[10.0] * 5], atol=1e-12)
+    np.testing.assert_allclose(ty, [[18.0, 19.0, 20.0, 21.0, 22.0]])
+    np.testing.assert_allclose(line_ends([10.0], [20.0], [90.0], 2.0), [[10.0], [22.0], [10.0], [18.0]], atol=1e-12)